@@ -1,67 +1,217 @@
 """主程序模块，整合所有组件并提供统一的接口"""
 
-import json
 import time
+import logging
 from models.model_interface import ModelInterface
-from managers.message_history import MessageHistory
-from managers.user_profile import UserProfileManager
+from models.scheduler import BatchScheduler
+from models.tracing import tracer, Span
 from managers.memory import MemoryManager
+from managers.memory_consolidation import MemoryConsolidator
+from managers.history_summarizer import HistorySummarizer
+from managers.profile_gate import ProfileFactGate
+from managers.post_response import PostResponseStage
+from managers.session_manager import SessionManager
+from managers.user_profile import UserProfileManager
 from config.config import Config
+from config.logging_config import get_logger, setup_logging
+
+turn_logger = get_logger("turn")
+profile_logger = get_logger("profile")
+clue_logger = get_logger("clues")
+prompt_logger = get_logger("prompt")
+retrieval_logger = get_logger("retrieval")
+session_logger = get_logger("session")
 
 
 class ResponseProcessor:
-    """响应处理类，负责处理用户输入并生成回答"""
+    """响应处理类，负责处理用户输入并生成回答
 
-    def __init__(self):
+    模型、记忆库和后台任务由所有用户共享；画像、对话历史等用户状态保存在会话中，
+    由SessionManager按LRU常驻内存。未指定用户时使用session_id对应的默认会话。
+    """
+
+    def __init__(self, session_id=None):
+        setup_logging()
+        self.session_id = session_id or Config.DEFAULT_USER_ID
         self.model_interface = ModelInterface()
-        self.conversation_history = MessageHistory()
-        self.user_profile_manager = UserProfileManager()
+        if Config.BATCH_SCHEDULER_ENABLED:
+            # 多会话并发时合并生成和嵌入请求
+            self.model_interface = BatchScheduler(self.model_interface)
         self.memory_manager = MemoryManager(self.model_interface)
+        # 画像门控：输入不含新的个人信息时跳过画像分析
+        self.profile_gate = None
+        if Config.PROFILE_GATE_ENABLED:
+            self.profile_gate = ProfileFactGate(self.model_interface)
+        # 回答后处理：画像持久化和记忆写入在回答返回后按会话顺序后台执行
+        self.post_response_stage = None
+        if Config.POST_RESPONSE_STAGE_ENABLED:
+            self.post_response_stage = PostResponseStage(max_workers=Config.POST_RESPONSE_WORKERS)
+        # 滚动摘要：移出对话窗口的轮次在回答后合并进摘要
+        self.history_summarizer = None
+        if Config.HISTORY_SUMMARY_ENABLED:
+            self.history_summarizer = HistorySummarizer(self.model_interface)
+        # 记忆整理：按间隔在后台去重并合并超出上限的旧记忆
+        self.memory_consolidator = None
+        if Config.CONSOLIDATION_INTERVAL > 0:
+            self.memory_consolidator = MemoryConsolidator(self.memory_manager, self.model_interface)
+            self.memory_consolidator.start()
+        # 多用户会话，默认会话常驻不换出
+        self.session_manager = SessionManager(
+            self.model_interface, post_response_stage=self.post_response_stage
+        )
+        self.session = self.session_manager.acquire(self.session_id)
 
-    def analyze_user_info(self, user_input):
-        """提取用户个人信息"""
+    @property
+    def user_profile_manager(self):
+        """默认会话的画像管理器"""
+        return self.session.user_profile_manager
+
+    @property
+    def conversation_history(self):
+        """默认会话的对话历史"""
+        return self.session.conversation_history
+
+    @property
+    def profile_renderer(self):
+        """默认会话的画像渲染器"""
+        return self.session.profile_renderer
+
+    def build_profile_prompt(self, user_input):
+        """构建用户画像分析的提示"""
         # 使用提示模板
         user_content = Config.ROLE_PROMPT["USER_PROFILE_ANALYZER_USER"].format(
             user_input=user_input
         )
 
-        prompt = [
+        return [
             {"role": "system", "content": Config.ROLE_PROMPT["USER_PROFILE_ANALYZER_SYSTEM"]},
             {"role": "user", "content": user_content},
         ]
 
-        # 生成回复
-        response = self.model_interface.generate_response(prompt)
-        print(f"用户画像分析结果: {response}")
+    def build_clue_prompt(self, user_input, user_profile, session=None):
+        """构建线索提取的提示"""
+        session = session or self.session
+        # 按token预算渲染用户画像
+        user_profile_str = session.profile_renderer.render(user_profile, user_input)
 
-        return self.user_profile_manager.extract_dict_from_response(response)
+        # 使用提示模板
+        user_content = Config.ROLE_PROMPT["CLUE_EXTRACTOR_USER"].format(
+            user_profile=user_profile_str, user_input=user_input
+        )
 
-    def extract_clues(self, user_input, user_profile):
+        return [
+            {"role": "system", "content": Config.ROLE_PROMPT["CLUE_EXTRACTOR_SYSTEM"]},
+            {"role": "user", "content": user_content},
+        ]
+
+    def analyze_user_info(self, user_input):
+        """提取用户个人信息"""
+        prompt = self.build_profile_prompt(user_input)
+
+        # 生成回复，启用约束解码时输出保证是符合画像形状的合法JSON
+        json_shape = Config.PROFILE_JSON_SHAPE if Config.CONSTRAINED_DECODING_ENABLED else None
+        with tracer.span("profile_analysis"):
+            response = self.model_interface.generate_response(prompt, json_shape=json_shape)
+        profile_logger.debug("用户画像分析结果: %s", response)
+
+        return UserProfileManager.extract_dict_from_response(response)
+
+    def extract_clues(self, user_input, user_profile, session=None):
         """从用户输入和用户画像中提取关键线索"""
-        # 格式化用户画像
-        user_profile_str = json.dumps(user_profile, ensure_ascii=False)
+        with tracer.span("clue_extraction"):
+            prompt = self.build_clue_prompt(user_input, user_profile, session)
+
+            # 生成回复
+            response = self.model_interface.generate_response(prompt)
+        clue_logger.debug("提取的线索: %s", response)
+
+        return response
+
+    def analyze_user_info_and_clues(self, user_input, user_profile, session=None):
+        """一次生成同时提取用户画像增量和答案线索（合并模式）
+
+        Returns:
+            (new_user_info, clues)，new_user_info解析失败时为None，clues为每行一条的线索文本
+        """
+        session = session or self.session
+        user_profile_str = session.profile_renderer.render(user_profile, user_input)
 
         # 使用提示模板
-        user_content = Config.ROLE_PROMPT["CLUE_EXTRACTOR_USER"].format(
+        user_content = Config.ROLE_PROMPT["PROFILE_CLUE_EXTRACTOR_USER"].format(
             user_profile=user_profile_str, user_input=user_input
         )
 
         prompt = [
-            {"role": "system", "content": Config.ROLE_PROMPT["CLUE_EXTRACTOR_SYSTEM"]},
+            {"role": "system", "content": Config.ROLE_PROMPT["PROFILE_CLUE_EXTRACTOR_SYSTEM"]},
             {"role": "user", "content": user_content},
         ]
 
-        # 生成回复
-        response = self.model_interface.generate_response(prompt)
-        print(f"提取的线索: {response}")
+        # 生成回复，JSON对象闭合即停止
+        json_shape = Config.FUSED_JSON_SHAPE if Config.CONSTRAINED_DECODING_ENABLED else None
+        with tracer.span("profile_clue_extraction"):
+            response = self.model_interface.generate_response(
+                prompt,
+                max_new_tokens=Config.FUSED_MAX_NEW_TOKENS,
+                json_object=True,
+                json_shape=json_shape,
+            )
+        profile_logger.debug("画像与线索提取结果: %s", response)
 
-        return response
+        result = UserProfileManager.extract_dict_from_response(response)
+        if not isinstance(result, dict):
+            return None, user_input
 
-    def generate_response(self, user_input, user_profile, clues, context, relevant_memories):
-        """生成最终回答"""
+        clues = result.pop("线索", None)
+        if isinstance(clues, list):
+            clues = "\n".join(str(clue) for clue in clues)
+        if not isinstance(clues, str) or not clues.strip():
+            # 与线索提取提示一致：无法提取线索则使用原问题
+            clues = user_input
+        clue_logger.debug("提取的线索: %s", clues)
+
+        return result, clues
+
+    def analyze_user_info_with_speculative_clues(self, user_input, user_profile, session=None):
+        """画像分析和线索提取作为一个填充批次同时生成（并行模式）
+
+        线索提取使用已保存的画像推测执行，不等待本轮画像分析的结果。
+
+        Returns:
+            (new_user_info, clues)
+        """
+        json_shape = Config.PROFILE_JSON_SHAPE if Config.CONSTRAINED_DECODING_ENABLED else None
+        with tracer.span("profile_clue_batch"):
+            profile_response, clues = self.model_interface.generate_responses(
+                [
+                    self.build_profile_prompt(user_input),
+                    self.build_clue_prompt(user_input, user_profile, session),
+                ],
+                json_shape=[json_shape, None],
+            )
+        profile_logger.debug("用户画像分析结果: %s", profile_response)
+        clue_logger.debug("提取的线索: %s", clues)
+
+        return UserProfileManager.extract_dict_from_response(profile_response), clues
+
+    @staticmethod
+    def clues_reference_fields(clues, fields):
+        """判断线索是否涉及画像中新增的字段名或字段值"""
+        for key, value in fields:
+            if key in clues:
+                return True
+            if isinstance(value, (str, int, float)) and str(value) and str(value) in clues:
+                return True
+        return False
+
+    def build_response_prompt(
+        self, user_input, user_profile, clues, context, relevant_memories, session=None
+    ):
+        """构建最终回答的提示"""
+        session = session or self.session
         # 格式化各部分信息
-        user_profile_str = json.dumps(user_profile, ensure_ascii=False)
-        memories_str = self.memory_manager.format_memories_for_context(relevant_memories)
+        with tracer.span("prompt_assembly"):
+            user_profile_str = session.profile_renderer.render(user_profile, user_input)
+            memories_str = self.memory_manager.format_memories_for_context(relevant_memories)
 
         # 使用提示模板
         user_content = Config.ROLE_PROMPT["RESPONSE_GENERATOR_USER"].format(
@@ -71,50 +221,220 @@ class ResponseProcessor:
             context=context,
             user_input=user_input,
         )
-        print(f"user_content: {user_content}")
-        prompt = [
+        prompt_logger.debug("最终回答提示:\n%s", user_content)
+        return [
             {"role": "system", "content": Config.ROLE_PROMPT["RESPONSE_GENERATOR_SYSTEM"]},
             {"role": "user", "content": user_content},
         ]
 
+    def generate_response(
+        self, user_input, user_profile, clues, context, relevant_memories, session=None
+    ):
+        """生成最终回答"""
+        prompt = self.build_response_prompt(
+            user_input, user_profile, clues, context, relevant_memories, session
+        )
+
         # 生成回复
-        response = self.model_interface.generate_response(prompt)
+        with tracer.span("generation"):
+            response = self.model_interface.generate_response(prompt)
         return response
 
-    def process_user_input(self, user_input):
-        """整合完整流程处理用户输入
+    def prepare_response_context(self, user_input, session=None):
+        """执行回答生成之前的阶段：画像分析、线索提取和记忆检索
 
-        Args:
-            user_input: 用户输入的消息
+        Returns:
+            (user_data, clues, context, relevant_memories)
         """
+        session = session or self.session
+        # 等待本会话上一轮的后台写入完成，保证读到最新的画像和记忆
+        if self.post_response_stage is not None:
+            with tracer.span("post_response_barrier"):
+                waited = self.post_response_stage.barrier(session.user_id)
+            if waited > 0.01:
+                session_logger.debug("等待上一轮后台写入完成，耗时 %.2f 秒", waited)
+
         # 获取当前对话上下文（不包含本轮用户提问）
-        context = self.conversation_history.to_string()
-        
+        context = session.conversation_history.to_string()
+
         # 添加用户消息到对话历史
-        self.conversation_history.add_user_message(user_input)
+        session.conversation_history.add_user_message(user_input)
+
+        user_data = session.user_profile_manager.load_data()
+        analyze = True
+        # 本轮输入的嵌入向量只算一次：规则无法判断时由门控计算，记忆检索时复用
+        input_embedding = None
+        if self.profile_gate is not None:
+            with tracer.span("profile_gate") as span:
+                analyze, input_embedding = self.profile_gate.decide(user_input)
+                span.set(analyze=analyze, embedded=input_embedding is not None)
+        if not analyze:
+            # 输入不含新的个人信息，只提取答案线索
+            clues = self.extract_clues(user_input, user_data, session)
+        elif Config.PIPELINE_MODE == "concurrent":
+            # 步骤1+2: 画像分析和基于已保存画像的线索提取同批生成
+            new_user_info, clues = self.analyze_user_info_with_speculative_clues(
+                user_input, user_data, session
+            )
+            if new_user_info:
+                changed_fields = UserProfileManager.new_fields(user_data, new_user_info)
+                user_data = self.merge_user_info(user_data, new_user_info, session)
+                # 画像变化涉及线索引用的字段时，推测的线索可能过时，重新提取
+                if self.clues_reference_fields(clues, changed_fields):
+                    clue_logger.debug("画像更新涉及线索字段，重新提取线索")
+                    clues = self.extract_clues(user_input, user_data, session)
+        elif Config.PIPELINE_MODE == "fused":
+            # 步骤1+2: 一次生成同时提取用户属性信息和答案线索
+            new_user_info, clues = self.analyze_user_info_and_clues(user_input, user_data, session)
+            if new_user_info:
+                user_data = self.merge_user_info(user_data, new_user_info, session)
+        else:
+            # 步骤1: 提取用户属性信息（结构化属性）
+            new_user_info = self.analyze_user_info(user_input)
+            if new_user_info:
+                user_data = self.merge_user_info(user_data, new_user_info, session)
+
+            # 步骤2: 提取答案线索（仅结合用户画像和输入）
+            clues = self.extract_clues(user_input, user_data, session)
 
-        # 步骤1: 提取用户属性信息（结构化属性）
-        user_data = self.user_profile_manager.load_data()
-        new_user_info = self.analyze_user_info(user_input)
-        if new_user_info:
-            user_data = self.user_profile_manager.update_data(user_data, new_user_info)
-            self.user_profile_manager.save_data(user_data)
+        # 步骤3: 使用线索和本轮输入检索相关记忆（只检索该用户的记忆）
+        with tracer.span("memory_retrieval"):
+            relevant_memories = self.memory_manager.retrieve_relevant_memories_by_clues(
+                clues, user_id=session.user_id, query=user_input, query_embedding=input_embedding
+            )
+        retrieval_logger.debug("检索到的相关记忆: %s", relevant_memories)
 
-        # 步骤2: 提取答案线索（仅结合用户画像和输入）
-        clues = self.extract_clues(user_input, user_data)
+        return user_data, clues, context, relevant_memories
 
-        # 步骤3: 使用线索检索相关记忆（从记忆集合中）
-        relevant_memories = self.memory_manager.retrieve_relevant_memories_by_clues(clues)
-        print(f"relevant_memories: {relevant_memories}")
+    def merge_user_info(self, user_data, new_user_info, session=None):
+        """合并本轮提取的用户信息，持久化推迟到回答之后"""
+        session = session or self.session
+        user_data = UserProfileManager.update_data(user_data, new_user_info)
+        session.pending_profile = user_data
+        return user_data
 
-        # 步骤4: 生成回答（整合所有信息）
-        response = self.generate_response(user_input, user_data, clues, context, relevant_memories)
+    def finish_turn(self, user_input, response, session=None):
+        """更新对话历史，画像持久化和记忆写入交给回答后处理阶段"""
+        session = session or self.session
+        session.conversation_history.add_ai_message(response)
+        user_data, session.pending_profile = session.pending_profile, None
+        # 本轮移出对话窗口的历史行，交给后台合并进滚动摘要
+        evicted = session.conversation_history.take_evicted()
+        if self.post_response_stage is not None:
+            self.post_response_stage.submit(
+                session.user_id, self.persist_turn, user_input, response, user_data, session, evicted
+            )
+        else:
+            self.persist_turn(user_input, response, user_data, session, evicted)
 
-        # 步骤5: 更新对话历史和记忆系统（长期）
-        self.conversation_history.add_ai_message(response)
-        self.memory_manager.add_memory(user_input, response)
+    def persist_turn(self, user_input, response, user_data, session=None, evicted=None):
+        """保存合并后的画像、写入本轮记忆（长期），并更新对话滚动摘要"""
+        session = session or self.session
+        if user_data is not None:
+            with tracer.span("profile_save"):
+                session.user_profile_manager.save_data(user_data)
+        with tracer.span("memory_write"):
+            self.memory_manager.add_memory(user_input, response, user_id=session.user_id)
+        if evicted and self.history_summarizer is not None:
+            history = session.conversation_history
+            with tracer.span("history_summary", turns=len(evicted)):
+                history.set_summary(self.history_summarizer.fold(history.summary, evicted))
+
+    def process_user_input(self, user_input, user_id=None):
+        """整合完整流程处理用户输入
+
+        Args:
+            user_input: 用户输入的消息
+            user_id: 用户ID，未指定时使用默认会话
+        """
+        with self.session_manager.session(user_id or self.session_id) as session:
+            # 同一用户的请求逐轮处理，保证对话历史和画像的顺序
+            with session.lock:
+                start_time = time.perf_counter()
+                with tracer.span("turn", session=session.user_id) as turn:
+                    user_data, clues, context, relevant_memories = self.prepare_response_context(
+                        user_input, session
+                    )
+
+                    # 步骤4: 生成回答（整合所有信息）
+                    response = self.generate_response(
+                        user_input, user_data, clues, context, relevant_memories, session
+                    )
+
+                    # 步骤5: 更新对话历史和记忆系统（长期）
+                    self.finish_turn(user_input, response, session)
+                self.log_turn(session, turn, start_time, clues, relevant_memories, response)
         return response
 
+    def process_user_input_stream(self, user_input, user_id=None):
+        """整合完整流程处理用户输入，流式返回最终回答
+
+        画像分析和线索提取仍使用阻塞生成，只有最终回答阶段逐段输出。
+        回答完整输出后才更新对话历史和记忆。
+
+        Args:
+            user_input: 用户输入的消息
+            user_id: 用户ID，未指定时使用默认会话
+        """
+        with self.session_manager.session(user_id or self.session_id) as session:
+            with session.lock:
+                start_time = time.perf_counter()
+                with tracer.span("turn", session=session.user_id) as turn:
+                    user_data, clues, context, relevant_memories = self.prepare_response_context(
+                        user_input, session
+                    )
+                    prompt = self.build_response_prompt(
+                        user_input, user_data, clues, context, relevant_memories, session
+                    )
+
+                    chunks = []
+                    with tracer.span("generation"):
+                        for chunk in self.model_interface.generate_response_stream(prompt):
+                            chunks.append(chunk)
+                            yield chunk
+
+                    response = self.model_interface.strip_role_prefix("".join(chunks).strip())
+                    self.finish_turn(user_input, response, session)
+                self.log_turn(session, turn, start_time, clues, relevant_memories, response)
+
+    def log_turn(self, session, turn, start_time, clues, relevant_memories, response):
+        """每轮输出一条INFO级汇总记录，包含总耗时、各阶段耗时和检索结果数量"""
+        if not turn_logger.isEnabledFor(logging.INFO):
+            return
+        fields = {
+            "session": session.user_id,
+            "duration": round(time.perf_counter() - start_time, 3),
+            "clues": sum(1 for clue in clues.split("\n") if clue.strip()),
+            "memories": len(relevant_memories),
+            "response_chars": len(response),
+        }
+        # 启用调度层时附带生成队列的深度和批次填充率
+        if Config.BATCH_SCHEDULER_ENABLED:
+            generate_stats = self.model_interface.stats()["generate"]
+            fields["queue_depth"] = generate_stats["queue_depth"]
+            fields["batch_fill"] = round(generate_stats["fill_ratio"], 3)
+        # 追踪开启时附带各阶段耗时，同名阶段（如重新提取线索）累加
+        if isinstance(turn, Span):
+            stages = {}
+            for child in turn.children:
+                stages[child.name] = stages.get(child.name, 0.0) + child.duration
+            fields["stages"] = {name: round(duration, 3) for name, duration in stages.items()}
+        summary = " ".join(f"{key}={value}" for key, value in fields.items() if key != "stages")
+        for name, duration in fields.get("stages", {}).items():
+            summary += f" {name}={duration}s"
+        turn_logger.info("本轮完成 %s", summary, extra={"fields": fields})
+
+    def close(self):
+        """释放资源，等待后台写入完成后写回所有会话"""
+        if self.memory_consolidator is not None:
+            self.memory_consolidator.stop()
+        if self.post_response_stage is not None:
+            self.post_response_stage.close()
+        self.session_manager.release(self.session)
+        self.session_manager.close()
+        self.memory_manager.close()
+        self.model_interface.close()
+
 
 def main():
     """主程序入口"""
@@ -125,15 +445,19 @@ def main():
     while True:
         user_input = input("用户: ")
         if user_input.lower() in ["退出", "exit", "quit"]:
+            processor.close()
             print("系统已退出，谢谢使用！")
             break
 
         start_time = time.time()
-        # 使用默认配置生成响应
-        response = processor.process_user_input(user_input)
+        # 流式输出最终回答
+        print("AI: ", end="", flush=True)
+        for chunk in processor.process_user_input_stream(user_input):
+            print(chunk, end="", flush=True)
+        print()
         end_time = time.time()
 
-        print(f"AI: {response}")
+        # 各阶段耗时见turn日志的汇总记录
         print(f"总处理时间: {end_time - start_time:.2f} 秒")
 
 
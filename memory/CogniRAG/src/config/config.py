@@ -13,13 +13,16 @@ class Config:
     DATA_DIR = os.path.join(ROOT_DIR, "data")
     USER_DATA_DIR = os.path.join(DATA_DIR, "user")
     MEMORY_DB_DIR = os.path.join(DATA_DIR, "memory")
+    CACHE_DIR = os.path.join(DATA_DIR, "cache")
 
     # 确保目录存在
     os.makedirs(USER_DATA_DIR, exist_ok=True)
     os.makedirs(MEMORY_DB_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
 
     # 文件路径
     USER_DATA_FILE = os.path.join(USER_DATA_DIR, "user_profile.json")
+    EMBEDDING_CACHE_FILE = os.path.join(CACHE_DIR, "embeddings.sqlite3")
 
     # 角色提示模板
     ROLE_PROMPT = {
@@ -52,6 +55,24 @@ class Config:
 
         请提取能够帮助回答用户问题的关键线索：
         """,
+        "PROFILE_CLUE_EXTRACTOR_SYSTEM": """
+        你是一个用户信息分析专家。你的任务是一次完成用户画像提取和线索提取。
+        1. 基本信息：请认真区分用户本人和其他人物关系，从用户输入中提取所有能够确定的用户个人信息。
+        2. 事件：提取用户提及的事件，根据事件内容自行判断相关属性并提取包括事件的经过描述等。
+        3. 线索：结合用户画像和用户输入，拆分生成1-3条能帮助回答用户当前问题的线索，每条线索不超过10个字；无法提取线索则返回原问题。
+
+        分析结果必须以一个JSON对象返回，不要有任何额外文字说明。
+        返回格式严格按照：{"基本信息": {}, "事件": {}, "线索": []}
+        """,
+        "PROFILE_CLUE_EXTRACTOR_USER": """
+        ## 用户画像:
+        {user_profile}
+
+        ## 用户输入:
+        {user_input}
+
+        请提取用户信息和能够帮助回答用户问题的关键线索：
+        """,
         "RESPONSE_GENERATOR_SYSTEM": """
         你是一个智能助手。你的任务是根据对话上下文、相关记忆、核心线索，为用户提供友好、专业、符合用户需求的回答。
         回答应该：
@@ -74,6 +95,21 @@ class Config:
 
         请根据以上信息，为用户提供个性化、准确、有深度的回答。注意保持语气友好，回答要有针对性且符合用户的背景知识水平。
         """,
+        "HISTORY_SUMMARIZER_SYSTEM": """
+        你是一个对话摘要专家。你的任务是把较早的对话合并进已有摘要，生成一段新的摘要。
+        1. 保留用户提到的事实、需求、决定和尚未解决的问题，以及助手给出的关键结论。
+        2. 删除寒暄和重复内容，新信息与旧摘要冲突时以新信息为准。
+        3. 只输出摘要纯文本，不要添加任何解释文字。
+        """,
+        "HISTORY_SUMMARIZER_USER": """
+        ## 已有摘要:
+        {summary}
+
+        ## 需要合并的对话:
+        {turns}
+
+        请输出合并后的摘要，不超过{token_budget}个token：
+        """,
     }
 
     # 模型配置
@@ -82,24 +118,125 @@ class Config:
 
     # 对话配置
     MAX_HISTORY_ROUNDS = 3  # 上下文对话轮数，仅保存最近3轮对话
+    MAX_HISTORY_TOKENS = 512  # 对话历史的token预算，超出时从最旧的一轮开始整轮丢弃
+    HISTORY_SUMMARY_ENABLED = False  # 是否把移出窗口的轮次合并进滚动摘要（回答后在后台生成）
+    HISTORY_SUMMARY_TOKEN_BUDGET = 128  # 滚动摘要的token上限
     SYSTEM_MESSAGE = "你是ai助手，请根据用户输入，给出最合适的回答。"
 
     # 生成参数
     MAX_NEW_TOKENS = 96
     TEMPERATURE = 0.5
     TOP_P = 0.9
+    PREFIX_CACHE_ENABLED = True  # 是否缓存固定系统提示的KV，避免每次重复prefill
+
+    # 处理流程配置
+    # "separate": 画像分析和线索提取依次生成；"fused": 合并为一次JSON生成；
+    # "concurrent": 两者同批生成，线索基于已保存的画像推测，画像变化涉及线索时重新提取
+    PIPELINE_MODE = "separate"
+    FUSED_MAX_NEW_TOKENS = 160  # 合并模式的最大生成长度，JSON对象闭合即提前停止
+    PROFILE_GATE_ENABLED = True  # 是否在画像分析前判断输入是否含新的个人信息，不含时跳过
+    PROFILE_GATE_MARGIN = 0.0  # 规则无法判断时，与事实原型和提问原型相似度之差超过此值才分析
+    POST_RESPONSE_STAGE_ENABLED = True  # 是否在回答返回后再后台持久化画像和写入记忆
+    POST_RESPONSE_WORKERS = 2  # 回答后处理线程数，同一会话的任务始终按顺序执行
+    PROFILE_COMPACT_INTERVAL = 50  # 画像追加日志累计多少条记录后合并写入快照文件
+    PROFILE_TOKEN_BUDGET = 256  # 写入提示的用户画像最大token数，None表示完整输出
+    PROFILE_RECENCY_WEIGHT = 0.2  # 画像条目排序时新近度的权重（与嵌入相似度相加）
+    CONSTRAINED_DECODING_ENABLED = True  # 画像分析是否使用JSON约束解码，保证输出可解析
+    CONSTRAINED_DECODING_TOP_N = 8  # 约束解码每步优先校验的高分候选token数量
+    # 约束解码的JSON形状：顶层键及其值类型（"{" 对象，"[" 数组）
+    PROFILE_JSON_SHAPE = (("基本信息", "{"), ("事件", "{"))
+    FUSED_JSON_SHAPE = (("基本信息", "{"), ("事件", "{"), ("线索", "["))
+
+    # 多用户会话配置
+    DEFAULT_USER_ID = "default"  # 未指定用户时使用的用户ID，其画像沿用USER_DATA_FILE
+    SESSION_DATA_DIR = None  # 其他用户的画像和对话历史目录，None表示USER_DATA_FILE同目录下的sessions
+    MAX_ACTIVE_SESSIONS = 256  # 内存中常驻的会话数上限，超出时按LRU写回磁盘并释放
+
+    # 服务配置
+    SERVER_HOST = "127.0.0.1"  # HTTP服务监听地址
+    SERVER_PORT = 8000  # HTTP服务监听端口
+    SERVER_WORKERS = 2  # 执行阻塞模型调用的线程数
+    SERVER_MAX_QUEUE = 16  # 等待空闲线程的请求数上限，超出时直接返回503
+    SERVER_DRAIN_TIMEOUT = 30.0  # 停止服务时等待进行中请求完成的最长时间（秒）
+
+    # 追踪配置
+    TRACING_ENABLED = True  # 是否记录处理流程各阶段的耗时
+    TRACING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # 耗时直方图桶上界（秒）
+    TRACING_RECENT_TURNS = 32  # 保留最近多少轮的完整追踪树
+
+    # 日志配置
+    LOG_LEVEL = "INFO"  # 默认日志级别，INFO时每轮只输出一条汇总记录
+    LOG_FORMAT = "text"  # "text": 可读文本；"json": 每条记录一行JSON，便于日志系统采集
+    # 单独开启DEBUG的阶段，如["retrieval", "prompt"]；可选值见README日志配置
+    LOG_DEBUG_STAGES = []
 
     # 记忆配置
     MEMORY_RETRIEVAL_TOP_K = 5  # 记忆检索时返回的最相关记忆数量
     SIMILARITY_THRESHOLD = 0.6  # 余弦相似度阈值，仅保留相似度高于此值的记忆
+    FLAT_INDEX_ENABLED = True  # 是否在进程内维护记忆向量的扁平索引
+    FLAT_INDEX_MAX_SIZE = 100000  # 记忆数量超过此值时回退到ChromaDB检索
+    MEMORY_INGESTION_ENABLED = True  # 是否在后台线程中写入记忆
+    MEMORY_INGESTION_QUEUE_SIZE = 256  # 待写入记忆队列容量，队列满时add_memory阻塞
+    MEMORY_INGESTION_BATCH_SIZE = 32  # 后台线程单次合并写入的最大记忆数量
+    RETRIEVAL_CACHE_MAX_ENTRIES = 256  # 检索缓存最大条目数
+    RETRIEVAL_CACHE_MAX_BYTES = 8 * 1024 * 1024  # 检索缓存最大字节数
+    RETRIEVAL_CACHE_TOLERANCE = 0.02  # 线索向量余弦距离在此容差内视为同一线索
+    # 记忆检索方式 "vector": 只用向量检索；"keyword": 只用BM25关键词检索；
+    # "hybrid": 两者结果按倒数排名融合（RRF），关键词命中的记忆不受相似度阈值限制
+    RETRIEVAL_MODE = "hybrid"
+    RETRIEVAL_INCLUDE_INPUT = True  # 是否把本轮输入也作为一条检索查询，复用画像门控算出的嵌入向量
+    BM25_K1 = 1.5  # BM25词频饱和参数
+    BM25_B = 0.75  # BM25文档长度归一化参数
+    RRF_K = 60  # 倒数排名融合的平滑常数，得分为 1 / (RRF_K + 排名)
+
+    # 记忆整理配置
+    CONSOLIDATION_INTERVAL = 0  # 后台整理记忆的间隔（秒），0表示不在后台运行，只通过consolidate.py离线整理
+    CONSOLIDATION_DUPLICATE_THRESHOLD = 0.95  # 余弦相似度高于此值的记忆视为重复，只保留最新一条
+    CONSOLIDATION_MAX_MEMORIES = 2000  # 每个用户的记忆数上限，超出时整理最旧的记忆
+    CONSOLIDATION_CLUSTER_THRESHOLD = 0.8  # 旧记忆与簇首的相似度高于此值时归入同一簇
+    CONSOLIDATION_GROUP_SIZE = 8  # 每条摘要记忆最多合并的旧记忆数
+    CONSOLIDATION_SUMMARIZE = True  # 超出上限时用语言模型把旧记忆簇合并为摘要记忆；False时直接删除最旧的记忆
+    CONSOLIDATION_SUMMARY_TOKEN_BUDGET = 128  # 每条摘要记忆的token上限
+
+    # 记忆打分与淘汰配置
+    MEMORY_SCORING_ENABLED = True  # 是否按 相似度 * 时间衰减 * 重要度 对候选记忆排序
+    MEMORY_RECENCY_HALF_LIFE_DAYS = 30  # 时间衰减的半衰期（天），从最近一次被检索命中算起
+    MEMORY_RECENCY_FLOOR = 0.2  # 时间衰减的下限，很久未访问的记忆仍保留这部分权重
+    MEMORY_IMPORTANCE_WEIGHT = 0.5  # 重要度对得分的影响，重要度系数为 1 - 权重 + 权重 * 重要度
+    MEMORY_IMPORTANCE_FACT = 1.0  # 含个人事实的陈述的重要度
+    MEMORY_IMPORTANCE_DEFAULT = 0.5  # 其余输入（包括规则拿不准的）及旧记忆的重要度
+    MEMORY_IMPORTANCE_QUESTION = 0.2  # 每个子句都以问号结尾的纯提问的重要度
+    MEMORY_ACCESS_WEIGHT = 0.5  # 淘汰时访问次数的权重，保留分数乘以 1 + 权重 * ln(1 + 访问次数)
+    MEMORY_ACCESS_FLUSH_SIZE = 64  # 待写回的访问统计达到此数量时批量写回ChromaDB
+    MEMORY_MAINTENANCE_INTERVAL = 300  # 后台写回访问统计并淘汰记忆的间隔（秒），0表示不在后台运行
+    # 淘汰会永久删除记忆，默认关闭
+    MEMORY_TTL_DAYS = 0  # 超过此天数未被访问且保留分数低于阈值的记忆被淘汰，0表示不按时间淘汰（如90）
+    MEMORY_EVICTION_THRESHOLD = 0.2  # 淘汰的保留分数阈值，按默认打分参数含个人事实的记忆不会因过期被淘汰
+    MEMORY_MAX_PER_USER = 0  # 每个用户的记忆数上限，超出时按保留分数从低到高淘汰该用户的记忆，0表示不限制
 
     # 性能优化配置
     EMBEDDING_BATCH_SIZE = 4  # 嵌入向量批处理大小
-    EMBEDDING_CACHE_SIZE = 64  # 嵌入向量缓存大小
+    EMBEDDING_CACHE_SIZE = 1024  # 嵌入向量内存缓存大小
+    EMBEDDING_CACHE_DISK_ENABLED = True  # 是否启用嵌入向量磁盘缓存（跨重启复用）
+    EMBEDDING_CACHE_DISK_MAX_ENTRIES = 200000  # 磁盘缓存的条目数上限，超出时删除最久未使用的条目，0表示不限制
     MAX_CLUES_TO_PROCESS = 3  # 最多处理的线索数量
     MEMORY_UPDATE_FREQUENCY = 3  # 每处理多少次用户输入更新一次工作记忆
     COLLECTION_DISTANCE_TYPE = "cosine"  # 向量距离计算方式
 
-    # 显存管理配置
-    MEMORY_CLEAR_FREQUENCY = 8  # 每处理多少次用户输入清理一次显存
-    MEMORY_CLEAR_ENABLED = True  # 是否启用显存清理
+    # 批处理调度配置
+    # 是否启用请求调度层，多会话并发时合并请求；多个请求合成的填充批次不使用前缀KV缓存，
+    # 批次中只有一个请求时仍走单条生成并复用前缀缓存
+    BATCH_SCHEDULER_ENABLED = False
+    BATCH_MAX_SIZE = 8  # 单个批次的最大请求数
+    BATCH_WINDOW_MS = 10  # 收集同批请求的时间窗口（毫秒）
+    BATCH_LENGTH_RATIO = 1.5  # 同批生成请求的输入长度最大比值
+
+    # 资源调控配置
+    RESOURCE_GOVERNOR_ENABLED = True  # 是否按实际内存占用释放缓存
+    RESOURCE_CHECK_INTERVAL = 5.0  # 后台检查内存占用的间隔（秒）
+    # 水位线 = 模型加载和预热完成后测得的基线 + 余量，常驻的模型权重不计入
+    MEMORY_HIGH_HEADROOM_MB = 2048  # 进程RSS超出基线多少MB时开始释放
+    MEMORY_LOW_HEADROOM_MB = 1024  # 进程RSS降到基线加多少MB以下后停止释放
+    DEVICE_MEMORY_HIGH_HEADROOM_MB = 2048  # 显存超出基线多少MB时开始释放（有加速器时生效）
+    DEVICE_MEMORY_LOW_HEADROOM_MB = 1024  # 显存降到基线加多少MB以下后停止释放
+    RESOURCE_MAX_COOLDOWN = 3600.0  # 释放无效时暂停时间按倍数增长的上限（秒）
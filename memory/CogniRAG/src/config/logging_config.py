@@ -0,0 +1,74 @@
+"""日志配置模块，按处理阶段划分日志记录器，支持文本和JSON两种输出格式"""
+
+import json
+import logging
+from config.config import Config
+
+# 各阶段的日志记录器名称，LOG_DEBUG_STAGES中列出的阶段单独开启DEBUG
+STAGES = (
+    "turn",  # 每轮汇总
+    "profile",  # 画像分析与持久化
+    "clues",  # 线索提取
+    "retrieval",  # 记忆检索
+    "prompt",  # 提示组装
+    "generation",  # 模型生成
+    "memory",  # 记忆库初始化与写入
+    "session",  # 会话与后台任务
+    "resource",  # 资源调控
+    "server",  # HTTP服务
+)
+
+ROOT_LOGGER = "cognirag"
+
+_configured = False
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出为一行JSON，extra中的fields字典合并到顶层"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def get_logger(stage):
+    """获取阶段日志记录器"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{stage}")
+
+
+def setup_logging(level=None, log_format=None, debug_stages=None, force=False):
+    """按配置设置日志级别、格式和阶段DEBUG开关，重复调用时只生效一次（force除外）"""
+    global _configured
+    if _configured and not force:
+        return
+    _configured = True
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level or Config.LOG_LEVEL)
+    handler = logging.StreamHandler()
+    if (log_format or Config.LOG_FORMAT) == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    # 不向根记录器传播，避免第三方库配置的处理器重复输出
+    root.propagate = False
+
+    for stage in STAGES:
+        get_logger(stage).setLevel(logging.NOTSET)
+    for stage in Config.LOG_DEBUG_STAGES if debug_stages is None else debug_stages:
+        get_logger(stage).setLevel(logging.DEBUG)
@@ -0,0 +1,61 @@
+"""离线记忆整理入口，去重并合并超出上限的旧记忆，输出整理前后的记忆数、占用空间和查询耗时"""
+
+import argparse
+from models.model_interface import ModelInterface
+from managers.memory import MemoryManager
+from managers.memory_consolidation import MemoryConsolidator
+from config.config import Config
+from config.logging_config import setup_logging
+
+
+def print_report(report):
+    """打印整理报告"""
+    title = "记忆整理计划（未修改记忆库）" if report["dry_run"] else "记忆整理报告"
+    print(title)
+    print(f"{'用户':<20} {'整理前':>8} {'整理后':>8} {'去重':>6} {'合并':>6} {'删除':>6}")
+    for plan in report["plans"]:
+        print(
+            f"{plan['user_id']:<20} {plan['before']:>8} {plan['after']:>8} "
+            f"{plan['duplicates']:>6} {plan['summarized']:>6} {plan['evicted']:>6}"
+        )
+    print(f"记忆总数: {report['collection_before']} -> {report['collection_after']}")
+    print(f"生成摘要记忆: {report['summaries']} 条")
+    print(
+        f"记忆库占用: {report['disk_bytes_before'] / 1024:.1f} KB -> "
+        f"{report['disk_bytes_after'] / 1024:.1f} KB"
+    )
+    if "latency_before" in report:
+        before, after = report["latency_before"], report["latency_after"]
+        print(f"ChromaDB查询耗时: {before['chroma_ms']:.2f} ms -> {after['chroma_ms']:.2f} ms")
+        print(f"当前检索路径耗时: {before['search_ms']:.2f} ms -> {after['search_ms']:.2f} ms")
+    print(f"整理耗时: {report['elapsed']:.2f} 秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="整理记忆库：合并近似重复的记忆，把超出上限的旧记忆合并为摘要")
+    parser.add_argument("--user", dest="users", action="append", help="只整理指定用户的记忆，可重复指定")
+    parser.add_argument(
+        "--max-memories", type=int, default=Config.CONSOLIDATION_MAX_MEMORIES, help="每个用户的记忆数上限"
+    )
+    parser.add_argument("--no-summarize", action="store_true", help="超出上限时直接删除最旧的记忆，不生成摘要")
+    parser.add_argument("--dry-run", action="store_true", help="只输出整理计划，不修改记忆库")
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.no_summarize:
+        Config.CONSOLIDATION_SUMMARIZE = False
+    model_interface = ModelInterface()
+    memory_manager = MemoryManager(model_interface)
+    consolidator = MemoryConsolidator(
+        memory_manager, model_interface, max_memories=args.max_memories
+    )
+    try:
+        report = consolidator.run(user_ids=args.users, dry_run=args.dry_run)
+        print_report(report)
+    finally:
+        memory_manager.close()
+        model_interface.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""扁平向量索引模块，在进程内镜像ChromaDB记忆集合以加速检索"""
+
+import numpy as np
+
+
+class _UserBlock:
+    """一个用户的记忆向量，连续存放在同一个矩阵中，rows为各行对应的全局行号"""
+
+    def __init__(self, dimension, capacity=64):
+        self.embeddings = np.empty((capacity, dimension), dtype=np.float32)
+        self.rows = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def append(self, vectors, rows):
+        """追加向量，容量不足时按倍数扩容"""
+        size = self.size
+        required = size + len(rows)
+        if required > len(self.rows):
+            capacity = max(required, 2 * len(self.rows))
+            embeddings = np.empty((capacity, self.embeddings.shape[1]), dtype=np.float32)
+            embeddings[:size] = self.embeddings[:size]
+            block_rows = np.empty(capacity, dtype=np.int64)
+            block_rows[:size] = self.rows[:size]
+            self.embeddings, self.rows = embeddings, block_rows
+        self.embeddings[size:required] = vectors
+        self.rows[size:required] = rows
+        # 数据写完后再更新行数，并发查询只会看到完整的记忆
+        self.size = required
+
+    def view(self):
+        """返回 (向量矩阵, 全局行号) 的视图，不复制数据"""
+        size = self.size
+        return self.embeddings[:size], self.rows[:size]
+
+
+class FlatMemoryIndex:
+    """内存扁平索引，按用户使用连续的float32矩阵保存记忆向量
+
+    ChromaDB仍是持久化存储，本索引只在进程内做暴力检索：
+    每次查询为一次矩阵乘法，结果格式与collection.query一致。
+    每个用户的记忆向量连续存放在各自的矩阵中，指定用户的查询直接在该矩阵的视图上计算，
+    不需要按行号复制该用户的全部向量。
+    """
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+        self.ids = []
+        self.documents = []
+        self.blocks = {}  # user_id -> 该用户的记忆向量块
+
+    @classmethod
+    def from_collection(cls, collection, dimension, page_size=5000):
+        """从ChromaDB集合分页加载全部记忆，构建索引"""
+        total = collection.count()
+        index = cls(dimension)
+        for offset in range(0, total, page_size):
+            page = collection.get(
+                include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset
+            )
+            user_ids = [(metadata or {}).get("user_id") for metadata in page["metadatas"]]
+            index.add(page["ids"], page["embeddings"], page["documents"], user_ids)
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, embeddings, documents, user_ids=None):
+        """追加记忆，按用户写入各自的向量块"""
+        if not len(ids):
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), self.dimension)
+        # 统一规范化，保证点积即余弦相似度
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+
+        # 先追加ID和文档，向量块中的行号指向它们
+        size = len(self.ids)
+        self.documents.extend(documents)
+        self.ids.extend(ids)
+
+        groups = {}
+        for offset, user_id in enumerate(user_ids or [None] * len(ids)):
+            groups.setdefault(user_id, []).append(offset)
+        for user_id, offsets in groups.items():
+            block = self.blocks.get(user_id)
+            if block is None:
+                block = self.blocks[user_id] = _UserBlock(self.dimension)
+            offsets = np.asarray(offsets, dtype=np.int64)
+            block.append(vectors[offsets], offsets + size)
+
+    def query(self, query_embeddings, n_results, user_id=None):
+        """检索最相似的记忆，返回与collection.query相同结构的结果（余弦距离）
+
+        Args:
+            user_id: 只检索该用户的记忆，None表示检索全部记忆
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dimension)
+        if user_id is None:
+            views = [block.view() for block in list(self.blocks.values())]
+        else:
+            block = self.blocks.get(user_id)
+            views = [] if block is None else [block.view()]
+        views = [(matrix, rows) for matrix, rows in views if len(rows)]
+        if not views:
+            empty = [[] for _ in range(len(queries))]
+            return {"ids": empty, "documents": empty, "distances": empty}
+
+        # 记忆矩阵按行连续存储，E @ Q^T 比 Q @ E^T 访存更友好；
+        # 检索全部记忆时逐块计算后只拼接相似度，不拼接向量
+        if len(views) == 1:
+            matrix, rows = views[0]
+            similarities = (matrix @ queries.T).T
+        else:
+            similarities = np.concatenate([matrix @ queries.T for matrix, _ in views]).T
+            rows = np.concatenate([rows for _, rows in views])
+        size = len(rows)
+        n_results = min(n_results, size)
+
+        # 每行先用argpartition取候选，再对候选排序
+        if n_results < size:
+            candidates = np.argpartition(-similarities, n_results - 1, axis=1)[:, :n_results]
+        else:
+            candidates = np.tile(np.arange(size), (len(queries), 1))
+        candidate_scores = np.take_along_axis(similarities, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind="stable")
+        top = rows[np.take_along_axis(candidates, order, axis=1)]
+        distances = 1.0 - np.take_along_axis(candidate_scores, order, axis=1)
+
+        return {
+            "ids": [[self.ids[i] for i in row] for row in top],
+            "documents": [[self.documents[i] for i in row] for row in top],
+            "distances": distances.tolist(),
+        }
@@ -0,0 +1,66 @@
+"""对话摘要模块，把移出对话窗口的轮次合并进一段长度有上限的滚动摘要"""
+
+from config.config import Config
+from config.logging_config import get_logger
+
+logger = get_logger("session")
+
+
+class HistorySummarizer:
+    """滚动摘要生成器
+
+    每轮回答后由回答后处理阶段调用：把已有摘要和本轮被移出窗口的对话一起交给语言模型，
+    生成新的摘要。摘要不超过token上限，注入回答提示后提示长度仍然有界，
+    较早的内容不必每轮都依赖向量检索找回。
+    """
+
+    def __init__(self, model_interface, token_budget=None):
+        self.model_interface = model_interface
+        self.tokenizer = model_interface.tokenizer
+        self.token_budget = (
+            Config.HISTORY_SUMMARY_TOKEN_BUDGET if token_budget is None else token_budget
+        )
+
+        self.folds = 0
+        self.failures = 0
+
+    def truncate(self, text):
+        """按token上限截断摘要"""
+        input_ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+        if len(input_ids) <= self.token_budget:
+            return text
+        return self.tokenizer.decode(input_ids[: self.token_budget], skip_special_tokens=True)
+
+    def fold(self, summary, lines):
+        """把移出窗口的对话行合并进摘要，返回新摘要；生成失败时保留原摘要"""
+        if not lines:
+            return summary
+        user_content = Config.ROLE_PROMPT["HISTORY_SUMMARIZER_USER"].format(
+            summary=summary or "（无）",
+            turns="\n".join(lines),
+            token_budget=self.token_budget,
+        )
+        prompt = [
+            {"role": "system", "content": Config.ROLE_PROMPT["HISTORY_SUMMARIZER_SYSTEM"]},
+            {"role": "user", "content": user_content},
+        ]
+        try:
+            response = self.model_interface.generate_response(
+                prompt, max_new_tokens=self.token_budget
+            )
+        except Exception as e:
+            self.failures += 1
+            logger.error("生成对话摘要失败: %s", e)
+            return summary
+        if not response:
+            self.failures += 1
+            return summary
+
+        self.folds += 1
+        new_summary = self.truncate(response)
+        logger.debug("对话摘要已更新: %s", new_summary)
+        return new_summary
+
+    def stats(self):
+        """返回摘要次数和失败次数"""
+        return {"folds": self.folds, "failures": self.failures}
@@ -0,0 +1,154 @@
+"""关键词索引模块，用jieba分词维护记忆的倒排索引，按BM25打分检索"""
+
+import re
+import json
+import math
+import heapq
+import logging
+import threading
+import jieba
+from config.config import Config
+
+# jieba默认在首次分词时输出加载词典的调试信息
+jieba.setLogLevel(logging.WARNING)
+
+# 不参与检索的虚词和标点
+STOP_WORDS = frozenset(
+    "我 你 他 她 它 我们 你们 的 地 得 了 着 过 是 在 和 与 及 或 也 都 就 还 吗 呢 吧 啊 呀 "
+    "什么 哪 哪里 哪儿 哪个 怎么 怎样 如何 多少 几 谁 请 帮 一下 这 那 这个 那个 有 没有 "
+    "用户 助手".split()
+)
+
+
+# 连续的汉字片段
+_CJK_PATTERN = re.compile(r"[\u4e00-\u9fff]{2,}")
+
+
+def tokenize(text):
+    """搜索引擎模式分词，去掉虚词、标点和空白，英文统一小写
+
+    另外加入汉字二元组：人名等词在不同上下文中切分结果不同（"我叫张三"切为"张"、"三"，
+    单独的"张三"则不切分），二元组保证两边仍能匹配。
+    """
+    tokens = []
+    for token in jieba.lcut_for_search(text):
+        token = token.strip().lower()
+        if not token or token in STOP_WORDS:
+            continue
+        # 单个标点或符号
+        if len(token) == 1 and not token.isalnum():
+            continue
+        tokens.append(token)
+    for run in _CJK_PATTERN.findall(text):
+        tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def document_text(document):
+    """取记忆文档中参与索引的文本：JSON记忆只索引各字段的值"""
+    try:
+        memory = json.loads(document)
+    except (json.JSONDecodeError, TypeError):
+        return document or ""
+    if isinstance(memory, dict):
+        return "\n".join(str(value) for value in memory.values())
+    return document
+
+
+class KeywordIndex:
+    """BM25倒排索引
+
+    与扁平向量索引一样在进程内镜像ChromaDB记忆集合，启动时加载一次，之后随记忆写入增量追加。
+    词项的倒排表为 (文档行号, 词频) 列表；文档数和平均长度全局统计，指定用户的查询只对
+    该用户的文档打分。写入和查询共用一把锁，单次查询只遍历查询词的倒排表。
+    """
+
+    def __init__(self, k1=None, b=None):
+        self.k1 = Config.BM25_K1 if k1 is None else k1
+        self.b = Config.BM25_B if b is None else b
+        self.postings = {}  # 词项 -> [(行号, 词频), ...]
+        self.doc_lengths = []
+        self.total_length = 0
+        self.ids = []
+        self.documents = []
+        self.doc_users = []
+        self.lock = threading.Lock()
+        # 提前加载分词词典（约0.5秒），避免落在第一次检索上
+        jieba.initialize()
+
+    @classmethod
+    def from_collection(cls, collection, page_size=5000):
+        """从ChromaDB集合分页加载全部记忆，构建索引"""
+        index = cls()
+        total = collection.count()
+        for offset in range(0, total, page_size):
+            page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            user_ids = [(metadata or {}).get("user_id") for metadata in page["metadatas"]]
+            index.add(page["ids"], page["documents"], user_ids)
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, documents, user_ids=None):
+        """追加记忆，分词在锁外完成"""
+        if not len(ids):
+            return
+        user_ids = user_ids or [None] * len(ids)
+        term_counts = []
+        for document in documents:
+            counts = {}
+            for token in tokenize(document_text(document)):
+                counts[token] = counts.get(token, 0) + 1
+            term_counts.append(counts)
+
+        with self.lock:
+            for memory_id, document, user_id, counts in zip(ids, documents, user_ids, term_counts):
+                row = len(self.ids)
+                for term, frequency in counts.items():
+                    self.postings.setdefault(term, []).append((row, frequency))
+                length = sum(counts.values())
+                self.doc_lengths.append(length)
+                self.total_length += length
+                self.ids.append(memory_id)
+                self.documents.append(document)
+                self.doc_users.append(user_id)
+
+    def _score(self, terms, user_id):
+        """计算一条查询对各文档的BM25分数，返回 {行号: 分数}"""
+        count = len(self.ids)
+        if not count:
+            return {}
+        average_length = self.total_length / count or 1.0
+        scores = {}
+        # 查询中重复的词只计一次
+        for term in dict.fromkeys(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1.0 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for row, frequency in postings:
+                if user_id is not None and self.doc_users[row] != user_id:
+                    continue
+                norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[row] / average_length)
+                scores[row] = scores.get(row, 0.0) + idf * frequency * (self.k1 + 1.0) / (
+                    frequency + norm
+                )
+        return scores
+
+    def query(self, query_texts, n_results, user_id=None):
+        """检索每条查询BM25分数最高的记忆，结果结构与collection.query相同，distances换为scores
+
+        Args:
+            user_id: 只检索该用户的记忆，None表示检索全部记忆
+        """
+        query_terms = [tokenize(text) for text in query_texts]
+        result = {"ids": [], "documents": [], "scores": []}
+        with self.lock:
+            for terms in query_terms:
+                scores = self._score(terms, user_id)
+                top = heapq.nlargest(n_results, scores.items(), key=lambda item: item[1])
+                result["ids"].append([self.ids[row] for row, _ in top])
+                result["documents"].append([self.documents[row] for row, _ in top])
+                result["scores"].append([score for _, score in top])
+        return result
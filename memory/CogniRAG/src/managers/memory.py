@@ -3,10 +3,24 @@
 import os
 import json
 import time
+import heapq
+import logging
+import threading
 from datetime import datetime
+import numpy as np
 import chromadb
 from chromadb.errors import NotFoundError
 from config.config import Config
+from config.logging_config import get_logger
+from models.tracing import tracer
+from managers.flat_index import FlatMemoryIndex
+from managers.keyword_index import KeywordIndex
+from managers.memory_ingestion import MemoryIngestionWorker
+from managers.memory_scoring import MemoryStats, estimate_importance
+from managers.retrieval_cache import RetrievalCache
+
+logger = get_logger("memory")
+retrieval_logger = get_logger("retrieval")
 
 
 class MemoryManager:
@@ -24,8 +38,8 @@ class MemoryManager:
             # 测试写入操作
             self._test_db_write_permission()
         except Exception as e:
-            print(f"数据库初始化错误: {e}")
-            print("尝试修复数据库权限...")
+            logger.error("数据库初始化错误: %s", e)
+            logger.info("尝试修复数据库权限...")
 
             # 尝试修复数据库文件权限
             if self._fix_db_permissions():
@@ -33,9 +47,9 @@ class MemoryManager:
                 try:
                     self.client = chromadb.PersistentClient(path=Config.MEMORY_DB_DIR)
                     self._test_db_write_permission()
-                    print("数据库权限修复成功，可以正常使用")
+                    logger.info("数据库权限修复成功，可以正常使用")
                 except Exception as retry_error:
-                    print(f"修复权限后仍然无法使用数据库: {retry_error}")
+                    logger.error("修复权限后仍然无法使用数据库: %s", retry_error)
                     self._recreate_db_directory()
             else:
                 # 如果无法修复权限，则重新创建数据库目录
@@ -43,13 +57,54 @@ class MemoryManager:
 
         # 获取嵌入向量的维度
         self.embedding_dimension = self.model_interface.get_embedding_dimension()
-        print(f"使用嵌入维度: {self.embedding_dimension}")
+        logger.info("使用嵌入维度: %d", self.embedding_dimension)
 
-        # 获取或创建统一记忆集合
+        # 获取或创建统一记忆集合，所有用户共用，按元数据user_id区分
         self.memory_collection = self._get_or_create_collection("memory")
+        self._migrate_user_scope()
+
+        # 进程内扁平索引（可选），ChromaDB仍为持久化存储
+        self.flat_index = self._load_flat_index()
+        # BM25关键词索引（混合检索或关键词检索时使用）
+        self.keyword_index = self._load_keyword_index()
+        # 记忆的时间、访问次数和重要度，用于排序和淘汰
+        self.memory_stats = self._load_memory_stats()
+
+        # 写入记忆集合并同步进程内索引期间持有；记忆整理重建索引时持有，避免漏掉并发写入
+        self.commit_lock = threading.RLock()
+
+        # 后台记忆写入线程（可选）
+        self.ingestion_worker = None
+        if Config.MEMORY_INGESTION_ENABLED:
+            self.ingestion_worker = MemoryIngestionWorker(
+                self.model_interface,
+                self.memory_collection,
+                on_commit=self._on_memories_committed,
+                commit_lock=self.commit_lock,
+            )
+
+        # 记忆检索缓存，按线索嵌入向量命中，写入记忆时按代数失效
+        self.retrieval_cache = RetrievalCache(
+            max_entries=Config.RETRIEVAL_CACHE_MAX_ENTRIES,
+            max_bytes=Config.RETRIEVAL_CACHE_MAX_BYTES,
+            tolerance=Config.RETRIEVAL_CACHE_TOLERANCE,
+            similarity_threshold=Config.SIMILARITY_THRESHOLD,
+        )
 
-        # 记忆查询缓存
-        self.memory_cache = {}
+        # 内存紧张时最先释放检索缓存
+        if self.model_interface.resource_governor is not None:
+            self.model_interface.resource_governor.register_action(
+                "清空检索缓存", self.retrieval_cache.clear, priority=0
+            )
+
+        # 后台维护线程（可选）：定期批量写回访问统计并淘汰记忆
+        self.stop_event = threading.Event()
+        self.maintenance_thread = None
+        if self.memory_stats is not None and Config.MEMORY_MAINTENANCE_INTERVAL > 0:
+            self.maintenance_thread = threading.Thread(
+                target=self._run_maintenance, name="memory-maintenance", daemon=True
+            )
+            self.maintenance_thread.start()
 
     def _test_db_write_permission(self):
         """测试数据库写入权限"""
@@ -63,29 +118,113 @@ class MemoryManager:
             )
             # 删除测试集合
             self.client.delete_collection(test_collection_name)
-            print("数据库写入权限测试通过")
+            logger.debug("数据库写入权限测试通过")
         except Exception as e:
-            print(f"数据库写入权限测试失败: {e}")
+            logger.error("数据库写入权限测试失败: %s", e)
             raise
 
     def _get_or_create_collection(self, name):
         """获取或创建ChromaDB集合"""
         try:
             collection = self.client.get_collection(name=name)
-            print(f"获取已有{name}集合")
+            logger.debug("获取已有%s集合", name)
             return collection
         except NotFoundError:
-            print(f"创建新的{name}集合")
+            logger.info("创建新的%s集合", name)
             return self.client.create_collection(
                 name=name, metadata={"hnsw:space": Config.COLLECTION_DISTANCE_TYPE}
             )
 
+    def _migrate_user_scope(self, page_size=5000):
+        """为没有user_id的旧记忆补上默认用户ID（只在首次启动时执行一次）"""
+        marker_file = os.path.join(Config.MEMORY_DB_DIR, "user_scope_migrated")
+        if os.path.exists(marker_file):
+            return
+
+        migrated = 0
+        total = self.memory_collection.count()
+        for offset in range(0, total, page_size):
+            page = self.memory_collection.get(
+                include=["metadatas"], limit=page_size, offset=offset
+            )
+            ids = []
+            metadatas = []
+            for memory_id, metadata in zip(page["ids"], page["metadatas"]):
+                if not (metadata or {}).get("user_id"):
+                    ids.append(memory_id)
+                    metadatas.append({**(metadata or {}), "user_id": Config.DEFAULT_USER_ID})
+            if ids:
+                self.memory_collection.update(ids=ids, metadatas=metadatas)
+                migrated += len(ids)
+
+        open(marker_file, "w").close()
+        if migrated:
+            logger.info("已将 %d 条旧记忆归属到默认用户 %s", migrated, Config.DEFAULT_USER_ID)
+
+    def _load_flat_index(self):
+        """从记忆集合加载扁平索引，未启用或记忆过多时返回None"""
+        if not Config.FLAT_INDEX_ENABLED:
+            return None
+
+        count = self.memory_collection.count()
+        if count > Config.FLAT_INDEX_MAX_SIZE:
+            logger.info(
+                "记忆数量 %d 超过扁平索引上限 %d，使用ChromaDB检索", count, Config.FLAT_INDEX_MAX_SIZE
+            )
+            return None
+
+        start_time = time.time()
+        flat_index = FlatMemoryIndex.from_collection(self.memory_collection, self.embedding_dimension)
+        logger.info(
+            "扁平索引加载完成: %d 条记忆，耗时 %.2f 秒", len(flat_index), time.time() - start_time
+        )
+        return flat_index
+
+    def _load_keyword_index(self):
+        """从记忆集合加载BM25关键词索引，只用向量检索时返回None"""
+        if Config.RETRIEVAL_MODE == "vector":
+            return None
+        start_time = time.time()
+        keyword_index = KeywordIndex.from_collection(self.memory_collection)
+        logger.info(
+            "关键词索引加载完成: %d 条记忆，%d 个词项，耗时 %.2f 秒",
+            len(keyword_index),
+            len(keyword_index.postings),
+            time.time() - start_time,
+        )
+        return keyword_index
+
+    def _load_memory_stats(self):
+        """从记忆集合加载打分统计，既不打分也不淘汰时返回None"""
+        if not (
+            Config.MEMORY_SCORING_ENABLED
+            or Config.MEMORY_TTL_DAYS > 0
+            or Config.MEMORY_MAX_PER_USER > 0
+        ):
+            return None
+        start_time = time.time()
+        memory_stats = MemoryStats.from_collection(self.memory_collection)
+        logger.info(
+            "记忆打分统计加载完成: %d 条记忆，耗时 %.2f 秒", len(memory_stats), time.time() - start_time
+        )
+        return memory_stats
+
+    def _query_memories(self, query_embeddings, n_results, user_id=None):
+        """执行向量检索，优先使用扁平索引；指定user_id时只检索该用户的记忆"""
+        if self.flat_index is not None:
+            return self.flat_index.query(query_embeddings, n_results, user_id=user_id)
+        return self.memory_collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where={"user_id": user_id} if user_id is not None else None,
+        )
+
     def _recreate_collections(self):
         """重新创建记忆集合（仅在必要时使用）"""
         # 删除现有集合
         try:
             self.client.delete_collection("memory")
-            print("已删除原有记忆集合")
+            logger.info("已删除原有记忆集合")
         except NotFoundError:
             pass
 
@@ -93,33 +232,167 @@ class MemoryManager:
         self.memory_collection = self.client.create_collection(
             name="memory", metadata={"hnsw:space": Config.COLLECTION_DISTANCE_TYPE}
         )
-        print(f"已创建新的记忆集合，向量维度: {self.embedding_dimension}")
-
-    def add_memory(self, user_input, ai_response):
-        """添加新记忆"""
-        # 使用时间戳作为唯一ID
-        memory_id = datetime.now().isoformat()
+        self.reload_indexes()
+        if self.ingestion_worker is not None:
+            self.ingestion_worker.collection = self.memory_collection
+        logger.info("已创建新的记忆集合，向量维度: %d", self.embedding_dimension)
+
+    def add_memory(self, user_input, ai_response, user_id=None, importance=None):
+        """添加新记忆，启用后台写入时只入队不阻塞
+
+        Args:
+            user_id: 记忆所属用户，None时归属默认用户
+            importance: 记忆重要度（0~1），None时按用户输入是否含个人事实估计
+        """
+        if user_id is None:
+            user_id = Config.DEFAULT_USER_ID
+        # 使用用户ID加时间戳作为唯一ID，不同用户同时写入也不会冲突
+        now = datetime.now()
+        memory_id = f"{user_id}-{now.isoformat()}"
 
         # 构建记忆内容
         memory_content = {"用户": user_input, "助手": ai_response}
 
         # 序列化记忆为文本
         memory_text = json.dumps(memory_content, ensure_ascii=False)
+        if importance is None:
+            importance = estimate_importance(user_input)
+        timestamp = now.timestamp()
+        metadata = {
+            "type": "memory",
+            "user_id": user_id,
+            "created_at": timestamp,
+            "last_accessed": timestamp,
+            "access_count": 0,
+            "importance": float(importance),
+        }
+
+        # 嵌入计算和写入交给后台线程批量完成
+        if self.ingestion_worker is not None:
+            self.ingestion_worker.submit(memory_id, memory_text, metadata)
+            logger.debug("记忆已提交后台写入: %s", memory_id)
+            return
 
         # 获取记忆的嵌入向量
         embedding = self.model_interface.get_embedding(memory_text)
 
         # 添加到统一记忆集合
-        self.memory_collection.add(
-            ids=[memory_id],
-            embeddings=[embedding],
-            metadatas=[{"type": "memory"}],
-            documents=[memory_text],
-        )
-        print(f"添加记忆到集合: {memory_id}")
-
-    def retrieve_relevant_memories_by_clues(self, clues, top_k=None):
-        """使用线索检索相关记忆，每条线索单独检索，但限制处理的线索数量"""
+        with self.commit_lock:
+            self.memory_collection.add(
+                ids=[memory_id],
+                embeddings=[embedding],
+                metadatas=[metadata],
+                documents=[memory_text],
+            )
+            self._on_memories_committed([memory_id], [embedding], [memory_text], [metadata])
+        logger.debug("添加记忆到集合: %s", memory_id)
+
+    def _on_memories_committed(self, ids, embeddings, documents, metadatas):
+        """记忆写入ChromaDB后使检索缓存失效，并同步更新扁平索引"""
+        user_ids = [metadata.get("user_id") for metadata in metadatas]
+        self.retrieval_cache.invalidate(embeddings, user_ids)
+        if self.keyword_index is not None:
+            self.keyword_index.add(ids, documents, user_ids)
+        if self.memory_stats is not None:
+            self.memory_stats.add(ids, metadatas)
+
+        # 超过上限后回退到ChromaDB检索
+        if self.flat_index is None:
+            return
+        self.flat_index.add(ids, embeddings, documents, user_ids)
+        if len(self.flat_index) > Config.FLAT_INDEX_MAX_SIZE:
+            logger.warning(
+                "记忆数量超过扁平索引上限 %d，释放索引并回退到ChromaDB检索", Config.FLAT_INDEX_MAX_SIZE
+            )
+            self.flat_index = None
+
+    def reload_indexes(self, flush_stats=True):
+        """记忆集合被整理（删除或替换记忆）后重建进程内索引并清空检索缓存
+
+        调用方需持有commit_lock，保证重建期间没有新记忆写入。
+        flush_stats为False时不先写回访问统计，用于调用方已写回并写入了合并后的打分字段的情况。
+        """
+        # 先写回访问统计，重新加载后不会丢失
+        if flush_stats:
+            self.flush_access_stats()
+        self.flat_index = self._load_flat_index()
+        self.keyword_index = self._load_keyword_index()
+        self.memory_stats = self._load_memory_stats()
+        self.retrieval_cache.clear()
+        self.retrieval_cache.invalidate()
+
+    def flush(self):
+        """等待后台写入完成，保证之后的检索能读到已添加的记忆"""
+        if self.ingestion_worker is not None:
+            self.ingestion_worker.flush()
+
+    def flush_access_stats(self):
+        """把累计的访问次数和访问时间一次写回ChromaDB，返回写回的记忆数"""
+        if self.memory_stats is None:
+            return 0
+        ids, metadatas = self.memory_stats.take_dirty()
+        if not ids:
+            return 0
+        try:
+            # update只合并给出的元数据字段，已被删除的记忆会被忽略
+            self.memory_collection.update(ids=ids, metadatas=metadatas)
+        except Exception as e:
+            logger.error("写回 %d 条记忆的访问统计失败: %s", len(ids), e)
+            return 0
+        logger.debug("写回 %d 条记忆的访问统计", len(ids))
+        return len(ids)
+
+    def evict_memories(self, ttl=None, threshold=None, capacity=None):
+        """淘汰过期且保留分数低的记忆，以及超出总数上限的低分记忆，返回淘汰的记忆数"""
+        if self.memory_stats is None:
+            return 0
+        with tracer.span("memory_eviction"):
+            # 读己之写：先写完已提交的记忆
+            self.flush()
+            with self.commit_lock:
+                ids = self.memory_stats.eviction_candidates(ttl, threshold, capacity)
+                if not ids:
+                    return 0
+                self.memory_collection.delete(ids=ids)
+                self.reload_indexes()
+        logger.info("淘汰 %d 条记忆，剩余 %d 条", len(ids), self.memory_collection.count())
+        return len(ids)
+
+    def _run_maintenance(self):
+        """后台维护线程主循环"""
+        while not self.stop_event.wait(Config.MEMORY_MAINTENANCE_INTERVAL):
+            try:
+                self.flush_access_stats()
+                if Config.MEMORY_TTL_DAYS > 0 or Config.MEMORY_MAX_PER_USER > 0:
+                    self.evict_memories()
+            except Exception as e:
+                logger.error("记忆维护失败: %s", e)
+
+    def close(self):
+        """写完待写入的记忆和访问统计并停止后台线程"""
+        self.stop_event.set()
+        if self.maintenance_thread is not None:
+            self.maintenance_thread.join()
+            self.maintenance_thread = None
+        if self.ingestion_worker is not None:
+            self.ingestion_worker.close()
+        self.flush_access_stats()
+
+    def retrieve_relevant_memories_by_clues(
+        self, clues, top_k=None, user_id=None, query=None, query_embedding=None
+    ):
+        """使用线索检索相关记忆，所有线索的嵌入向量合并为一次多查询检索
+
+        混合检索模式下同时用BM25检索线索中的关键词，两路结果按倒数排名融合，
+        名字、时间、数字等精确事实即使向量相似度低于阈值也能被找回。
+
+        Args:
+            user_id: 只检索该用户的记忆，None时检索默认用户
+            query: 本轮用户输入，作为一条额外的检索查询
+            query_embedding: 已计算好的输入嵌入向量（如画像门控算出的），未提供时与线索一起批量计算
+        """
+        if user_id is None:
+            user_id = Config.DEFAULT_USER_ID
         start_time = time.time()
         if top_k is None:
             top_k = Config.MEMORY_RETRIEVAL_TOP_K
@@ -127,124 +400,251 @@ class MemoryManager:
         # 将线索拆分为单独的条目
         clue_list = [clue.strip() for clue in clues.strip().split("\n") if clue.strip()]
 
-        if not clue_list:
-            print("没有有效的线索条目")
-            return []
-
         # 限制处理的线索数量，防止过多查询导致性能问题
         if len(clue_list) > Config.MAX_CLUES_TO_PROCESS:
-            print(f"线索过多，限制处理前 {Config.MAX_CLUES_TO_PROCESS} 条")
+            retrieval_logger.debug("线索过多，限制处理前 %d 条", Config.MAX_CLUES_TO_PROCESS)
             clue_list = clue_list[: Config.MAX_CLUES_TO_PROCESS]
 
-        print(f"处理 {len(clue_list)} 条线索进行检索")
-        for i, clue in enumerate(clue_list):
-            print(f"线索 {i+1}: {clue}")
+        # 本轮输入也作为一条查询，已有的嵌入向量直接复用
+        known_embeddings = {}
+        query = (query or "").strip() if Config.RETRIEVAL_INCLUDE_INPUT else ""
+        if query:
+            if query not in clue_list:
+                clue_list.append(query)
+            if query_embedding is not None:
+                known_embeddings[query] = query_embedding
 
-        # 存储所有检索结果
-        all_memories = {}  # 使用字典去重
+        if not clue_list:
+            retrieval_logger.debug("没有有效的线索条目")
+            return []
 
-        # 批量获取所有线索的嵌入向量
-        clue_embeddings = self.model_interface.get_embeddings_batch(clue_list)
+        if retrieval_logger.isEnabledFor(logging.DEBUG):
+            retrieval_logger.debug("处理 %d 条线索进行检索", len(clue_list))
+            for i, clue in enumerate(clue_list):
+                retrieval_logger.debug("线索 %d: %s", i + 1, clue)
+
+        # 读己之写：等待之前提交的记忆写入完成
+        self.flush()
+        tracer.annotate(clues=len(clue_list))
+
+        rows = []
+        if Config.RETRIEVAL_MODE != "keyword":
+            rows = self._vector_query_rows(clue_list, top_k, user_id, known_embeddings)
+
+        # 候选记忆按 相似度 * 时间衰减 * 重要度 排序
+        weights = None
+        if self.memory_stats is not None and Config.MEMORY_SCORING_ENABLED:
+            weights = self.memory_stats.weights
+
+        if self.keyword_index is None or Config.RETRIEVAL_MODE == "vector":
+            memories_list = self._merge_query_rows(rows, top_k, weights)
+        else:
+            # 关键词检索不需要嵌入向量，每条线索取top_k条参与融合
+            with tracer.span("keyword_query", queries=len(clue_list)):
+                results = self.keyword_index.query(clue_list, top_k, user_id)
+            keyword_rows = list(zip(results["ids"], results["documents"], results["scores"]))
+            memories_list = self._fuse_query_rows(rows, keyword_rows, top_k, weights=weights)
+
+        # 访问统计只在内存中累加，攒够一批再写回
+        if self.memory_stats is not None and memories_list:
+            dirty = self.memory_stats.record_access([memory["id"] for memory in memories_list])
+            if dirty >= Config.MEMORY_ACCESS_FLUSH_SIZE:
+                self.flush_access_stats()
+
+        if retrieval_logger.isEnabledFor(logging.DEBUG):
+            retrieval_logger.debug(
+                "记忆检索耗时: %.2f 秒，找到 %d 条相关记忆",
+                time.time() - start_time,
+                len(memories_list),
+            )
+            retrieval_logger.debug("检索缓存统计: %s", self.retrieval_cache.stats())
 
-        # 对每条线索进行检索
-        for i, clue_embedding in enumerate(clue_embeddings):
-            try:
-                clue = clue_list[i]
-
-                # 从缓存中查找结果
-                cache_key = clue[:50]  # 使用线索的前50个字符作为缓存键
-                if cache_key in self.memory_cache:
-                    print(f"使用缓存结果: {cache_key}")
-                    for memory_obj in self.memory_cache[cache_key]:
-                        # 只添加符合相似度阈值的记忆
-                        memory_similarity = 1 - memory_obj.get("distance", 1.0)
-                        if memory_similarity >= Config.SIMILARITY_THRESHOLD:
-                            memory_id = memory_obj.get("timestamp", datetime.now().isoformat())
-                            all_memories[memory_id] = memory_obj
-                        else:
-                            print(
-                                f"缓存记忆相似度 ({memory_similarity:.4f}) 低于阈值 ({Config.SIMILARITY_THRESHOLD})，已过滤"
-                            )
-                    continue
+        return memories_list
 
-                # 从记忆集合中检索
-                # 检索比需要的多一些结果，以便在相似度过滤后仍有足够的结果
-                larger_top_k = min(top_k * 3, 20)  # 检索更多结果以便过滤
-                print(f"检索 {larger_top_k} 条记忆，以便在应用相似度过滤后有足够的结果...")
-
-                # 从记忆集合中检索
-                results = self.memory_collection.query(
-                    query_embeddings=[clue_embedding], n_results=larger_top_k
-                )
-
-                # 处理检索结果
-                memory_results = []
-                filtered_count = 0
-
-                if results["documents"] and len(results["documents"][0]) > 0:
-                    for j in range(len(results["documents"][0])):
-                        try:
-                            doc = results["documents"][0][j]
-                            distance = results["distances"][0][j] if "distances" in results else 1.0
-
-                            # 由于ChromaDB使用的是余弦距离，需要将其转换为余弦相似度
-                            # 在余弦距离中，0表示完全相似，2表示完全不相似
-                            # 我们将其转换为余弦相似度，1表示完全相似，-1表示完全不相似
-                            similarity = 1 - distance
-
-                            # 只有相似度高于阈值的记忆才会被保留
-                            if similarity < Config.SIMILARITY_THRESHOLD:
-                                print(
-                                    f"记忆 {j+1} 相似度 ({similarity:.4f}) 低于阈值 ({Config.SIMILARITY_THRESHOLD})，已过滤"
-                                )
-                                filtered_count += 1
-                                continue
-
-                            memory_obj = json.loads(doc)
-                            memory_id = memory_obj.get('timestamp', datetime.now().isoformat())
-
-                            # 添加距离和相似度信息
-                            memory_obj["distance"] = distance
-                            memory_obj["similarity"] = similarity
-                            memory_results.append(memory_obj)
-
-                            # 如果这个记忆已经存在，保留距离更小的版本
-                            if (
-                                memory_id not in all_memories
-                                or all_memories[memory_id]["distance"] > distance
-                            ):
-                                all_memories[memory_id] = memory_obj
-                        except json.JSONDecodeError:
-                            print(f"无法解析记忆内容: {results['documents'][0][j]}")
-
-                    print(
-                        f"根据相似度阈值 {Config.SIMILARITY_THRESHOLD} 过滤掉了 {filtered_count} 条记忆"
-                    )
+    def _vector_query_rows(self, clue_list, top_k, user_id, known_embeddings=None):
+        """向量检索每条线索，返回 (ids, documents, distances) 列表
 
-                # 将结果保存到缓存
-                if memory_results:
-                    self.memory_cache[cache_key] = memory_results
-                    # 限制缓存大小
-                    if len(self.memory_cache) > Config.EMBEDDING_CACHE_SIZE:
-                        # 删除最早添加的缓存项
-                        oldest_key = next(iter(self.memory_cache))
-                        del self.memory_cache[oldest_key]
+        known_embeddings为 线索 -> 已计算好的嵌入向量，其余线索批量计算。
+        """
+        # 批量获取所有线索的嵌入向量
+        embeddings = dict(known_embeddings or {})
+        missing = [clue for clue in clue_list if clue not in embeddings]
+        if missing:
+            embeddings.update(zip(missing, self.model_interface.get_embeddings_batch(missing)))
+        clue_embeddings = [embeddings[clue] for clue in clue_list]
+
+        # 检索比需要的多一些结果，以便在相似度过滤后仍有足够的结果
+        larger_top_k = min(top_k * 3, 20)
+
+        # 先从缓存中取出相近线索的检索结果，其余线索合并为一次查询
+        rows = []
+        uncached_embeddings = []
+        for clue, clue_embedding in zip(clue_list, clue_embeddings):
+            row = self.retrieval_cache.get(clue_embedding, larger_top_k, user_id)
+            if row is not None:
+                retrieval_logger.debug("使用缓存结果: %s", clue)
+                rows.append(row)
+            else:
+                uncached_embeddings.append(clue_embedding)
+
+        # 记录到调用方所在阶段的span
+        tracer.annotate(retrieval_cache_hits=len(rows))
 
+        if uncached_embeddings:
+            retrieval_logger.debug(
+                "一次检索 %d 条线索，每条 %d 条记忆...", len(uncached_embeddings), larger_top_k
+            )
+            try:
+                with tracer.span("vector_query", queries=len(uncached_embeddings)):
+                    results = self._query_memories(uncached_embeddings, larger_top_k, user_id)
+                for i, clue_embedding in enumerate(uncached_embeddings):
+                    row = (
+                        results["ids"][i],
+                        results["documents"][i],
+                        results["distances"][i],
+                    )
+                    rows.append(row)
+                    self.retrieval_cache.put(clue_embedding, larger_top_k, row, user_id)
             except Exception as e:
-                print(f"检索线索 '{clue_list[i]}' 时出错: {e}")
+                retrieval_logger.error("检索 %d 条线索时出错: %s", len(uncached_embeddings), e)
+
+        return rows
+
+    @staticmethod
+    def _fuse_query_rows(vector_rows, keyword_rows, top_k, rrf_k=None, weights=None):
+        """用倒数排名融合（RRF）合并向量检索和BM25检索的结果
+
+        向量结果先按相似度阈值过滤，关键词结果只要命中查询词即参与。每个结果列表中
+        排第r位的记忆得分 1 / (rrf_k + r)，同一记忆在多个列表中的得分累加，
+        得分相同时距离小的优先。只对最终入选的记忆做JSON解析。
+
+        Args:
+            vector_rows: 每条线索的向量检索结果 (ids, documents, distances) 列表
+            keyword_rows: 每条线索的BM25检索结果 (ids, documents, scores) 列表
+            top_k: 返回的记忆数量
+            weights: 按记忆ID列表返回权重数组的函数，融合得分乘以权重后再排序
+        """
+        rrf_k = Config.RRF_K if rrf_k is None else rrf_k
+        max_distance = 1.0 - Config.SIMILARITY_THRESHOLD
+        fused = {}
+        documents = {}
+        distances = {}
+        bm25_scores = {}
+
+        for ids, docs, row_distances in vector_rows:
+            rank = 0
+            for memory_id, doc, distance in zip(ids, docs, row_distances):
+                if distance > max_distance:
+                    continue
+                rank += 1
+                fused[memory_id] = fused.get(memory_id, 0.0) + 1.0 / (rrf_k + rank)
+                documents[memory_id] = doc
+                distances[memory_id] = min(distance, distances.get(memory_id, distance))
+
+        for ids, docs, scores in keyword_rows:
+            for rank, (memory_id, doc, score) in enumerate(zip(ids, docs, scores), start=1):
+                fused[memory_id] = fused.get(memory_id, 0.0) + 1.0 / (rrf_k + rank)
+                documents[memory_id] = doc
+                bm25_scores[memory_id] = max(score, bm25_scores.get(memory_id, score))
+
+        if weights is not None and fused:
+            candidates = list(fused)
+            for memory_id, weight in zip(candidates, weights(candidates).tolist()):
+                fused[memory_id] *= weight
+
+        selected = heapq.nlargest(
+            top_k, fused, key=lambda memory_id: (fused[memory_id], -distances.get(memory_id, 2.0))
+        )
+
+        memories_list = []
+        for memory_id in selected:
+            try:
+                memory_obj = json.loads(documents[memory_id])
+            except json.JSONDecodeError:
+                retrieval_logger.warning("无法解析记忆内容: %s", documents[memory_id])
                 continue
+            memory_obj["id"] = memory_id
+            memory_obj["rrf_score"] = fused[memory_id]
+            if memory_id in distances:
+                memory_obj["distance"] = float(distances[memory_id])
+                memory_obj["similarity"] = 1 - float(distances[memory_id])
+            if memory_id in bm25_scores:
+                memory_obj["bm25_score"] = bm25_scores[memory_id]
+            memories_list.append(memory_obj)
+
+        return memories_list
+
+    @staticmethod
+    def _merge_query_rows(rows, top_k, weights=None):
+        """合并多条线索的检索结果
+
+        用NumPy一次完成相似度阈值过滤、同一记忆取最小距离去重，以及argpartition选取top_k，
+        只对最终入选的记忆做JSON解析。
+
+        Args:
+            rows: 每条线索的检索结果 (ids, documents, distances) 列表
+            top_k: 返回的记忆数量
+            weights: 按记忆ID列表返回权重数组的函数，给出时按 相似度 * 权重 排序，否则按距离排序
+        """
+        ids = [memory_id for row in rows for memory_id in row[0]]
+        if not ids:
+            return []
+        documents = [doc for row in rows for doc in row[1]]
+        distances = np.fromiter(
+            (distance for row in rows for distance in row[2]), dtype=np.float32, count=len(ids)
+        )
 
-        # 将所有记忆转换为列表并按照相关性排序
-        memories_list = list(all_memories.values())
-        memories_list.sort(key=lambda x: x.get("distance", 1.0))
+        # 由于ChromaDB使用的是余弦距离，相似度 = 1 - 距离
+        # 只有相似度高于阈值的记忆才会被保留
+        mask = distances <= 1.0 - Config.SIMILARITY_THRESHOLD
+        if retrieval_logger.isEnabledFor(logging.DEBUG):
+            retrieval_logger.debug(
+                "根据相似度阈值 %s 过滤掉了 %d 条记忆",
+                Config.SIMILARITY_THRESHOLD,
+                int(len(ids) - mask.sum()),
+            )
+        if not mask.any():
+            return []
+        kept = np.flatnonzero(mask)
 
-        end_time = time.time()
-        print(
-            f"记忆检索耗时: {end_time - start_time:.2f} 秒，找到 {len(memories_list)} 条相似度高于阈值的相关记忆"
+        # 同一条记忆可能被多条线索命中，保留距离最小的版本
+        unique_ids, first_index, inverse = np.unique(
+            np.asarray(ids)[kept], return_index=True, return_inverse=True
         )
+        min_distances = np.full(len(unique_ids), np.inf, dtype=np.float32)
+        np.minimum.at(min_distances, inverse, distances[kept])
+
+        # 排序键越小越靠前：默认为距离，给出权重时为负的 相似度 * 权重
+        if weights is None:
+            keys = min_distances
+        else:
+            scores = (1.0 - min_distances) * weights(unique_ids.tolist())
+            keys = -scores
+
+        # 选出排序键最小的top_k条记忆并排序
+        if len(unique_ids) > top_k:
+            selected = np.argpartition(keys, top_k - 1)[:top_k]
+        else:
+            selected = np.arange(len(unique_ids))
+        selected = selected[np.argsort(keys[selected], kind="stable")]
+
+        memories_list = []
+        for idx in selected:
+            doc = documents[kept[first_index[idx]]]
+            try:
+                memory_obj = json.loads(doc)
+            except json.JSONDecodeError:
+                retrieval_logger.warning("无法解析记忆内容: %s", doc)
+                continue
+            distance = float(min_distances[idx])
+            memory_obj["id"] = str(unique_ids[idx])
+            memory_obj["distance"] = distance
+            memory_obj["similarity"] = 1 - distance
+            if weights is not None:
+                memory_obj["score"] = float(scores[idx])
+            memories_list.append(memory_obj)
 
-        # 限制返回数量
-        return memories_list[:top_k]
+        return memories_list
 
     def format_memories_for_context(self, memories):
         """将记忆格式化为上下文字符串"""
@@ -252,6 +652,7 @@ class MemoryManager:
             return ""
 
         formatted_memories = []
+        debug = retrieval_logger.isEnabledFor(logging.DEBUG)
         for memory in memories:
             try:
                 # 尝试解析记忆内容
@@ -264,14 +665,20 @@ class MemoryManager:
                 ai_response = memory_obj.get("助手", "")
                 similarity = memory_obj.get("similarity", "未知")
 
-                memory_text = f"用户: {user_input}\n助手: {ai_response}"
+                # 记忆整理生成的摘要记忆只有摘要字段
+                if "摘要" in memory_obj:
+                    memory_text = f"早前对话摘要: {memory_obj['摘要']}"
+                    user_input = memory_obj["摘要"]
+                else:
+                    memory_text = f"用户: {user_input}\n助手: {ai_response}"
                 formatted_memories.append(memory_text)
 
-                print(
-                    f"添加记忆到上下文: 相似度 {similarity}, 用户输入: {user_input[:30]}..."
-                )
+                if debug:
+                    retrieval_logger.debug(
+                        "添加记忆到上下文: 相似度 %s, 用户输入: %s...", similarity, user_input[:30]
+                    )
             except (json.JSONDecodeError, KeyError) as e:
-                print(f"格式化记忆时出错: {e}, 内容: {memory}")
+                retrieval_logger.warning("格式化记忆时出错: %s, 内容: %s", e, memory)
 
         return "\n\n".join(formatted_memories)
 
@@ -282,23 +689,23 @@ class MemoryManager:
             if os.path.exists(db_file):
                 # 修改数据库文件权限为可读写
                 os.chmod(db_file, 0o666)
-                print(f"已修改数据库文件权限: {db_file}")
+                logger.info("已修改数据库文件权限: %s", db_file)
 
                 # 修改数据库目录权限
                 os.chmod(Config.MEMORY_DB_DIR, 0o755)
-                print(f"已修改数据库目录权限: {Config.MEMORY_DB_DIR}")
+                logger.info("已修改数据库目录权限: %s", Config.MEMORY_DB_DIR)
 
                 return True
             else:
-                print(f"数据库文件不存在: {db_file}")
+                logger.warning("数据库文件不存在: %s", db_file)
                 return False
         except Exception as e:
-            print(f"修复数据库权限失败: {e}")
+            logger.error("修复数据库权限失败: %s", e)
             return False
 
     def _recreate_db_directory(self):
         """重新创建数据库目录"""
-        print("尝试重新创建数据库目录...")
+        logger.info("尝试重新创建数据库目录...")
         # 备份旧数据库
         backup_dir = f"{Config.MEMORY_DB_DIR}_backup_{int(time.time())}"
         if os.path.exists(Config.MEMORY_DB_DIR):
@@ -306,15 +713,15 @@ class MemoryManager:
                 import shutil
 
                 shutil.move(Config.MEMORY_DB_DIR, backup_dir)
-                print(f"已将旧数据库备份到: {backup_dir}")
+                logger.info("已将旧数据库备份到: %s", backup_dir)
             except Exception as move_error:
-                print(f"备份数据库失败: {move_error}")
+                logger.error("备份数据库失败: %s", move_error)
 
         # 创建新的数据库目录
         os.makedirs(Config.MEMORY_DB_DIR, exist_ok=True)
         # 修改权限确保可写
         os.chmod(Config.MEMORY_DB_DIR, 0o755)
-        print(f"创建了新的数据库目录: {Config.MEMORY_DB_DIR}")
+        logger.info("创建了新的数据库目录: %s", Config.MEMORY_DB_DIR)
 
         # 重新初始化客户端
         self.client = chromadb.PersistentClient(path=Config.MEMORY_DB_DIR)
@@ -0,0 +1,429 @@
+"""记忆整理模块，合并近似重复的记忆，记忆数超出上限时把最旧的记忆簇替换为摘要记忆"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+import numpy as np
+from config.config import Config
+from config.logging_config import get_logger
+from models.tracing import tracer
+from managers.history_summarizer import HistorySummarizer
+from managers.memory_scoring import merge_stats_fields
+
+logger = get_logger("memory")
+
+
+class MemoryConsolidator:
+    """记忆整理任务
+
+    按用户读取记忆快照，分三步生成整理计划：
+    1. 去重：嵌入相似度高于CONSOLIDATION_DUPLICATE_THRESHOLD的记忆用并查集合并为一组，
+       只保留最新一条，被删除记忆的ID记入保留记忆元数据的merged_ids；
+    2. 合并：去重后仍超过CONSOLIDATION_MAX_MEMORIES时，对最旧的一段记忆按簇首相似度聚类，
+       从最旧的簇开始用语言模型合并为一条摘要记忆，元数据source_ids记录全部来源ID；
+       相似的簇不够时按时间顺序分组合并；
+    3. 删除：未启用摘要或摘要生成失败时，删除最旧的记忆直到不超过上限。
+    生成摘要和计算摘要嵌入在锁外完成，只有写入ChromaDB和重建进程内索引时持有记忆库的commit_lock。
+    可以离线运行（consolidate.py），也可以按CONSOLIDATION_INTERVAL在后台线程中定期运行。
+    """
+
+    def __init__(self, memory_manager, model_interface, interval=None, max_memories=None):
+        self.memory_manager = memory_manager
+        self.model_interface = model_interface
+        self.interval = Config.CONSOLIDATION_INTERVAL if interval is None else interval
+        self.max_memories = (
+            Config.CONSOLIDATION_MAX_MEMORIES if max_memories is None else max_memories
+        )
+        self.summarizer = None
+        if Config.CONSOLIDATION_SUMMARIZE:
+            self.summarizer = HistorySummarizer(
+                model_interface, token_budget=Config.CONSOLIDATION_SUMMARY_TOKEN_BUDGET
+            )
+
+        self.run_lock = threading.Lock()  # 同一时间只运行一次整理
+        self.reports = deque(maxlen=20)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """启动后台整理线程"""
+        if self.thread is None and self.interval > 0:
+            self.thread = threading.Thread(
+                target=self._run, name="memory-consolidation", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        """停止后台整理线程"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        """后台线程主循环"""
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.run()
+            except Exception as e:
+                logger.error("记忆整理失败: %s", e)
+
+    @property
+    def collection(self):
+        return self.memory_manager.memory_collection
+
+    def user_ids(self, page_size=5000):
+        """记忆集合中出现过的全部用户ID"""
+        user_ids = set()
+        total = self.collection.count()
+        for offset in range(0, total, page_size):
+            page = self.collection.get(include=["metadatas"], limit=page_size, offset=offset)
+            user_ids.update((metadata or {}).get("user_id") for metadata in page["metadatas"])
+        user_ids.discard(None)
+        return sorted(user_ids)
+
+    def _load(self, user_id):
+        """读取用户的全部记忆，按ID（用户ID加时间戳）排序即按时间从旧到新"""
+        page = self.collection.get(
+            where={"user_id": user_id}, include=["embeddings", "documents", "metadatas"]
+        )
+        order = sorted(range(len(page["ids"])), key=lambda i: page["ids"][i])
+        embeddings = np.asarray(page["embeddings"], dtype=np.float32).reshape(len(order), -1)[order]
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return (
+            [page["ids"][i] for i in order],
+            embeddings / np.maximum(norms, 1e-12),
+            [page["documents"][i] for i in order],
+            [page["metadatas"][i] or {} for i in order],
+        )
+
+    @staticmethod
+    def find_duplicates(embeddings, threshold, chunk_size=1024):
+        """用并查集把相似度高于阈值的记忆合并为组，返回大小不小于2的组（组内按时间排序）"""
+        count = len(embeddings)
+        parent = list(range(count))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # 分块计算相似度矩阵的上三角，避免一次分配N*N矩阵
+        for start in range(0, count, chunk_size):
+            block = embeddings[start : start + chunk_size] @ embeddings.T
+            rows, cols = np.nonzero(block >= threshold)
+            for row, col in zip(rows.tolist(), cols.tolist()):
+                i = start + row
+                if col > i:
+                    root_i, root_j = find(i), find(col)
+                    if root_i != root_j:
+                        parent[root_i] = root_j
+
+        groups = {}
+        for i in range(count):
+            groups.setdefault(find(i), []).append(i)
+        return [group for group in groups.values() if len(group) > 1]
+
+    @staticmethod
+    def cluster_oldest(embeddings, indices, threshold, group_size):
+        """按时间顺序做簇首聚类：记忆归入与簇首相似度最高且未满的簇，返回按最旧成员排序的簇"""
+        clusters = []
+        leaders = []
+        for index in indices:
+            best = -1
+            if leaders:
+                similarities = np.asarray(leaders) @ embeddings[index]
+                for candidate in np.argsort(-similarities):
+                    if similarities[candidate] < threshold:
+                        break
+                    if len(clusters[candidate]) < group_size:
+                        best = int(candidate)
+                        break
+            if best < 0:
+                clusters.append([index])
+                leaders.append(embeddings[index])
+            else:
+                clusters[best].append(index)
+        return clusters
+
+    @staticmethod
+    def provenance(memory_id, metadata):
+        """记忆本身及其已合并来源的ID"""
+        ids = [memory_id]
+        for key in ("merged_ids", "source_ids"):
+            if metadata.get(key):
+                ids.extend(json.loads(metadata[key]))
+        return ids
+
+    @staticmethod
+    def memory_lines(document):
+        """把记忆文档转换为摘要输入的对话行"""
+        try:
+            memory = json.loads(document)
+        except json.JSONDecodeError:
+            return [document]
+        if "摘要" in memory:
+            return [f"早前对话摘要: {memory['摘要']}"]
+        return [f"用户: {memory.get('用户', '')}", f"助手: {memory.get('助手', '')}"]
+
+    def plan(self, user_id):
+        """生成一个用户的整理计划（不修改记忆库）"""
+        ids, embeddings, documents, metadatas = self._load(user_id)
+        plan = {
+            "user_id": user_id,
+            "before": len(ids),
+            "delete": [],
+            "update": {},  # 保留记忆ID -> 新元数据
+            "add": [],  # (id, document, metadata)
+            "stats_sources": {},  # 保留记忆或摘要记忆ID -> 打分字段由哪些记忆合并而来
+            "duplicates": 0,
+            "summarized": 0,
+            "evicted": 0,
+        }
+        if not ids:
+            plan["after"] = 0
+            return plan, embeddings
+
+        # 1. 近似重复：保留每组中最新的一条
+        removed = set()
+        for group in self.find_duplicates(embeddings, Config.CONSOLIDATION_DUPLICATE_THRESHOLD):
+            keep = group[-1]
+            merged = []
+            for index in group[:-1]:
+                merged.extend(self.provenance(ids[index], metadatas[index]))
+                removed.add(index)
+            metadata = dict(metadatas[keep])
+            metadata["merged_ids"] = json.dumps(
+                json.loads(metadata.get("merged_ids", "[]")) + merged, ensure_ascii=False
+            )
+            # 访问次数累加，时间和重要度取组内最新、最高的值
+            metadata.update(
+                merge_stats_fields([ids[i] for i in group], [metadatas[i] for i in group])
+            )
+            plan["update"][ids[keep]] = metadata
+            plan["stats_sources"][ids[keep]] = [ids[i] for i in group]
+            plan["duplicates"] += len(group) - 1
+
+        remaining = [i for i in range(len(ids)) if i not in removed]
+        excess = len(remaining) - self.max_memories
+
+        # 2. 超出上限：最旧的记忆按簇合并为摘要记忆
+        if excess > 0 and self.summarizer is not None:
+            window = remaining[: min(len(remaining), 2 * excess + Config.CONSOLIDATION_GROUP_SIZE)]
+            clusters = self.cluster_oldest(
+                embeddings,
+                window,
+                Config.CONSOLIDATION_CLUSTER_THRESHOLD,
+                Config.CONSOLIDATION_GROUP_SIZE,
+            )
+            groups = [cluster for cluster in clusters if len(cluster) > 1]
+            # 相似的簇不够时，把剩下的单条记忆按时间顺序分组
+            singles = [cluster[0] for cluster in clusters if len(cluster) == 1]
+            for start in range(0, len(singles), Config.CONSOLIDATION_GROUP_SIZE):
+                chunk = singles[start : start + Config.CONSOLIDATION_GROUP_SIZE]
+                if len(chunk) > 1:
+                    groups.append(chunk)
+
+            reduced = 0
+            for group in groups:
+                if reduced >= excess:
+                    break
+                lines = [line for index in group for line in self.memory_lines(documents[index])]
+                summary = self.summarizer.fold("", lines)
+                if not summary:
+                    continue
+                sources = [
+                    source
+                    for index in group
+                    for source in self.provenance(ids[index], metadatas[index])
+                ]
+                # 去重时已更新过元数据的记忆以更新后的为准
+                group_metadatas = [plan["update"].get(ids[i], metadatas[i]) for i in group]
+                summary_id = f"{ids[group[0]]}-summary"
+                plan["stats_sources"][summary_id] = [
+                    source
+                    for index in group
+                    for source in plan["stats_sources"].pop(ids[index], [ids[index]])
+                ]
+                plan["add"].append(
+                    (
+                        summary_id,
+                        json.dumps({"摘要": summary}, ensure_ascii=False),
+                        {
+                            "type": "summary",
+                            "user_id": user_id,
+                            "source_ids": json.dumps(sources, ensure_ascii=False),
+                            **merge_stats_fields([ids[i] for i in group], group_metadatas),
+                        },
+                    )
+                )
+                for index in group:
+                    removed.add(index)
+                    plan["update"].pop(ids[index], None)
+                plan["summarized"] += len(group)
+                reduced += len(group) - 1
+            remaining = [i for i in remaining if i not in removed]
+            excess = len(remaining) + len(plan["add"]) - self.max_memories
+
+        # 3. 仍超出上限：删除最旧的记忆
+        if excess > 0:
+            for index in remaining[:excess]:
+                removed.add(index)
+                plan["update"].pop(ids[index], None)
+                plan["stats_sources"].pop(ids[index], None)
+            plan["evicted"] = excess
+
+        plan["delete"] = [ids[i] for i in sorted(removed)]
+        plan["after"] = len(ids) - len(removed) + len(plan["add"])
+        return plan, embeddings
+
+    def embed_summaries(self, plan):
+        """计算计划中摘要记忆的嵌入向量，在持有commit_lock之前调用"""
+        documents = [document for _, document, _ in plan["add"]]
+        plan["add_embeddings"] = []
+        if documents:
+            plan["add_embeddings"] = self.model_interface.get_embeddings_batch(documents)
+
+    def refresh_stats(self, plan):
+        """按记忆打分统计的当前值重新合并保留记忆和摘要记忆的打分字段
+
+        生成计划（包括生成摘要）期间仍有检索命中，访问次数和时间以内存中的统计为准，
+        计划中的快照值会丢掉这些访问。调用方需持有commit_lock并已写回访问统计。
+        """
+        memory_stats = self.memory_manager.memory_stats
+        if memory_stats is None:
+            return
+        metadatas = dict(plan["update"])
+        metadatas.update((memory_id, metadata) for memory_id, _, metadata in plan["add"])
+        for memory_id, sources in plan["stats_sources"].items():
+            fields = memory_stats.fields(sources)
+            if memory_id in metadatas and all(field is not None for field in fields):
+                metadatas[memory_id].update(merge_stats_fields(sources, fields))
+
+    def apply(self, plan):
+        """把整理计划写入ChromaDB，摘要记忆的嵌入向量需已由embed_summaries算好"""
+        if plan["delete"]:
+            self.collection.delete(ids=plan["delete"])
+        if plan["update"]:
+            self.collection.update(
+                ids=list(plan["update"]), metadatas=list(plan["update"].values())
+            )
+        if plan["add"]:
+            self.collection.add(
+                ids=[memory_id for memory_id, _, _ in plan["add"]],
+                embeddings=plan["add_embeddings"],
+                documents=[document for _, document, _ in plan["add"]],
+                metadatas=[metadata for _, _, metadata in plan["add"]],
+            )
+
+    def measure_latency(self, queries, repeats=5):
+        """测量ChromaDB（HNSW）和当前检索路径的平均查询耗时（毫秒）"""
+        latency = {"chroma_ms": 0.0, "search_ms": 0.0}
+        if not queries:
+            return latency
+        top_k = min(Config.MEMORY_RETRIEVAL_TOP_K * 3, 20)
+        for user_id, embedding in queries:
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                self.collection.query(
+                    query_embeddings=[embedding], n_results=top_k, where={"user_id": user_id}
+                )
+            latency["chroma_ms"] += time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                self.memory_manager._query_memories([embedding], top_k, user_id)
+            latency["search_ms"] += time.perf_counter() - start_time
+        scale = 1000 / (repeats * len(queries))
+        return {key: value * scale for key, value in latency.items()}
+
+    @staticmethod
+    def disk_size():
+        """记忆库目录占用的字节数"""
+        total = 0
+        for root, _, files in os.walk(Config.MEMORY_DB_DIR):
+            for name in files:
+                total += os.path.getsize(os.path.join(root, name))
+        return total
+
+    def run(self, user_ids=None, dry_run=False, measure=True, sample_queries=20):
+        """整理指定用户（默认全部用户）的记忆，返回整理报告
+
+        Args:
+            dry_run: 只生成计划，不修改记忆库
+            measure: 整理前后测量查询耗时
+        """
+        with self.run_lock, tracer.span("memory_consolidation"):
+            start_time = time.perf_counter()
+            # 先写完已提交的记忆和访问统计，快照包含全部已知记忆
+            self.memory_manager.flush()
+            self.memory_manager.flush_access_stats()
+            if user_ids is None:
+                user_ids = self.user_ids()
+
+            plans = []
+            queries = []
+            rng = np.random.default_rng(0)
+            for user_id in user_ids:
+                plan, embeddings = self.plan(user_id)
+                plans.append(plan)
+                # 用该用户已有记忆的向量作为测量查询
+                if measure and len(embeddings):
+                    picks = rng.choice(
+                        len(embeddings), min(len(embeddings), sample_queries), replace=False
+                    )
+                    queries.extend((user_id, embeddings[i].tolist()) for i in picks)
+            queries = queries[:sample_queries]
+
+            report_keys = ("user_id", "before", "after", "duplicates", "summarized", "evicted")
+            report = {
+                "users": len(plans),
+                "dry_run": dry_run,
+                "collection_before": self.collection.count(),
+                "disk_bytes_before": self.disk_size(),
+                "duplicates": sum(plan["duplicates"] for plan in plans),
+                "summarized": sum(plan["summarized"] for plan in plans),
+                "summaries": sum(len(plan["add"]) for plan in plans),
+                "evicted": sum(plan["evicted"] for plan in plans),
+                "plans": [{key: plan[key] for key in report_keys} for plan in plans],
+            }
+            if measure:
+                report["latency_before"] = self.measure_latency(queries)
+
+            changed = [plan for plan in plans if plan["delete"] or plan["update"] or plan["add"]]
+            if changed and not dry_run:
+                # 嵌入计算在锁外完成，锁只覆盖写入和索引重建
+                for plan in changed:
+                    self.embed_summaries(plan)
+                # 写入和重建索引期间暂停新记忆写入，重建后的索引不会漏掉并发写入的记忆
+                with self.memory_manager.commit_lock:
+                    # 先写回访问统计，再按当前统计合并打分字段，写入后不再写回，
+                    # 避免按行写回的访问次数覆盖合并后的值
+                    self.memory_manager.flush_access_stats()
+                    for plan in changed:
+                        self.refresh_stats(plan)
+                        self.apply(plan)
+                    self.memory_manager.reload_indexes(flush_stats=False)
+
+            report["collection_after"] = self.collection.count()
+            report["disk_bytes_after"] = self.disk_size()
+            if measure:
+                report["latency_after"] = self.measure_latency(queries)
+            report["elapsed"] = time.perf_counter() - start_time
+
+        self.reports.append(report)
+        logger.info(
+            "记忆整理完成: %d 个用户，记忆 %d -> %d 条，去重 %d 条，"
+            "合并 %d 条为 %d 条摘要，删除 %d 条，耗时 %.2f 秒",
+            report["users"],
+            report["collection_before"],
+            report["collection_after"],
+            report["duplicates"],
+            report["summarized"],
+            report["summaries"],
+            report["evicted"],
+            report["elapsed"],
+        )
+        return report
@@ -0,0 +1,112 @@
+"""记忆写入模块，在后台线程中批量完成记忆的嵌入和入库"""
+
+import atexit
+import queue
+import threading
+import time
+from config.config import Config
+from config.logging_config import get_logger
+from models.tracing import tracer
+
+logger = get_logger("memory")
+
+
+class MemoryIngestionWorker:
+    """记忆写入后台线程
+
+    add_memory只负责把记忆放入有界队列，后台线程合并队列中所有待写入的记忆，
+    用一次get_embeddings_batch计算嵌入、一次collection.add写入ChromaDB。
+    """
+
+    _STOP = object()
+
+    def __init__(self, model_interface, collection, on_commit=None, commit_lock=None):
+        self.model_interface = model_interface
+        self.collection = collection
+        self.on_commit = on_commit  # 写入成功后的回调，参数为(ids, embeddings, documents, metadatas)
+        # 写入ChromaDB和执行回调期间持有，与记忆整理互斥
+        self.commit_lock = commit_lock or threading.Lock()
+
+        self.queue = queue.Queue(maxsize=Config.MEMORY_INGESTION_QUEUE_SIZE)
+        self.pending = 0  # 已提交但尚未写入完成的记忆数量
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, name="memory-ingestion", daemon=True)
+        self.thread.start()
+
+        # 进程退出前写完剩余记忆
+        atexit.register(self.close)
+
+    def submit(self, memory_id, document, metadata):
+        """提交一条待写入的记忆，队列满时阻塞等待"""
+        if self.closed:
+            raise RuntimeError("记忆写入线程已关闭")
+        with self.condition:
+            self.pending += 1
+        self.queue.put((memory_id, document, metadata))
+
+    def flush(self, timeout=None):
+        """等待已提交的记忆全部写入完成，保证后续检索能读到"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+    def close(self):
+        """写完剩余记忆并停止后台线程"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+    def _run(self):
+        """后台线程主循环：取出一批记忆并写入"""
+        while True:
+            item = self.queue.get()
+            if item is self._STOP:
+                return
+
+            # 合并队列中已有的记忆，一次完成嵌入和写入
+            batch = [item]
+            stop = False
+            while len(batch) < Config.MEMORY_INGESTION_BATCH_SIZE:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._ingest(batch)
+            if stop:
+                return
+
+    def _ingest(self, batch):
+        """嵌入并写入一批记忆，耗时计入memory_ingest阶段"""
+        with tracer.span("memory_ingest", memories=len(batch)):
+            self._ingest_batch(batch)
+
+    def _ingest_batch(self, batch):
+        """嵌入并写入一批记忆"""
+        start_time = time.time()
+        ids = [memory_id for memory_id, _, _ in batch]
+        documents = [document for _, document, _ in batch]
+        metadatas = [metadata for _, _, metadata in batch]
+
+        try:
+            embeddings = self.model_interface.get_embeddings_batch(documents)
+            with self.commit_lock:
+                self.collection.add(
+                    ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents
+                )
+                if self.on_commit:
+                    self.on_commit(ids, embeddings, documents, metadatas)
+            logger.debug("后台写入 %d 条记忆，耗时 %.2f 秒", len(batch), time.time() - start_time)
+        except Exception as e:
+            logger.error("后台写入记忆失败: %s", e)
+        finally:
+            with self.condition:
+                self.pending -= len(batch)
+                self.condition.notify_all()
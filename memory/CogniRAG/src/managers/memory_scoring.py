@@ -0,0 +1,259 @@
+"""记忆打分模块，维护记忆的时间、访问次数和重要度，按相似度、时间衰减和重要度对记忆排序和淘汰"""
+
+import re
+import time
+import threading
+from datetime import datetime
+import numpy as np
+from config.config import Config
+from managers.profile_gate import ProfileFactGate
+
+_DAY = 86400.0
+# 记忆ID为 用户ID-ISO时间，旧记忆没有时间元数据时从ID中解析
+_ID_TIME_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?")
+# 按标点切分子句，问号保留在子句末尾
+_CLAUSE_PATTERN = re.compile(r"[^，。；！？,;!?\n]+[？?]?")
+
+
+def estimate_importance(user_input):
+    """估计记忆重要度
+
+    只有画像门控规则明确判断含个人事实的输入用最高重要度，每个子句都以问号结尾的输入用最低重要度；
+    其余输入（包括规则拿不准的）一律用默认重要度，避免被误判为提问的陈述在淘汰时吃亏。
+    """
+    clauses = [
+        clause.strip() for clause in _CLAUSE_PATTERN.findall(user_input or "") if clause.strip()
+    ]
+    if clauses and all(clause[-1] in "？?" for clause in clauses):
+        return Config.MEMORY_IMPORTANCE_QUESTION
+    if ProfileFactGate.classify_by_rules(user_input or "") is True:
+        return Config.MEMORY_IMPORTANCE_FACT
+    return Config.MEMORY_IMPORTANCE_DEFAULT
+
+
+def id_timestamp(memory_id, default=None):
+    """从记忆ID中解析写入时间（秒），解析失败时返回default"""
+    match = _ID_TIME_PATTERN.search(memory_id or "")
+    if match is None:
+        return default
+    try:
+        return datetime.fromisoformat(match.group(0)).timestamp()
+    except ValueError:
+        return default
+
+
+def memory_stats_fields(memory_id, metadata, now=None):
+    """读取记忆元数据中的打分字段，缺失时按ID时间和默认重要度补齐"""
+    metadata = metadata or {}
+    created_at = metadata.get("created_at")
+    if created_at is None:
+        created_at = id_timestamp(memory_id, time.time() if now is None else now)
+    return {
+        "created_at": float(created_at),
+        "last_accessed": float(metadata.get("last_accessed", created_at)),
+        "access_count": int(metadata.get("access_count", 0)),
+        "importance": float(metadata.get("importance", Config.MEMORY_IMPORTANCE_DEFAULT)),
+    }
+
+
+def merge_stats_fields(ids, metadatas):
+    """合并多条记忆的打分字段：取最新的时间、最高的重要度，访问次数累加"""
+    fields = [
+        memory_stats_fields(memory_id, metadata) for memory_id, metadata in zip(ids, metadatas)
+    ]
+    return {
+        "created_at": max(field["created_at"] for field in fields),
+        "last_accessed": max(field["last_accessed"] for field in fields),
+        "access_count": sum(field["access_count"] for field in fields),
+        "importance": max(field["importance"] for field in fields),
+    }
+
+
+class MemoryStats:
+    """记忆打分统计
+
+    与扁平索引一样在进程内镜像记忆集合的元数据：写入时间、最近访问时间、访问次数和重要度
+    按行保存在连续的NumPy数组中，检索时对候选记忆一次算出权重：
+        时间衰减 = 下限 + (1 - 下限) * 0.5 ^ (距最近访问的天数 / 半衰期)
+        重要度系数 = 1 - 重要度权重 + 重要度权重 * 重要度
+    候选记忆的得分为 相似度 * 时间衰减 * 重要度系数。
+    访问次数和访问时间只在内存中更新并记为待写回，由调用方按批写回ChromaDB。
+    淘汰时的保留分数为 时间衰减 * 重要度系数 * (1 + 访问权重 * ln(1 + 访问次数))。
+    """
+
+    def __init__(self, capacity=1024):
+        self.half_life = Config.MEMORY_RECENCY_HALF_LIFE_DAYS * _DAY
+        self.recency_floor = Config.MEMORY_RECENCY_FLOOR
+        self.importance_weight = Config.MEMORY_IMPORTANCE_WEIGHT
+        self.access_weight = Config.MEMORY_ACCESS_WEIGHT
+
+        self.rows = {}  # 记忆ID -> 行号
+        self.user_rows = {}  # user_id -> 该用户记忆所在行号列表
+        self.ids = []
+        self.created_at = np.empty(capacity, dtype=np.float64)
+        self.last_accessed = np.empty(capacity, dtype=np.float64)
+        self.access_count = np.empty(capacity, dtype=np.int64)
+        self.importance = np.empty(capacity, dtype=np.float32)
+        self.dirty = set()  # 访问统计有变化、尚未写回的行号
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_collection(cls, collection, page_size=5000):
+        """从ChromaDB集合分页加载全部记忆的元数据"""
+        total = collection.count()
+        stats = cls(capacity=max(total, 1024))
+        for offset in range(0, total, page_size):
+            page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+            stats.add(page["ids"], page["metadatas"])
+        return stats
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _grow(self, required):
+        """容量不足时按倍数扩容"""
+        if required <= len(self.created_at):
+            return
+        capacity = max(required, 2 * len(self.created_at))
+        size = len(self.ids)
+        for name in ("created_at", "last_accessed", "access_count", "importance"):
+            array = getattr(self, name)
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:size] = array[:size]
+            setattr(self, name, grown)
+
+    def add(self, ids, metadatas):
+        """追加记忆"""
+        if not len(ids):
+            return
+        now = time.time()
+        fields = [
+            memory_stats_fields(memory_id, metadata, now)
+            for memory_id, metadata in zip(ids, metadatas)
+        ]
+        with self.lock:
+            size = len(self.ids)
+            self._grow(size + len(ids))
+            rows = range(size, size + len(ids))
+            for row, memory_id, metadata, field in zip(rows, ids, metadatas, fields):
+                self.rows[memory_id] = row
+                self.ids.append(memory_id)
+                self.user_rows.setdefault((metadata or {}).get("user_id"), []).append(row)
+                self.created_at[row] = field["created_at"]
+                self.last_accessed[row] = field["last_accessed"]
+                self.access_count[row] = field["access_count"]
+                self.importance[row] = field["importance"]
+
+    def _lookup(self, ids):
+        """记忆ID转换为行号数组，未知的记忆为-1"""
+        return np.fromiter(
+            (self.rows.get(memory_id, -1) for memory_id in ids), dtype=np.int64, count=len(ids)
+        )
+
+    def _weights(self, rows, now):
+        """按行号计算时间衰减乘重要度系数"""
+        age = np.maximum(now - self.last_accessed[rows], 0.0)
+        recency = self.recency_floor + (1.0 - self.recency_floor) * np.exp2(-age / self.half_life)
+        importance = 1.0 - self.importance_weight + self.importance_weight * self.importance[rows]
+        return recency * importance
+
+    def weights(self, ids, now=None):
+        """候选记忆的排序权重（时间衰减 * 重要度系数），未知的记忆权重为1"""
+        now = time.time() if now is None else now
+        with self.lock:
+            rows = self._lookup(ids)
+            weights = np.ones(len(ids), dtype=np.float64)
+            known = rows >= 0
+            if known.any():
+                weights[known] = self._weights(rows[known], now)
+        return weights
+
+    def record_access(self, ids, now=None):
+        """记录一次检索命中，返回待写回的记忆数"""
+        now = time.time() if now is None else now
+        with self.lock:
+            rows = self._lookup(ids)
+            rows = rows[rows >= 0]
+            self.access_count[rows] += 1
+            self.last_accessed[rows] = now
+            self.dirty.update(rows.tolist())
+            return len(self.dirty)
+
+    def fields(self, ids):
+        """读取记忆当前的打分字段，未知的记忆为None"""
+        with self.lock:
+            rows = [self.rows.get(memory_id) for memory_id in ids]
+            return [
+                None
+                if row is None
+                else {
+                    "created_at": float(self.created_at[row]),
+                    "last_accessed": float(self.last_accessed[row]),
+                    "access_count": int(self.access_count[row]),
+                    "importance": float(self.importance[row]),
+                }
+                for row in rows
+            ]
+
+    def take_dirty(self):
+        """取出待写回的访问统计，返回 (ids, metadatas)"""
+        with self.lock:
+            rows = sorted(self.dirty)
+            self.dirty.clear()
+            ids = [self.ids[row] for row in rows]
+            metadatas = [
+                {
+                    "access_count": int(self.access_count[row]),
+                    "last_accessed": float(self.last_accessed[row]),
+                }
+                for row in rows
+            ]
+        return ids, metadatas
+
+    def retention_scores(self, now=None):
+        """全部记忆的保留分数，访问越多、越新、越重要的记忆分数越高"""
+        now = time.time() if now is None else now
+        with self.lock:
+            size = len(self.ids)
+            rows = np.arange(size)
+            access = np.log1p(self.access_count[:size])
+            scores = self._weights(rows, now) * (1.0 + self.access_weight * access)
+            idle = now - self.last_accessed[:size]
+        return scores, idle
+
+    def eviction_candidates(self, ttl=None, threshold=None, capacity=None, now=None):
+        """选出需要淘汰的记忆ID
+
+        超过ttl秒未被访问且保留分数低于threshold的记忆淘汰；淘汰后某个用户的记忆数仍超过
+        capacity时，再按保留分数从低到高淘汰该用户的记忆，一个用户的记忆多不会挤掉其他用户的记忆。
+        ttl或capacity为0表示不限制。
+        """
+        ttl = Config.MEMORY_TTL_DAYS * _DAY if ttl is None else ttl
+        threshold = Config.MEMORY_EVICTION_THRESHOLD if threshold is None else threshold
+        capacity = Config.MEMORY_MAX_PER_USER if capacity is None else capacity
+        scores, idle = self.retention_scores(now)
+
+        evict = np.zeros(len(scores), dtype=bool)
+        if ttl > 0:
+            evict |= (idle > ttl) & (scores < threshold)
+        if capacity > 0:
+            with self.lock:
+                user_rows = [np.asarray(rows, dtype=np.int64) for rows in self.user_rows.values()]
+            for rows in user_rows:
+                rows = rows[rows < len(scores)]
+                remaining = rows[~evict[rows]]
+                excess = len(remaining) - capacity
+                if excess > 0:
+                    lowest = remaining[np.argpartition(scores[remaining], excess - 1)[:excess]]
+                    evict[lowest] = True
+        return [self.ids[row] for row in np.flatnonzero(evict)]
+
+    def stats(self):
+        """返回记忆数、待写回数和平均访问次数"""
+        with self.lock:
+            size = len(self.ids)
+            return {
+                "memories": size,
+                "dirty": len(self.dirty),
+                "mean_access_count": float(self.access_count[:size].mean()) if size else 0.0,
+            }
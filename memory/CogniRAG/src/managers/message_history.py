@@ -1,70 +1,159 @@
 """对话历史管理模块，用于记录和处理对话历史"""
 
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, trim_messages
+import os
+import json
+from collections import deque
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from config.config import Config
+from config.logging_config import get_logger
+
+logger = get_logger("session")
 
 
 class MessageHistory:
-    """消息历史管理类，处理当前对话历史"""
+    """消息历史管理类，处理当前对话历史
+
+    非系统消息连同其token数保存在双端队列中，token数在消息加入时用语言模型分词器
+    计算一次并累加到总数。超出token预算或轮数上限时从最旧的一端整轮（用户消息及其回答）
+    弹出，每条消息最多入队出队各一次。尚未回答的最新提问即使单独超出预算也会保留。
+    to_string的结果缓存到下一次修改。
+
+    启用滚动摘要时，被弹出的历史行暂存在evicted中，由回答后处理阶段取走并合并进摘要；
+    摘要放在to_string输出的最前面。
+    """
 
-    def __init__(self):
-        self.messages = []
-        self.k = Config.MAX_HISTORY_ROUNDS  # 保存最近一轮完整对话
+    def __init__(self, tokenizer=None, max_tokens=None, max_rounds=None, keep_evicted=None):
+        self.tokenizer = tokenizer  # 为None时按字符数估算
+        self.max_tokens = Config.MAX_HISTORY_TOKENS if max_tokens is None else max_tokens
+        self.k = Config.MAX_HISTORY_ROUNDS if max_rounds is None else max_rounds
+        self.keep_evicted = Config.HISTORY_SUMMARY_ENABLED if keep_evicted is None else keep_evicted
+        self.system_message = SystemMessage(content=Config.SYSTEM_MESSAGE)
 
-        # 添加系统消息
-        self.messages.insert(0, SystemMessage(content=Config.SYSTEM_MESSAGE))
+        self.entries = deque()  # (消息, 行文本, token数)
+        self.total_tokens = 0
+        self.user_messages = 0  # 队列中的用户消息数，即轮数
+        self.summary = ""  # 移出窗口的轮次的滚动摘要
+        self.evicted = []  # 已移出窗口、尚未合并进摘要的历史行
+        self._string = None  # to_string的缓存
+
+    @property
+    def messages(self):
+        """系统消息加上窗口内的对话消息"""
+        return [self.system_message] + [message for message, _, _ in self.entries]
+
+    def count_tokens(self, text):
+        """计算一行历史文本的token数"""
+        if self.tokenizer is None:
+            return len(text)
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
 
     def add_user_message(self, message):
         """添加用户消息"""
-        self.messages.append(HumanMessage(content=message))
+        self._append(HumanMessage(content=message), f"用户: {message}")
+        self.user_messages += 1
         self._trim_history()
 
     def add_ai_message(self, message):
         """添加AI消息"""
-        self.messages.append(AIMessage(content=message))
+        self._append(AIMessage(content=message), f"助手: {message}")
         self._trim_history()
-        
+
+    def _append(self, message, line):
+        tokens = self.count_tokens(line)
+        self.entries.append((message, line, tokens))
+        # 换行符按一个token计
+        self.total_tokens += tokens + 1
+        self._string = None
+
+    def _pop_round(self):
+        """弹出最旧的一轮：一条用户消息及其后的AI消息"""
+        message, line, tokens = self.entries.popleft()
+        self.total_tokens -= tokens + 1
+        if isinstance(message, HumanMessage):
+            self.user_messages -= 1
+        if self.keep_evicted:
+            self.evicted.append(line)
+        # 连续弹出直到下一轮的用户消息，保证窗口总是从用户消息开始
+        while self.entries and not isinstance(self.entries[0][0], HumanMessage):
+            _, line, tokens = self.entries.popleft()
+            self.total_tokens -= tokens + 1
+            if self.keep_evicted:
+                self.evicted.append(line)
+
+    def take_evicted(self):
+        """取走尚未合并进摘要的历史行"""
+        evicted, self.evicted = self.evicted, []
+        return evicted
+
+    def set_summary(self, summary):
+        """更新滚动摘要"""
+        self.summary = summary
+        self._string = None
+
     def _trim_history(self):
-        """裁剪历史消息，只保留系统消息和最近k轮对话"""
-        # 保留系统消息
-        system_messages = [msg for msg in self.messages if isinstance(msg, SystemMessage)]
-        
-        # 获取用户和AI消息（非系统消息）
-        non_system_messages = [msg for msg in self.messages if not isinstance(msg, SystemMessage)]
-        
-        # 如果非系统消息超过2*k条（k轮完整对话 = k个用户消息 + k个AI消息）
-        if len(non_system_messages) > 2 * self.k:
-            # 只保留最近的2*k条非系统消息
-            non_system_messages = non_system_messages[-2 * self.k:]
-            
-        # 重新组合消息列表
-        self.messages = system_messages + non_system_messages
+        """裁剪历史消息，只保留token预算和轮数上限内的最近几轮对话"""
+        while self.entries and (
+            self.total_tokens > self.max_tokens or self.user_messages > self.k
+        ):
+            # 只剩正在处理的提问时不再弹出
+            if self.user_messages <= 1 and isinstance(self.entries[-1][0], HumanMessage):
+                break
+            self._pop_round()
+            self._string = None
 
     def get_trimmed_messages(self):
-        """获取经过trim处理的消息列表"""
-        return trim_messages(
-            self.messages,
-            token_counter=len,  # 使用消息数量而非token数
-            max_tokens=self.k * 2,  # 一轮对话包含一个用户消息和一个AI消息
-            strategy="last",  # 保留最后的消息
-            start_on="human",  # 确保历史从人类消息开始
-            include_system=True,  # 保留系统消息(如果有)
-            allow_partial=False,  # 不允许部分对话(确保问答对完整)
-        )
+        """获取经过裁剪的消息列表（系统消息加上窗口内的完整对话）"""
+        return self.messages
 
     def to_string(self):
-        """将消息历史转换为字符串形式"""
-        context = []
-        # 只获取非系统消息
-        non_system_messages = [msg for msg in self.messages if not isinstance(msg, SystemMessage)]
-        for msg in non_system_messages:
-            if isinstance(msg, HumanMessage):
-                context.append(f"用户: {msg.content}")
-            elif isinstance(msg, AIMessage):
-                context.append(f"助手: {msg.content}")
-        return "\n".join(context)
+        """将消息历史转换为字符串形式，有滚动摘要时放在最前面"""
+        if self._string is None:
+            lines = [line for _, line, _ in self.entries]
+            if self.summary:
+                lines.insert(0, f"早前对话摘要: {self.summary}")
+            self._string = "\n".join(lines)
+        return self._string
 
     def clear(self):
         """清空消息历史"""
-        self.messages = [SystemMessage(content=Config.SYSTEM_MESSAGE)]
-        self.previous_qa_pair = None
+        self.entries.clear()
+        self.total_tokens = 0
+        self.user_messages = 0
+        self.summary = ""
+        self.evicted = []
+        self._string = None
+
+    def save(self, path):
+        """把非系统消息、滚动摘要和尚未合并的历史行写入文件，会话被换出内存时调用"""
+        records = [
+            {"role": "user" if isinstance(msg, HumanMessage) else "assistant", "content": msg.content}
+            for msg, _, _ in self.entries
+        ]
+        data = {"summary": self.summary, "evicted": self.evicted, "messages": records}
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_file, path)
+
+    def load(self, path):
+        """从文件恢复消息历史，文件不存在时保持为空"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        except json.JSONDecodeError:
+            logger.warning("读取对话历史%s失败，使用空历史", path)
+            return
+        self.clear()
+        # 旧格式的文件只有消息列表
+        if isinstance(records, dict):
+            self.summary = records.get("summary", "")
+            self.evicted = list(records.get("evicted", [])) if self.keep_evicted else []
+            records = records.get("messages", [])
+        for record in records:
+            content = record.get("content", "")
+            if record.get("role") == "user":
+                self.add_user_message(content)
+            else:
+                self.add_ai_message(content)
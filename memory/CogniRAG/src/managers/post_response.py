@@ -0,0 +1,103 @@
+"""回答后处理模块，回答返回后在后台按会话顺序执行画像持久化和记忆写入"""
+
+import atexit
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from config.logging_config import get_logger
+
+logger = get_logger("session")
+
+
+class PostResponseStage:
+    """回答后的后台任务阶段
+
+    任务按会话排队：同一会话的任务严格按提交顺序串行执行，不同会话的任务在线程池中并行。
+    下一轮开始前调用barrier，保证能读到上一轮的全部写入。
+    """
+
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="post-response")
+        self.lock = threading.Lock()
+        self.queues = {}  # session_id -> 待执行任务队列
+        self.running = set()  # 正在执行任务的会话
+        self.last_futures = {}  # session_id -> 最后提交任务的Future
+        self.closed = False
+
+        self.tasks = 0
+        self.task_time = 0.0
+        self.barrier_wait = 0.0
+
+        # 进程退出前执行完剩余任务
+        atexit.register(self.close)
+
+    def submit(self, session_id, func, *args, **kwargs):
+        """提交会话任务，返回Future"""
+        if self.closed:
+            raise RuntimeError("回答后处理阶段已关闭")
+        future = Future()
+        with self.lock:
+            self.queues.setdefault(session_id, deque()).append((func, args, kwargs, future))
+            self.last_futures[session_id] = future
+            if session_id in self.running:
+                return future
+            self.running.add(session_id)
+        self.executor.submit(self._drain, session_id)
+        return future
+
+    def barrier(self, session_id, timeout=None):
+        """等待会话已提交的任务全部完成，返回等待耗时（秒）"""
+        with self.lock:
+            future = self.last_futures.get(session_id)
+        if future is None or future.done():
+            return 0.0
+        start_time = time.perf_counter()
+        try:
+            future.result(timeout=timeout)
+        except Exception:
+            # 任务异常已在执行时打印，这里只负责等待
+            pass
+        elapsed = time.perf_counter() - start_time
+        self.barrier_wait += elapsed
+        return elapsed
+
+    def close(self):
+        """执行完所有已提交的任务后关闭线程池"""
+        if self.closed:
+            return
+        self.closed = True
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        """返回任务数、平均任务耗时和累计屏障等待时间"""
+        with self.lock:
+            queued = sum(len(tasks) for tasks in self.queues.values())
+        return {
+            "tasks": self.tasks,
+            "queued": queued,
+            "avg_task_ms": self.task_time / self.tasks * 1000 if self.tasks else 0.0,
+            "barrier_wait": self.barrier_wait,
+        }
+
+    def _drain(self, session_id):
+        """依次执行会话队列中的任务，队列为空时释放该会话"""
+        while True:
+            with self.lock:
+                tasks = self.queues.get(session_id)
+                if not tasks:
+                    self.queues.pop(session_id, None)
+                    self.running.discard(session_id)
+                    # 任务已全部完成，释放该会话的记录，会话数很多时内存不随会话数增长
+                    self.last_futures.pop(session_id, None)
+                    return
+                func, args, kwargs, future = tasks.popleft()
+
+            start_time = time.perf_counter()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                logger.error("后台任务执行失败: %s", e)
+                future.set_exception(e)
+            self.tasks += 1
+            self.task_time += time.perf_counter() - start_time
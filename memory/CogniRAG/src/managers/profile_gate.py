@@ -0,0 +1,161 @@
+"""画像门控模块，判断用户输入是否可能包含新的个人信息，决定是否运行画像分析"""
+
+import re
+import time
+import numpy as np
+from config.config import Config
+from config.logging_config import get_logger
+
+logger = get_logger("profile")
+
+
+# 含个人信息的陈述（与评估用例无重叠，避免高估效果）
+FACT_PROTOTYPES = [
+    "我叫李明，今年三十岁",
+    "我是一名软件工程师，在北京工作",
+    "我住在杭州西湖区",
+    "我的爱好是游泳和看书",
+    "我养了一只狗叫旺财",
+    "我毕业于复旦大学",
+    "我喜欢吃甜食，不喜欢吃辣",
+    "我害怕坐船",
+    "明天上午十点有个会议",
+    "下周三上午开会，下午出差",
+    "项目预算200万，团队10个人",
+    "小王负责测试，小李负责设计",
+    "我最近换了工作",
+    "我下个月结婚",
+]
+
+# 不含个人信息的提问或寒暄
+QUESTION_PROTOTYPES = [
+    "我叫什么名字？",
+    "我今年多大？",
+    "我在哪里工作？",
+    "我的爱好是什么？",
+    "明天有什么安排？",
+    "项目预算是多少？",
+    "谁负责测试？",
+    "你好",
+    "今天天气怎么样？",
+    "帮我写一首诗",
+    "你能做什么？",
+    "谢谢你",
+]
+
+# 句末语气词：子句以问号或这些词结尾时才视为提问。疑问词（几、哪、谁、怎么等）也常出现在
+# 陈述中（"我有几个孩子"、"我知道怎么做蛋糕"），不作为提问的依据
+QUESTION_PARTICLES = ("吗", "呢")
+# 子句末尾不影响判断的标点和空白
+_CLAUSE_END_PUNCTUATION = "，。；！,;! \t"
+
+# 按标点切分子句，保留句末标点
+_CLAUSE_PATTERN = re.compile(r"[^，。；！？,;!?\n]+[，。；！？,;!?]?")
+# 陈述子句中的事实信号：以第一人称开头、含冒号列举或含数字
+_FACT_SIGNAL_PATTERN = re.compile(r"^\s*我|[：:]|\d")
+
+
+class ProfileFactGate:
+    """画像分析门控：规则 + 原型向量相似度
+
+    先按子句做规则判断：全是提问的输入直接跳过，含事实信号的陈述直接分析；
+    规则无法判断时，用输入的嵌入向量与两组原型向量的最大相似度之差决定。
+    拿不准时倾向于运行分析，漏掉事实比多一次生成代价更高。
+    """
+
+    def __init__(self, model_interface, margin=None):
+        self.model_interface = model_interface
+        self.margin = Config.PROFILE_GATE_MARGIN if margin is None else margin
+        self.fact_prototypes = None
+        self.question_prototypes = None
+
+        self.rule_decisions = 0
+        self.embedding_decisions = 0
+        self.skipped = 0
+        self.decision_time = 0.0
+
+    def _load_prototypes(self):
+        """计算原型向量（首次需要时计算，之后命中嵌入缓存）"""
+        embeddings = np.asarray(
+            self.model_interface.get_embeddings_batch(FACT_PROTOTYPES + QUESTION_PROTOTYPES),
+            dtype=np.float32,
+        )
+        self.fact_prototypes = embeddings[: len(FACT_PROTOTYPES)]
+        self.question_prototypes = embeddings[len(FACT_PROTOTYPES):]
+
+    @staticmethod
+    def classify_by_rules(user_input):
+        """按子句规则判断，以问号或句末语气词结尾的子句视为提问
+
+        Returns:
+            True 含事实，False 不含事实，None 无法判断
+        """
+        clauses = [clause for clause in _CLAUSE_PATTERN.findall(user_input.strip()) if clause.strip()]
+        if not clauses:
+            return False
+
+        all_questions = True
+        for clause in clauses:
+            ending = clause.rstrip(_CLAUSE_END_PUNCTUATION)
+            is_question = bool(ending) and (ending[-1] in "？?" or ending.endswith(QUESTION_PARTICLES))
+            if is_question:
+                continue
+            all_questions = False
+            if _FACT_SIGNAL_PATTERN.search(clause):
+                return True
+        return False if all_questions else None
+
+    def fact_score(self, embedding):
+        """与事实原型和提问原型的最大相似度之差"""
+        if self.fact_prototypes is None:
+            self._load_prototypes()
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return float(
+            np.max(self.fact_prototypes @ embedding) - np.max(self.question_prototypes @ embedding)
+        )
+
+    def should_analyze(self, user_input, embedding=None):
+        """判断是否需要对本轮输入运行画像分析
+
+        Args:
+            user_input: 用户输入
+            embedding: 已计算好的输入嵌入向量，未提供时在需要时计算
+        """
+        return self.decide(user_input, embedding)[0]
+
+    def decide(self, user_input, embedding=None):
+        """判断是否需要运行画像分析，同时返回门控用到的输入嵌入向量
+
+        规则能判断时不计算嵌入向量，返回的向量为传入值（可能为None）；
+        规则无法判断时计算一次，调用方在记忆检索时复用，避免同一输入再做一次前向计算。
+
+        Returns:
+            (decision, embedding)
+        """
+        start_time = time.perf_counter()
+        decision = self.classify_by_rules(user_input)
+        if decision is not None:
+            self.rule_decisions += 1
+        else:
+            if embedding is None:
+                embedding = self.model_interface.get_embedding(user_input)
+            decision = self.fact_score(embedding) > self.margin
+            self.embedding_decisions += 1
+        elapsed = time.perf_counter() - start_time
+        self.decision_time += elapsed
+
+        if not decision:
+            self.skipped += 1
+            logger.debug("画像门控: 输入不含新的个人信息，跳过画像分析（%.2f ms）", elapsed * 1000)
+        return decision, embedding
+
+    def stats(self):
+        """返回门控统计"""
+        total = self.rule_decisions + self.embedding_decisions
+        return {
+            "decisions": total,
+            "rule_decisions": self.rule_decisions,
+            "embedding_decisions": self.embedding_decisions,
+            "skipped": self.skipped,
+            "avg_decision_ms": self.decision_time / total * 1000 if total else 0.0,
+        }
@@ -0,0 +1,130 @@
+"""画像渲染模块，按token预算选出与当前输入最相关的画像内容写入提示"""
+
+import json
+import threading
+import numpy as np
+from config.config import Config
+
+
+class ProfileRenderer:
+    """按token预算渲染用户画像
+
+    完整画像不超过预算时原样输出（紧凑JSON）；超过时按与当前输入的嵌入相似度
+    加上时间新近度为基本信息字段和事件打分，按分数从高到低选入，直到用完预算。
+    token数用语言模型的分词器计算。事件只会追加，其文本、token数和向量都增量维护，
+    每轮只处理新增事件。
+    """
+
+    def __init__(self, model_interface, token_budget=None, recency_weight=None):
+        self.model_interface = model_interface
+        self.tokenizer = model_interface.tokenizer
+        self.token_budget = Config.PROFILE_TOKEN_BUDGET if token_budget is None else token_budget
+        self.recency_weight = (
+            Config.PROFILE_RECENCY_WEIGHT if recency_weight is None else recency_weight
+        )
+
+        self.event_texts = []
+        self.event_tokens = []
+        self.event_matrix = None  # 前len(event_matrix)个事件的向量
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    def count_tokens(self, text):
+        """用语言模型分词器计算token数"""
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _sync_events(self, events):
+        """增量更新事件文本和token数"""
+        cached = len(self.event_texts)
+        if cached and (len(events) < cached or self._dumps(events[cached - 1]) != self.event_texts[-1]):
+            # 画像被替换（如切换用户），重新计算
+            self.event_texts = []
+            self.event_tokens = []
+            self.event_matrix = None
+            cached = 0
+        for event in events[cached:]:
+            text = self._dumps(event)
+            self.event_texts.append(text)
+            self.event_tokens.append(self.count_tokens(text))
+
+    def _event_embeddings(self):
+        """返回所有事件的向量，只为尚未计算的事件调用嵌入模型"""
+        computed = 0 if self.event_matrix is None else len(self.event_matrix)
+        new_texts = self.event_texts[computed:]
+        if new_texts:
+            vectors = np.asarray(
+                self.model_interface.get_embeddings_batch(new_texts), dtype=np.float32
+            )
+            self.event_matrix = (
+                vectors if self.event_matrix is None else np.vstack([self.event_matrix, vectors])
+            )
+        return self.event_matrix
+
+    @staticmethod
+    def _build(basic_info, keys, events, selected):
+        return {
+            "基本信息": {keys[i]: basic_info[keys[i]] for i in sorted(selected["基本信息"])},
+            "事件": [events[i] for i in sorted(selected["事件"])],
+        }
+
+    def render(self, user_profile, user_input, token_budget=None):
+        """渲染用户画像，返回不超过token预算的紧凑JSON文本"""
+        budget = self.token_budget if token_budget is None else token_budget
+        if budget is None:
+            return self._dumps(user_profile)
+
+        basic_info = user_profile.get("基本信息", {})
+        events = user_profile.get("事件", [])
+        keys = list(basic_info)
+        field_texts = [self._dumps({key: basic_info[key]}) for key in keys]
+        field_tokens = [self.count_tokens(text) for text in field_texts]
+        overhead = self.count_tokens(self._dumps({"基本信息": {}, "事件": []}))
+
+        with self.lock:
+            self._sync_events(events)
+            # 逗号分隔符各算一个token
+            estimate = overhead + sum(field_tokens) + sum(self.event_tokens) + len(keys) + len(events)
+            if estimate <= budget:
+                full_text = self._dumps(user_profile)
+                if self.count_tokens(full_text) <= budget:
+                    return full_text
+
+            # 相似度打分：基本信息字段视为最新，事件按位置线性衰减
+            query = np.asarray(self.model_interface.get_embedding(user_input), dtype=np.float32)
+            scores = []
+            if field_texts:
+                field_matrix = np.asarray(
+                    self.model_interface.get_embeddings_batch(field_texts), dtype=np.float32
+                )
+                scores.extend(
+                    ("基本信息", i, float(score) + self.recency_weight)
+                    for i, score in enumerate(field_matrix @ query)
+                )
+            if events:
+                recency = np.linspace(0.0, 1.0, len(events)) if len(events) > 1 else np.ones(1)
+                event_scores = self._event_embeddings() @ query + self.recency_weight * recency
+                scores.extend(("事件", i, float(score)) for i, score in enumerate(event_scores))
+            event_tokens = list(self.event_tokens)
+
+        scores.sort(key=lambda item: item[2], reverse=True)
+
+        # 按分数贪心选入
+        remaining = budget - overhead
+        selected = {"基本信息": set(), "事件": set()}
+        for section, index, _ in scores:
+            tokens = field_tokens[index] if section == "基本信息" else event_tokens[index]
+            if tokens + 1 <= remaining:
+                selected[section].add(index)
+                remaining -= tokens + 1
+        text = self._dumps(self._build(basic_info, keys, events, selected))
+
+        # 相邻条目合并分词可能略有偏差，超出时去掉分数最低的已选条目
+        lowest_first = [item for item in reversed(scores) if item[1] in selected[item[0]]]
+        while lowest_first and self.count_tokens(text) > budget:
+            section, index, _ = lowest_first.pop(0)
+            selected[section].discard(index)
+            text = self._dumps(self._build(basic_info, keys, events, selected))
+        return text
@@ -0,0 +1,195 @@
+"""检索缓存模块，按线索嵌入向量缓存记忆检索结果"""
+
+import threading
+from collections import OrderedDict, deque
+import numpy as np
+
+
+class _CacheEntry:
+    """单条缓存：线索向量、检索结果、所属用户及其所属的记忆代数"""
+
+    __slots__ = ("embedding", "row", "n_results", "nbytes", "generation", "user_id")
+
+    def __init__(self, embedding, row, n_results, nbytes, generation, user_id=None):
+        self.user_id = user_id
+        self.embedding = embedding
+        self.row = row
+        self.n_results = n_results
+        self.nbytes = nbytes
+        self.generation = generation
+
+
+class RetrievalCache:
+    """语义检索缓存
+
+    - 以用户和量化后的线索嵌入向量为键，同一用户余弦距离在容差内的相近线索同样命中
+    - 按条目数和字节数做LRU淘汰
+    - 每次写入记忆时代数加一；旧代数的条目在命中时用新增记忆的向量复核，
+      新增记忆都低于相似度阈值时检索结果不会改变，条目继续有效，否则视为过期；
+      其他用户新增的记忆不影响条目
+    """
+
+    def __init__(self, max_entries, max_bytes, tolerance, similarity_threshold, history_size=64):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self.similarity_threshold = similarity_threshold
+
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.generation = 0
+        # 最近若干代新增记忆的向量，用于复核旧条目
+        self.history = deque(maxlen=history_size)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self._matrix = None  # 缓存条目向量矩阵，用于相近线索查找
+
+    @staticmethod
+    def _quantize(embedding, n_results, user_id=None):
+        """将规范化向量量化为int8，与用户和结果数一起作为缓存键"""
+        quantized = np.clip(np.rint(embedding * 127), -127, 127).astype(np.int8)
+        return user_id, n_results, quantized.tobytes()
+
+    def get(self, embedding, n_results, user_id=None):
+        """查找缓存，返回检索结果 (ids, documents, distances) 或None"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            key = self._quantize(embedding, n_results, user_id)
+            entry = self.entries.get(key)
+            if entry is None and self.tolerance > 0:
+                key = self._find_near(embedding, n_results, user_id)
+                entry = self.entries.get(key) if key is not None else None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry.generation != self.generation and not self._revalidate(entry):
+                self.stale += 1
+                self._remove(key)
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry.row
+
+    def put(self, embedding, n_results, row, user_id=None):
+        """写入一条检索结果"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        ids, documents, _ = row
+        nbytes = (
+            embedding.nbytes
+            + sum(len(memory_id) for memory_id in ids)
+            + sum(len(doc.encode("utf-8")) for doc in documents)
+            + 8 * len(ids)
+        )
+        with self.lock:
+            key = self._quantize(embedding, n_results, user_id)
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = _CacheEntry(
+                embedding, row, n_results, nbytes, self.generation, user_id
+            )
+            self.total_bytes += nbytes
+            self._matrix = None
+
+            # LRU淘汰，直到满足条目数和字节数上限
+            while self.entries and (
+                len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, embeddings=None, user_ids=None):
+        """记忆集合发生写入，代数加一并记录新增记忆的向量及其所属用户"""
+        with self.lock:
+            self.generation += 1
+            if embeddings is None:
+                # 无法复核，清空历史使所有旧条目过期
+                self.history.clear()
+            else:
+                self.history.append(
+                    (
+                        self.generation,
+                        np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1),
+                        None if user_ids is None else list(user_ids),
+                    )
+                )
+
+    def clear(self):
+        """清空缓存"""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+            self._matrix = None
+
+    def stats(self):
+        """返回命中统计"""
+        lookups = self.hits + self.misses + self.stale
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "revalidated": self.revalidated,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _find_near(self, embedding, n_results, user_id=None):
+        """在同一用户、同一结果数的缓存线索中查找容差范围内最相近的一条"""
+        if not self.entries:
+            return None
+        if self._matrix is None:
+            keys = list(self.entries.keys())
+            scopes = {}
+            for i, key in enumerate(keys):
+                scopes.setdefault(key[:2], []).append(i)
+            self._matrix = (
+                keys,
+                np.stack([self.entries[k].embedding for k in keys]),
+                {scope: np.asarray(rows) for scope, rows in scopes.items()},
+            )
+        keys, matrix, scopes = self._matrix
+        rows = scopes.get((user_id, n_results))
+        if rows is None:
+            return None
+        similarities = matrix[rows] @ embedding
+        best = int(np.argmax(similarities))
+        if 1.0 - similarities[best] > self.tolerance:
+            return None
+        return keys[rows[best]]
+
+    def _revalidate(self, entry):
+        """用条目之后新增的记忆复核条目是否仍然有效"""
+        newer = [
+            (vectors, user_ids)
+            for generation, vectors, user_ids in self.history
+            if generation > entry.generation
+        ]
+        # 历史不完整时无法复核
+        if not self.history or self.history[0][0] > entry.generation + 1 or not newer:
+            return False
+        # 只有同一用户（或所属用户未知）的新增记忆可能改变检索结果，不限用户的条目检查全部新增记忆
+        relevant = [
+            vectors
+            if user_ids is None or entry.user_id is None
+            else vectors[[i for i, user_id in enumerate(user_ids) if user_id == entry.user_id]]
+            for vectors, user_ids in newer
+        ]
+        similarities = np.concatenate(relevant) @ entry.embedding
+        if len(similarities) and similarities.max() >= self.similarity_threshold:
+            return False
+        entry.generation = self.generation
+        self.revalidated += 1
+        return True
+
+    def _remove(self, key):
+        """删除一条缓存"""
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.nbytes
+        self._matrix = None
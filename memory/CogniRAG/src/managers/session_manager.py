@@ -0,0 +1,163 @@
+"""会话管理模块，为每个用户维护独立的画像、对话历史，活跃会话按LRU常驻内存"""
+
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from config.config import Config
+from config.logging_config import get_logger
+from managers.message_history import MessageHistory
+from managers.user_profile import UserProfileManager
+from managers.profile_renderer import ProfileRenderer
+
+logger = get_logger("session")
+
+
+class UserSession:
+    """单个用户的会话状态：画像、对话历史、画像渲染器和本轮待持久化的画像"""
+
+    def __init__(self, user_id, data_file, model_interface):
+        self.user_id = user_id
+        self.user_profile_manager = UserProfileManager(data_file)
+        # 对话历史与画像快照同目录同名
+        self.history_file = os.path.splitext(data_file)[0] + ".history.json"
+        self.conversation_history = MessageHistory(model_interface.tokenizer)
+        self.conversation_history.load(self.history_file)
+        self.profile_renderer = ProfileRenderer(model_interface)
+        self.pending_profile = None  # 本轮合并后待持久化的画像
+
+        self.lock = threading.RLock()  # 同一用户的请求按到达顺序逐轮处理
+        self.refs = 0  # 正在使用该会话的请求数，大于0时不会被换出
+
+    def close(self):
+        """合并画像日志并写出对话历史"""
+        self.user_profile_manager.close()
+        self.conversation_history.save(self.history_file)
+
+
+class SessionManager:
+    """多用户会话管理
+
+    会话在首次访问时从磁盘加载，常驻会话数超过上限时按最近最少使用的顺序换出：
+    先等待该用户的回答后处理任务完成，再合并画像日志、写出对话历史并释放内存。
+    正在处理请求的会话不会被换出。
+    """
+
+    def __init__(self, model_interface, max_sessions=None, post_response_stage=None):
+        self.model_interface = model_interface
+        self.max_sessions = Config.MAX_ACTIVE_SESSIONS if max_sessions is None else max_sessions
+        self.post_response_stage = post_response_stage
+
+        self.sessions = OrderedDict()  # user_id -> UserSession，按最近使用排序
+        self.closing = {}  # 正在换出的user_id -> threading.Event
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def data_file(user_id):
+        """用户画像快照文件路径，默认用户沿用USER_DATA_FILE"""
+        if user_id == Config.DEFAULT_USER_ID:
+            return Config.USER_DATA_FILE
+        session_dir = Config.SESSION_DATA_DIR or os.path.join(
+            os.path.dirname(Config.USER_DATA_FILE), "sessions"
+        )
+        os.makedirs(session_dir, exist_ok=True)
+        # 用户ID只保留文件名安全字符，改写过的加哈希后缀避免冲突
+        name = re.sub(r"[^\w.-]", "_", user_id)
+        if name != user_id:
+            name += "-" + hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:8]
+        return os.path.join(session_dir, f"{name}.json")
+
+    def acquire(self, user_id):
+        """取得用户会话（不在内存时从磁盘加载），使用完毕后需调用release"""
+        while True:
+            with self.lock:
+                closing = self.closing.get(user_id)
+                if closing is None:
+                    session = self.sessions.get(user_id)
+                    if session is not None:
+                        self.hits += 1
+                        self.sessions.move_to_end(user_id)
+                    else:
+                        session = UserSession(user_id, self.data_file(user_id), self.model_interface)
+                        self.sessions[user_id] = session
+                        self.loads += 1
+                    session.refs += 1
+                    break
+            # 该用户的会话正在写回磁盘，等写完再重新加载
+            closing.wait()
+
+        self._evict_over_limit()
+        return session
+
+    def release(self, session):
+        """释放会话引用"""
+        with self.lock:
+            session.refs -= 1
+        self._evict_over_limit()
+
+    @contextmanager
+    def session(self, user_id):
+        """在with块内持有用户会话"""
+        session = self.acquire(user_id)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def _evict_over_limit(self):
+        """换出超出上限的最久未使用会话，跳过正在使用的会话"""
+        with self.lock:
+            victims = []
+            excess = len(self.sessions) - self.max_sessions
+            for user_id, session in self.sessions.items():
+                if excess <= 0:
+                    break
+                if session.refs == 0:
+                    victims.append(session)
+                    excess -= 1
+            for session in victims:
+                del self.sessions[session.user_id]
+                self.closing[session.user_id] = threading.Event()
+                self.evictions += 1
+
+        for session in victims:
+            self._close_session(session)
+
+    def _close_session(self, session):
+        """等待后台写入完成后写回磁盘"""
+        try:
+            if self.post_response_stage is not None:
+                self.post_response_stage.barrier(session.user_id)
+            session.close()
+        except Exception as e:
+            logger.error("写回用户%s的会话失败: %s", session.user_id, e)
+        finally:
+            with self.lock:
+                self.closing.pop(session.user_id).set()
+
+    def close(self):
+        """写回所有常驻会话"""
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+            for session in sessions:
+                self.closing[session.user_id] = threading.Event()
+        for session in sessions:
+            self._close_session(session)
+
+    def stats(self):
+        """返回会话统计"""
+        with self.lock:
+            active = len(self.sessions)
+        return {
+            "active": active,
+            "hits": self.hits,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
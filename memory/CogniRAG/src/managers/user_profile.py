@@ -2,36 +2,126 @@
 
 import os
 import json
-import logging
+import threading
 from config.config import Config
+from config.logging_config import get_logger
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
-logger = logging.getLogger(__name__)
+logger = get_logger("profile")
 
 
 class UserProfileManager:
-    """用户画像管理类，专注于结构化属性的提取和管理"""
+    """用户画像管理类，专注于结构化属性的提取和管理
 
-    @staticmethod
-    def load_data():
-        """从本地文件加载用户数据"""
-        if os.path.exists(Config.USER_DATA_FILE):
+    画像常驻内存，启动时从快照文件和追加日志恢复一次。每轮只把新增的字段和事件
+    作为一行追加到日志，日志累计到PROFILE_COMPACT_INTERVAL条后合并写入快照并清空日志。
+    """
+
+    def __init__(self, data_file=None):
+        self.data_file = data_file or Config.USER_DATA_FILE
+        # 追加日志与快照文件同目录同名
+        self.log_file = os.path.splitext(self.data_file)[0] + ".log.jsonl"
+        self.lock = threading.Lock()
+
+        self.seq = 0  # 最后一条日志记录的序号
+        self.log_records = 0  # 自上次合并以来日志中的记录数
+        self.profile = self._load()
+        self.dirty = self.log_records > 0  # 快照是否落后于日志
+
+        # 已持久化的部分，用于计算增量
+        self.persisted_keys = set(self.profile["基本信息"])
+        self.persisted_events = len(self.profile["事件"])
+
+    def _load(self):
+        """读取快照并重放快照之后的日志记录"""
+        profile = {}
+        if os.path.exists(self.data_file):
             try:
-                with open(Config.USER_DATA_FILE, "r", encoding="utf-8") as f:
-                    return json.load(f)
+                with open(self.data_file, "r", encoding="utf-8") as f:
+                    profile = json.load(f)
             except json.JSONDecodeError:
-                print(f"读取文件{Config.USER_DATA_FILE}失败，创建新的用户数据")
-        return {"基本信息": {}, "事件": []}
+                logger.warning("读取文件%s失败，创建新的用户数据", self.data_file)
+        if not isinstance(profile, dict):
+            profile = {}
+        # 快照中记录了已合并的日志序号，避免重复应用
+        snapshot_seq = profile.pop("_log_seq", 0)
+        profile.setdefault("基本信息", {})
+        profile.setdefault("事件", [])
+
+        self.seq = snapshot_seq
+        if os.path.exists(self.log_file):
+            with open(self.log_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 写入中断留下的不完整行
+                        logger.warning("跳过日志%s中不完整的记录", self.log_file)
+                        continue
+                    if record.get("seq", 0) <= snapshot_seq:
+                        continue
+                    self._apply(profile, record)
+                    self.seq = record["seq"]
+                    self.log_records += 1
+        return profile
 
     @staticmethod
-    def save_data(user_data):
-        """保存用户数据到本地文件"""
-        with open(Config.USER_DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=2)
-        print(f"用户数据已保存到 {Config.USER_DATA_FILE}")
+    def _apply(profile, record):
+        """把一条日志记录应用到画像"""
+        for key, value in record.get("基本信息", {}).items():
+            profile["基本信息"].setdefault(key, value)
+        profile["事件"].extend(record.get("事件", []))
+
+    def load_data(self):
+        """返回内存中的用户画像"""
+        return self.profile
+
+    def save_data(self, user_data):
+        """持久化用户画像：只把自上次保存以来新增的字段和事件追加到日志"""
+        with self.lock:
+            self.profile = user_data
+            basic_info = user_data.get("基本信息", {})
+            events = user_data.get("事件", [])
+            new_basic_info = {
+                key: value for key, value in basic_info.items() if key not in self.persisted_keys
+            }
+            new_events = events[self.persisted_events:]
+            if not new_basic_info and not new_events:
+                return
+
+            self.seq += 1
+            record = {"seq": self.seq, "基本信息": new_basic_info, "事件": new_events}
+            with open(self.log_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+            self.persisted_keys.update(new_basic_info)
+            self.persisted_events = len(events)
+            self.log_records += 1
+            self.dirty = True
+            if self.log_records >= Config.PROFILE_COMPACT_INTERVAL:
+                self._compact()
+        logger.debug("用户数据已追加到 %s", self.log_file)
+
+    def compact(self):
+        """把日志合并进快照文件"""
+        with self.lock:
+            if self.dirty:
+                self._compact()
+
+    def _compact(self):
+        """写入新快照（先写临时文件再替换），然后清空日志"""
+        tmp_file = self.data_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({**self.profile, "_log_seq": self.seq}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.data_file)
+        # 快照已记录序号，即使清空日志前中断，重放时也会跳过已合并的记录
+        open(self.log_file, "w", encoding="utf-8").close()
+        self.log_records = 0
+        self.dirty = False
+        logger.debug("用户数据已合并到 %s", self.data_file)
+
+    def close(self):
+        """退出前合并日志"""
+        self.compact()
 
     @staticmethod
     def is_valid_value(value):
@@ -73,9 +163,33 @@ class UserProfileManager:
 
         return current_data
 
+    @staticmethod
+    def new_fields(current_data, new_data):
+        """返回合并new_data时会新增的 (字段, 值) 列表，与update_data的合并规则一致"""
+        if not new_data:
+            return []
+        existing = current_data.get("基本信息", {})
+        fields = [
+            (key, value)
+            for key, value in (new_data.get("基本信息") or {}).items()
+            if key not in existing and UserProfileManager.is_valid_value(value)
+        ]
+        if isinstance(new_data.get("事件"), dict):
+            fields.extend(
+                (key, value)
+                for key, value in new_data["事件"].items()
+                if UserProfileManager.is_valid_value(value)
+            )
+        return fields
+
     @staticmethod
     def extract_dict_from_response(response):
         """从模型响应中提取字典数据"""
+        try:
+            # 约束解码的输出是合法JSON，直接解析
+            return json.loads(response)
+        except json.JSONDecodeError:
+            pass
         try:
             # 直接尝试将回复解析为JSON
             return json.loads(response.replace("'", '"'))
@@ -91,7 +205,7 @@ class UserProfileManager:
                     dict_str = cleaned_response[start:end]
                     return json.loads(dict_str.replace("'", '"'))
                 except json.JSONDecodeError:
-                    print("提取的字典格式不正确，无法解析")
+                    logger.debug("提取的字典格式不正确，无法解析")
 
-            print("未能从响应中提取字典")
+            logger.debug("未能从响应中提取字典")
             return None
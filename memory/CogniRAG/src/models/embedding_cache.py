@@ -0,0 +1,204 @@
+"""嵌入向量缓存模块，内存LRU + SQLite磁盘两级缓存"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class EmbeddingCache:
+    """两级嵌入向量缓存
+
+    键为 (嵌入模型名, 文本) 的哈希，向量以float32原始字节存储。
+    内存层为LRU，磁盘层为SQLite，跨进程重启仍然有效。
+    磁盘层记录每条向量的最近使用时间，条目数超过disk_max_entries时按最近使用时间
+    删除最旧的条目，留出一成余量避免每次写入都触发清理；disk_max_entries为0表示不限制。
+    两层的命中都会刷新最近使用时间：命中的键先记在内存中，攒够touch_flush_size条、
+    清理磁盘层之前或关闭时批量写回，最常用的向量只在内存层命中也不会被当作最旧的条目删除。
+    """
+
+    def __init__(
+        self, model_name, db_path=None, memory_size=1024, disk_max_entries=0, touch_flush_size=256
+    ):
+        self.model_name = model_name
+        self.memory_size = memory_size
+        self.db_path = db_path
+        self.disk_max_entries = disk_max_entries
+        self.disk_entries = 0
+        self.touch_flush_size = touch_flush_size
+        self.touched = {}  # 命中但尚未写回最近使用时间的键 -> 命中时间
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.conn = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL DEFAULT 0)"
+            )
+            # 旧版本的缓存文件没有最近使用时间列，补上后这些条目视为最旧
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(embeddings)")]
+            if "last_used" not in columns:
+                self.conn.execute(
+                    "ALTER TABLE embeddings ADD COLUMN last_used REAL NOT NULL DEFAULT 0"
+                )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+            self.disk_entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._prune_disk()
+            self.conn.commit()
+
+    def _key(self, text):
+        """计算缓存键"""
+        return hashlib.blake2b(
+            f"{self.model_name}\0{text}".encode("utf-8"), digest_size=16
+        ).digest()
+
+    def get_many(self, texts):
+        """批量查询缓存，未命中的位置为None"""
+        keys = [self._key(text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                vector = self.lru.get(key)
+                if vector is not None:
+                    self.lru.move_to_end(key)
+                    self.memory_hits += 1
+                    results[i] = vector
+                    self._touch(key)
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            # 内存未命中的键一次性从磁盘查询
+            if missing and self.conn is not None:
+                placeholders = ",".join("?" * len(missing))
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    list(missing.keys()),
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    self._remember(key, vector)
+                    self._touch(key)
+                    for i in missing.pop(key):
+                        results[i] = vector
+                        self.disk_hits += 1
+
+            if len(self.touched) >= self.touch_flush_size:
+                self._flush_touched()
+                self.conn.commit()
+
+            self.misses += sum(len(indices) for indices in missing.values())
+
+        return results
+
+    def put_many(self, texts, vectors):
+        """批量写入缓存"""
+        items = []
+        with self.lock:
+            for text, vector in zip(texts, vectors):
+                key = self._key(text)
+                vector = np.ascontiguousarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                items.append((key, vector.tobytes()))
+
+            if self.conn is not None and items:
+                keys = list({key for key, _ in items})
+                placeholders = ",".join("?" * len(keys))
+                existing = self.conn.execute(
+                    f"SELECT COUNT(*) FROM embeddings WHERE key IN ({placeholders})", keys
+                ).fetchone()[0]
+                now = time.time()
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                    [(key, blob, now) for key, blob in items],
+                )
+                self.disk_entries += len(keys) - existing
+                self._prune_disk()
+                self.conn.commit()
+
+    def _touch(self, key):
+        """记录一次命中，调用方持有锁；磁盘层不限制条目数时不需要记录"""
+        if self.conn is not None and self.disk_max_entries > 0:
+            self.touched[key] = time.time()
+
+    def _flush_touched(self):
+        """把记下的命中时间写回磁盘层，调用方持有锁并负责提交"""
+        if not self.touched:
+            return
+        self.conn.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE key = ?",
+            [(last_used, key) for key, last_used in self.touched.items()],
+        )
+        self.touched.clear()
+
+    def _prune_disk(self):
+        """磁盘层超过上限时删除最久未使用的条目，保留上限的九成，调用方持有锁并负责提交"""
+        if self.disk_max_entries <= 0 or self.disk_entries <= self.disk_max_entries:
+            return
+        # 先写回命中时间，只在内存层命中的常用向量不会被当作最旧的条目
+        self._flush_touched()
+        keep = self.disk_max_entries * 9 // 10
+        self.conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (self.disk_entries - keep,),
+        )
+        self.disk_entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _remember(self, key, vector):
+        """写入内存LRU并淘汰最久未使用的向量"""
+        self.lru[key] = vector
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.memory_size:
+            self.lru.popitem(last=False)
+
+    def clear_memory(self):
+        """清空内存层，磁盘层保留"""
+        with self.lock:
+            self.lru.clear()
+
+    def stats(self):
+        """返回命中率和磁盘占用"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        disk_entries = 0
+        disk_bytes = 0
+        if self.conn is not None:
+            with self.lock:
+                disk_entries = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            for suffix in ("", "-wal"):
+                path = self.db_path + suffix
+                if os.path.exists(path):
+                    disk_bytes += os.path.getsize(path)
+        return {
+            "memory_entries": len(self.lru),
+            "disk_entries": disk_entries,
+            "disk_bytes": disk_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """关闭磁盘连接"""
+        if self.conn is not None:
+            with self.lock:
+                self._flush_touched()
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,467 @@
+"""JSON输出解码模块，提供约束解码和JSON对象闭合即停止生成"""
+
+import copy
+import torch
+from transformers import StoppingCriteria, LogitsProcessor
+
+
+class JsonScanState:
+    """逐字符扫描JSON文本，跟踪大括号深度和字符串状态
+
+    字符串内的括号不计入深度；单引号和双引号都视为字符串边界，兼容模型输出的单引号JSON。
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.quote = None  # 当前所在字符串的引号字符，不在字符串内时为None
+        self.escape = False
+        self.started = False
+        self.closed = False
+
+    def feed(self, text):
+        """追加一段文本，返回最外层对象是否已闭合"""
+        for char in text:
+            if self.closed:
+                break
+            if self.quote is not None:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == self.quote:
+                    self.quote = None
+            elif not self.started:
+                # 第一个左括号之前的内容（如前导说明文字）忽略
+                if char == "{":
+                    self.started = True
+                    self.depth = 1
+            elif char in "\"'":
+                self.quote = char
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+        return self.closed
+
+
+class JsonEndCriteria(StoppingCriteria):
+    """生成的第一个JSON对象闭合时停止该序列的生成
+
+    每个解码步只解码新增的token，不重复解码已生成的部分。
+    rows为每个序列是否跟踪的列表，批量中混有非JSON输出时使用，默认全部跟踪。
+    """
+
+    def __init__(self, tokenizer, prompt_length, rows=None):
+        self.tokenizer = tokenizer
+        self.position = prompt_length
+        self.rows = rows
+        self.states = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.states is None:
+            rows = self.rows or [True] * input_ids.shape[0]
+            self.states = [JsonScanState() if tracked else None for tracked in rows]
+
+        new_tokens = input_ids[:, self.position:].tolist()
+        self.position = input_ids.shape[-1]
+        done = []
+        for state, token_ids in zip(self.states, new_tokens):
+            if state is None:
+                done.append(False)
+                continue
+            if not state.closed:
+                state.feed(self.tokenizer.decode(token_ids, skip_special_tokens=True))
+            done.append(state.closed)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class JsonPrefixValidator:
+    """JSON前缀校验器：逐字符推进的下推自动机
+
+    只接受能够继续补全为合法JSON的前缀。给定shape时，顶层对象的键及顺序固定，
+    shape为 ((键, "{" 或 "["), ...)，对应的值必须是对象或数组。
+    """
+
+    MAX_WHITESPACE = 12  # 结构字符之间允许的最大连续空白数（足够两层缩进），避免模型反复输出空白
+    MAX_DEPTH = 8
+
+    _LITERALS = {"t": "rue", "f": "alse", "n": "ull"}
+    _ESCAPES = '"\\/bfnrt'
+    _HEX_DIGITS = "0123456789abcdefABCDEF"
+    _NUMBER_TERMINAL = ("zero", "int", "frac", "exp_digits")
+
+    def __init__(self, shape=None):
+        self.shape = shape
+        self.stack = []  # 尚未闭合的容器："{" 或 "["
+        self.mode = "value"
+        self.whitespace_run = 0
+
+        # 字符串状态
+        self.is_key = False
+        self.escape = False
+        self.unicode_left = 0
+        self.key_buffer = ""
+
+        self.number_state = None
+        self.literal_rest = ""
+        self.top_key_index = 0  # 顶层已完成的键数量
+
+    @property
+    def done(self):
+        return self.mode == "done"
+
+    def copy(self):
+        """复制当前状态，用于试探候选token"""
+        clone = copy.copy(self)
+        clone.stack = list(self.stack)
+        return clone
+
+    def feed(self, text):
+        """追加文本，返回追加后是否仍为合法前缀"""
+        for char in text:
+            if not self._feed_char(char):
+                return False
+        return True
+
+    def closing_suffix(self):
+        """返回把当前前缀补全为合法JSON的最短文本"""
+        clone = self.copy()
+        suffix = []
+        while not clone.done and len(suffix) < 256:
+            char = clone._next_closing_char()
+            if not clone._feed_char(char):
+                break
+            suffix.append(char)
+        return "".join(suffix)
+
+    def _expected_key(self):
+        return self.shape[self.top_key_index][0]
+
+    def _at_top_level(self):
+        """当前是否位于受shape约束的顶层对象内"""
+        return self.shape is not None and len(self.stack) == 1
+
+    def _shape_opener(self):
+        """当前位置要求的值开头字符，不受约束时返回None"""
+        if self.shape is None:
+            return None
+        if not self.stack:
+            return "{"
+        if len(self.stack) == 1 and self.mode == "value":
+            return self.shape[self.top_key_index - 1][1]
+        return None
+
+    def _keys_remaining(self):
+        return self.top_key_index < len(self.shape)
+
+    def _end_value(self):
+        self.mode = "after_value" if self.stack else "done"
+
+    def _feed_char(self, char):
+        mode = self.mode
+        if mode == "string":
+            return self._feed_string_char(char)
+        if mode == "number":
+            if self._feed_number_char(char):
+                return True
+            if self.number_state not in self._NUMBER_TERMINAL:
+                return False
+            # 数字结束，当前字符按值之后的结构字符处理
+            self._end_value()
+            mode = self.mode
+        if mode == "literal":
+            if char != self.literal_rest[0]:
+                return False
+            self.literal_rest = self.literal_rest[1:]
+            if not self.literal_rest:
+                self._end_value()
+            return True
+
+        if char in " \t\n\r":
+            self.whitespace_run += 1
+            return self.whitespace_run <= self.MAX_WHITESPACE
+        self.whitespace_run = 0
+
+        if mode == "done":
+            return False
+        if mode in ("value", "value_or_end"):
+            if mode == "value_or_end" and char == "]":
+                self.stack.pop()
+                self._end_value()
+                return True
+            opener = self._shape_opener()
+            if opener is not None and char != opener:
+                return False
+            return self._start_value(char)
+        if mode in ("key_or_end", "key"):
+            if char == '"':
+                if self._at_top_level() and not self._keys_remaining():
+                    return False
+                self.mode = "string"
+                self.is_key = True
+                self.key_buffer = ""
+                return True
+            if char == "}" and mode == "key_or_end":
+                if self._at_top_level() and self._keys_remaining():
+                    return False
+                self.stack.pop()
+                self._end_value()
+                return True
+            return False
+        if mode == "colon":
+            if char == ":":
+                self.mode = "value"
+                return True
+            return False
+        if mode == "after_value":
+            container = self.stack[-1]
+            if char == ",":
+                if self._at_top_level() and not self._keys_remaining():
+                    return False
+                self.mode = "key" if container == "{" else "value"
+                return True
+            if (char == "}" and container == "{") or (char == "]" and container == "["):
+                if char == "}" and self._at_top_level() and self._keys_remaining():
+                    return False
+                self.stack.pop()
+                self._end_value()
+                return True
+        return False
+
+    def _start_value(self, char):
+        if char in "{[":
+            if len(self.stack) >= self.MAX_DEPTH:
+                return False
+            self.stack.append(char)
+            self.mode = "key_or_end" if char == "{" else "value_or_end"
+            return True
+        if char == '"':
+            self.mode = "string"
+            self.is_key = False
+            return True
+        if char == "-" or char.isdigit():
+            self.mode = "number"
+            self.number_state = None
+            return self._feed_number_char(char)
+        if char in self._LITERALS:
+            self.mode = "literal"
+            self.literal_rest = self._LITERALS[char]
+            return True
+        return False
+
+    def _feed_string_char(self, char):
+        if self.unicode_left:
+            if char not in self._HEX_DIGITS:
+                return False
+            self.unicode_left -= 1
+            return True
+        if self.escape:
+            self.escape = False
+            if char == "u":
+                self.unicode_left = 4
+                return True
+            return char in self._ESCAPES
+        if char == "\\":
+            # 顶层键是固定文本，不允许转义
+            if self.is_key and self._at_top_level():
+                return False
+            self.escape = True
+            return True
+        if char == '"':
+            if self.is_key:
+                if self._at_top_level():
+                    if self.key_buffer != self._expected_key():
+                        return False
+                    self.top_key_index += 1
+                self.mode = "colon"
+            else:
+                self._end_value()
+            return True
+        if ord(char) < 0x20:
+            return False
+        if self.is_key and self._at_top_level():
+            self.key_buffer += char
+            return self._expected_key().startswith(self.key_buffer)
+        return True
+
+    def _feed_number_char(self, char):
+        state = self.number_state
+        digit = char.isdigit() and char.isascii()
+        if state is None:
+            if char == "-":
+                self.number_state = "sign"
+            elif digit:
+                self.number_state = "zero" if char == "0" else "int"
+            else:
+                return False
+        elif state == "sign" and digit:
+            self.number_state = "zero" if char == "0" else "int"
+        elif state in ("zero", "int") and char == ".":
+            self.number_state = "dot"
+        elif state in ("zero", "int", "frac") and char in "eE":
+            self.number_state = "exp"
+        elif state == "int" and digit:
+            pass
+        elif state in ("dot", "frac") and digit:
+            self.number_state = "frac"
+        elif state == "exp" and char in "+-":
+            self.number_state = "exp_sign"
+        elif state in ("exp", "exp_sign", "exp_digits") and digit:
+            self.number_state = "exp_digits"
+        else:
+            return False
+        return True
+
+    def _next_closing_char(self):
+        """补全时下一个字符的选择"""
+        mode = self.mode
+        if mode == "string":
+            if self.unicode_left:
+                return "0"
+            if self.escape:
+                return "n"
+            if self.is_key and self._at_top_level() and self.key_buffer != self._expected_key():
+                return self._expected_key()[len(self.key_buffer)]
+            return '"'
+        if mode == "number" and self.number_state not in self._NUMBER_TERMINAL:
+            return "0"
+        if mode == "literal":
+            return self.literal_rest[0]
+        if mode == "value":
+            return self._shape_opener() or '"'
+        if mode == "value_or_end":
+            return "]"
+        if mode == "key_or_end":
+            return '"' if self._at_top_level() and self._keys_remaining() else "}"
+        if mode == "key":
+            return '"'
+        if mode == "colon":
+            return ":"
+        # after_value，或数字已可结束
+        if self._at_top_level() and self._keys_remaining():
+            return ","
+        return "}" if self.stack[-1] == "{" else "]"
+
+
+class JsonShapeLogitsProcessor(LogitsProcessor):
+    """JSON约束解码：每步只保留能让输出保持为合法JSON前缀的token
+
+    先在得分最高的top_n个候选中校验，都不合法时再按得分顺序扩大范围；
+    剩余生成长度只够补全时，强制输出补全文本，保证结果一定能闭合。
+    shape为列表时按序列分别指定形状，其中为None的序列不做约束。
+    """
+
+    def __init__(self, tokenizer, prompt_length, max_new_tokens, shape=None, top_n=8):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.shape = shape
+        self.top_n = top_n
+        self.special_ids = set(tokenizer.all_special_ids)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.rows = None
+
+        # 统计
+        self.steps = 0
+        self.forced_tokens = 0
+        self.fallback_scans = 0
+
+    def __call__(self, input_ids, scores):
+        if self.rows is None:
+            if isinstance(self.shape, list):
+                shapes = self.shape
+            else:
+                shapes = [self.shape] * input_ids.shape[0]
+            self.rows = [
+                {"validator": JsonPrefixValidator(shape), "offset": 0}
+                if shape is not None or not isinstance(self.shape, list)
+                else None
+                for shape in shapes
+            ]
+
+        generated = input_ids[:, self.prompt_length:].tolist()
+        for row_index, (row, token_ids) in enumerate(zip(self.rows, generated)):
+            if row is None:
+                continue
+            self.steps += 1
+            pending_ids = self._sync(row, token_ids)
+            validator = row["validator"]
+            row_scores = scores[row_index]
+
+            if validator.done:
+                # 对象已闭合，只允许结束符
+                allowed = [self.eos_token_id] if self.eos_token_id is not None else None
+            elif len(token_ids) + self._closing_length(validator) + 1 >= self.max_new_tokens:
+                # 剩余长度只够补全，强制输出补全文本
+                allowed = [self._encode(validator.closing_suffix())[0]]
+                self.forced_tokens += 1
+            else:
+                allowed = self._valid_candidates(validator, pending_ids, row_scores)
+
+            if allowed:
+                mask = torch.full_like(row_scores, float("-inf"))
+                mask[allowed] = 0
+                scores[row_index] = row_scores + mask
+        return scores
+
+    def _sync(self, row, token_ids):
+        """把上一步选出的token推进到校验器，返回尚未构成完整字符的token"""
+        pending_ids = token_ids[row["offset"]:]
+        if not pending_ids:
+            return pending_ids
+        text = self.tokenizer.decode(pending_ids, skip_special_tokens=True)
+        if text.endswith("\ufffd"):
+            # 多字节字符尚未完整，等待后续token
+            return pending_ids
+        row["validator"].feed(text)
+        row["offset"] = len(token_ids)
+        return []
+
+    def _encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _closing_length(self, validator):
+        """补全当前前缀所需的token数"""
+        return len(self._encode(validator.closing_suffix()))
+
+    def _is_valid(self, validator, pending_ids, token_id):
+        """判断追加token后输出是否仍为合法前缀"""
+        if token_id in self.special_ids:
+            return False
+        text = self.tokenizer.decode(pending_ids + [token_id], skip_special_tokens=True)
+        stripped = text.rstrip("\ufffd")
+        if not text:
+            return False
+        trial = validator.copy()
+        if not trial.feed(stripped):
+            return False
+        # 末尾是不完整的多字节字符时，只能出现在字符串内
+        return stripped == text or trial.mode == "string"
+
+    def _valid_candidates(self, validator, pending_ids, row_scores):
+        """返回候选中合法的token"""
+        top_ids = torch.topk(row_scores, min(self.top_n, row_scores.shape[-1])).indices.tolist()
+        allowed = [
+            token_id for token_id in top_ids if self._is_valid(validator, pending_ids, token_id)
+        ]
+        if allowed:
+            return allowed
+
+        # 高分候选都不合法，按得分顺序分块扩大搜索范围
+        self.fallback_scans += 1
+        ranked = torch.argsort(row_scores, descending=True).tolist()
+        for start in range(self.top_n, len(ranked), 1024):
+            for token_id in ranked[start:start + 1024]:
+                if self._is_valid(validator, pending_ids, token_id):
+                    return [token_id]
+        return [self._encode(validator.closing_suffix())[0]]
+
+    def stats(self):
+        """返回约束解码统计"""
+        return {
+            "steps": self.steps,
+            "forced_tokens": self.forced_tokens,
+            "fallback_scans": self.fallback_scans,
+        }
@@ -2,8 +2,30 @@
 
 import torch
 import time
-from transformers import AutoModelForCausalLM, AutoTokenizer, AutoModel
+import threading
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    AutoModel,
+    StoppingCriteriaList,
+    LogitsProcessorList,
+)
 from config.config import Config
+from config.logging_config import get_logger
+from models.embedding_cache import EmbeddingCache
+from models.streaming import (
+    TokenQueueStreamer,
+    CancelCriteria,
+    BatchStreamer,
+    BatchCancelCriteria,
+    IncrementalDecoder,
+)
+from models.prefix_cache import PrefixKVCache
+from models.resource_governor import ResourceGovernor
+from models.json_decoding import JsonEndCriteria, JsonShapeLogitsProcessor
+from models.tracing import tracer
+
+logger = get_logger("generation")
 
 class ModelInterface:
     """模型接口类，封装与模型的交互"""
@@ -22,107 +44,344 @@ class ModelInterface:
         self.model = self.model.to(self.device)
         self.embedding_model = self.embedding_model.to(self.device)
 
-        # 添加嵌入向量缓存
-        self.embedding_cache = {}
+        # 嵌入向量缓存：内存LRU + 磁盘SQLite，键为(嵌入模型名, 文本)的哈希
+        self.embedding_cache = EmbeddingCache(
+            Config.EMBEDDING_MODEL_NAME,
+            db_path=Config.EMBEDDING_CACHE_FILE if Config.EMBEDDING_CACHE_DISK_ENABLED else None,
+            memory_size=Config.EMBEDDING_CACHE_SIZE,
+            disk_max_entries=Config.EMBEDDING_CACHE_DISK_MAX_ENTRIES,
+        )
+
+        # 设备锁：后台线程计算嵌入时，避免与生成同时操作模型
+        self.device_lock = threading.Lock()
+
+        # 最近一次生成的性能统计
+        self.last_generation_stats = {}
+
+        # 固定系统提示的前缀KV缓存，启动时预先计算
+        self.prefix_cache = None
+        if Config.PREFIX_CACHE_ENABLED:
+            self.prefix_cache = PrefixKVCache(Config.MODEL_NAME)
+            self.warmup_prefix_cache()
+
+        # 资源调控：内存超过高水位线时，按代价从低到高释放缓存
+        self.resource_governor = None
+        if Config.RESOURCE_GOVERNOR_ENABLED:
+            self.resource_governor = ResourceGovernor(
+                Config.MEMORY_HIGH_HEADROOM_MB,
+                Config.MEMORY_LOW_HEADROOM_MB,
+                Config.DEVICE_MEMORY_HIGH_HEADROOM_MB,
+                Config.DEVICE_MEMORY_LOW_HEADROOM_MB,
+                check_interval=Config.RESOURCE_CHECK_INTERVAL,
+                max_cooldown=Config.RESOURCE_MAX_COOLDOWN,
+            )
+            self.resource_governor.register_action(
+                "清空嵌入向量内存缓存", self.embedding_cache.clear_memory, priority=10
+            )
+            if self.prefix_cache is not None:
+                self.resource_governor.register_action(
+                    "清空前缀KV缓存", self.prefix_cache.clear, priority=20
+                )
+            self.resource_governor.register_action(
+                "释放加速器缓存", ResourceGovernor.release_accelerator_cache, priority=30
+            )
+            # 模型和前缀缓存都已加载，此时测量基线
+            self.resource_governor.start()
+
+    def generate_response(self, prompt, max_new_tokens=None, json_object=False, json_shape=None):
+        """使用模型生成回复（阻塞），返回完整回复文本
+
+        json_object为True时，输出的JSON对象闭合即停止生成；
+        给定json_shape时进行约束解码，输出保证是符合该形状的合法JSON。
+        """
+        response = "".join(
+            self.generate_response_stream(
+                prompt, max_new_tokens=max_new_tokens, json_object=json_object, json_shape=json_shape
+            )
+        )
+        return self.strip_role_prefix(response.strip())
 
-        # 请求计数器
-        self.request_counter = 0
+    def generate_response_stream(self, prompt, max_new_tokens=None, json_object=False, json_shape=None):
+        """流式生成回复，逐段返回新解码的文本
 
-    def generate_response(self, prompt):
-        """使用模型生成回复"""
-        # 增加请求计数器
-        self.request_counter += 1
+        generate在后台线程运行，新token通过队列传回并增量解码；
+        调用方提前结束迭代时中止生成。结束后记录首token延迟、每token延迟和吞吐。
+        """
+        if max_new_tokens is None:
+            max_new_tokens = Config.MAX_NEW_TOKENS
 
         # 编码输入
-        model_inputs = self.tokenizer.apply_chat_template(
-            prompt, return_tensors="pt", add_generation_prompt=True
-        ).to(self.device)
+        model_inputs = self._encode_prompt(prompt)
 
-        # 生成回复
-        output = self.model.generate(
-            model_inputs,
-            max_new_tokens=Config.MAX_NEW_TOKENS,
-            temperature=Config.TEMPERATURE,
-            top_p=Config.TOP_P,
+        streamer = TokenQueueStreamer()
+        logits_processor, stopping_criteria = self._json_controls(
+            model_inputs.shape[-1], max_new_tokens, json_object, json_shape
+        )
+        stopping_criteria.append(CancelCriteria(streamer))
+        prefix_hits = []
+
+        def run_generate():
+            try:
+                prefix_hits.append(
+                    self.generate_into(
+                        streamer,
+                        prompt,
+                        model_inputs,
+                        max_new_tokens,
+                        logits_processor,
+                        stopping_criteria,
+                    )
+                )
+            except Exception as e:
+                streamer.fail(e)
+
+        start_time = time.perf_counter()
+        thread = threading.Thread(target=run_generate, name="generate", daemon=True)
+        thread.start()
+
+        token_times = []
+        try:
+            yield from self._decode_stream(streamer, token_times)
+        finally:
+            streamer.cancel()
+            thread.join()
+
+        self._record_generation_stats(model_inputs.shape[-1], start_time, token_times)
+        if logits_processor:
+            self.last_generation_stats["constrained"] = logits_processor[0].stats()
+        # 记录到调用方所在阶段的span
+        tracer.annotate(
+            prompt_tokens=model_inputs.shape[-1],
+            new_tokens=len(token_times),
+            prefix_cache_hit=bool(prefix_hits and prefix_hits[0]),
         )
 
-        # 解码回复
-        full_response = self.tokenizer.batch_decode(output, skip_special_tokens=True)[0]
+    def generate_into(
+        self, streamer, prompt, model_inputs, max_new_tokens, logits_processor, stopping_criteria
+    ):
+        """在当前线程执行单条生成，新token交给streamer，返回是否命中前缀KV缓存"""
+        with self.device_lock:
+            # 复用系统提示前缀的KV缓存，只对本轮新增部分做prefill
+            past_key_values = None
+            if self.prefix_cache is not None:
+                past_key_values = self.prefix_cache.lookup(
+                    self.model, self.tokenizer, prompt, model_inputs
+                )
+            self.model.generate(
+                model_inputs,
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                temperature=Config.TEMPERATURE,
+                top_p=Config.TOP_P,
+                streamer=streamer,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+            )
+        return past_key_values is not None
+
+    def _decode_stream(self, streamer, token_times):
+        """从streamer读取新token并增量解码，逐段返回文本，token到达时间追加到token_times
+
+        生成出错时读到结束标记后抛出异常。
+        """
+        decoder = IncrementalDecoder(self.tokenizer)
+        while True:
+            token_ids = streamer.queue.get()
+            if token_ids is None:
+                if streamer.error is not None:
+                    raise streamer.error
+                return
+            token_times.append(time.perf_counter())
+            chunk = decoder.push(token_ids)
+            if chunk:
+                yield chunk
+
+    def generate_responses(self, prompts, max_new_tokens=None, json_object=False, json_shape=None):
+        """多个对话提示编码后作为一个填充批次生成，返回各自的回复文本"""
+        input_ids_list = [self._encode_prompt(prompt) for prompt in prompts]
+        return self.generate_batch(
+            input_ids_list, max_new_tokens=max_new_tokens, json_object=json_object, json_shape=json_shape
+        )
 
-        # 提取assistant响应
-        response = self.extract_assistant_response(full_response)
+    def generate_batch(
+        self, input_ids_list, max_new_tokens=None, json_object=False, json_shape=None, streamers=None
+    ):
+        """批量生成：多个已编码的输入左填充后一次generate，返回各自的回复文本
+
+        Args:
+            input_ids_list: 每个请求的input_ids，形状为 (1, seq_len)
+            max_new_tokens: 最大生成长度，默认使用配置值
+            json_object: 为True时各序列输出的JSON对象闭合即停止，也可按序列给出列表
+            json_shape: 给定时对各序列做JSON约束解码，也可按序列给出列表（None表示不约束）
+            streamers: 按序列给出的TokenQueueStreamer列表（None表示该序列不流式输出），
+                各序列的新token逐步放入对应队列
+        """
+        if max_new_tokens is None:
+            max_new_tokens = Config.MAX_NEW_TOKENS
+
+        # 左填充对齐，使所有序列在同一位置开始生成
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        max_length = max(ids.shape[-1] for ids in input_ids_list)
+        input_ids = torch.full(
+            (len(input_ids_list), max_length), pad_token_id, dtype=torch.long, device=self.device
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for i, ids in enumerate(input_ids_list):
+            length = ids.shape[-1]
+            input_ids[i, max_length - length:] = ids[0]
+            attention_mask[i, max_length - length:] = 1
+
+        logits_processor, stopping_criteria = self._json_controls(
+            max_length, max_new_tokens, json_object, json_shape
+        )
+        batch_streamer = None
+        if streamers is not None and any(streamer is not None for streamer in streamers):
+            # 序列结束后generate以pad补位，结束符和pad都表示该序列已结束
+            stop_token_ids = {pad_token_id}
+            eos_token_id = self.model.generation_config.eos_token_id
+            if eos_token_id is None:
+                eos_token_id = self.tokenizer.eos_token_id
+            if isinstance(eos_token_id, int):
+                eos_token_id = [eos_token_id]
+            stop_token_ids.update(eos_token_id or [])
+            batch_streamer = BatchStreamer(streamers, stop_token_ids)
+            stopping_criteria.append(BatchCancelCriteria(streamers))
+
+        start_time = time.perf_counter()
+        with self.device_lock:
+            output = self.model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max_new_tokens,
+                temperature=Config.TEMPERATURE,
+                top_p=Config.TOP_P,
+                pad_token_id=pad_token_id,
+                streamer=batch_streamer,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+            )
+        elapsed = time.perf_counter() - start_time
+
+        responses = self.tokenizer.batch_decode(output[:, max_length:], skip_special_tokens=True)
+        tracer.annotate(
+            batch_size=len(input_ids_list),
+            prompt_tokens=sum(ids.shape[-1] for ids in input_ids_list),
+            new_tokens=int((output[:, max_length:] != pad_token_id).sum()),
+        )
+        logger.debug(
+            "批量生成 %d 条，输入最长 %d tokens，耗时 %.2f 秒", len(input_ids_list), max_length, elapsed
+        )
 
-        # 检查是否需要清理内存
-        self._check_and_clear_memory()
+        return [self.strip_role_prefix(response.strip()) for response in responses]
+
+    def warmup_prefix_cache(self):
+        """为各角色的系统提示预先计算前缀KV缓存"""
+        start_time = time.time()
+        with self.device_lock:
+            for name, content in Config.ROLE_PROMPT.items():
+                if name.endswith("_SYSTEM"):
+                    self.prefix_cache.build(
+                        self.model, self.tokenizer, {"role": "system", "content": content}
+                    )
+        logger.info("前缀KV缓存预热完成，耗时 %.2f 秒", time.time() - start_time)
+
+    def _json_controls(self, prompt_length, max_new_tokens, json_object, json_shape):
+        """构建JSON输出所需的logits处理器和停止条件
+
+        json_object/json_shape为列表时按序列分别生效。
+        """
+        logits_processor = LogitsProcessorList()
+        stopping_criteria = StoppingCriteriaList()
+        if isinstance(json_shape, list) or isinstance(json_object, list):
+            batch_size = len(json_shape if isinstance(json_shape, list) else json_object)
+            shapes = json_shape if isinstance(json_shape, list) else [json_shape] * batch_size
+            objects = json_object if isinstance(json_object, list) else [json_object] * batch_size
+            rows = [obj or shape is not None for obj, shape in zip(objects, shapes)]
+            if any(shape is not None for shape in shapes):
+                logits_processor.append(
+                    JsonShapeLogitsProcessor(
+                        self.tokenizer,
+                        prompt_length,
+                        max_new_tokens,
+                        shape=shapes,
+                        top_n=Config.CONSTRAINED_DECODING_TOP_N,
+                    )
+                )
+            if any(rows):
+                stopping_criteria.append(JsonEndCriteria(self.tokenizer, prompt_length, rows=rows))
+            return logits_processor, stopping_criteria
+
+        if json_shape is not None:
+            processor = JsonShapeLogitsProcessor(
+                self.tokenizer,
+                prompt_length,
+                max_new_tokens,
+                shape=json_shape,
+                top_n=Config.CONSTRAINED_DECODING_TOP_N,
+            )
+            logits_processor.append(processor)
+        if json_object or json_shape is not None:
+            stopping_criteria.append(JsonEndCriteria(self.tokenizer, prompt_length))
+        return logits_processor, stopping_criteria
+
+    def _encode_prompt(self, prompt):
+        """按对话模板编码输入，返回input_ids张量"""
+        return self.tokenizer.apply_chat_template(
+            prompt, return_tensors="pt", add_generation_prompt=True, return_dict=False
+        ).to(self.device)
 
-        return response
+    def _record_generation_stats(self, prompt_tokens, start_time, token_times):
+        """记录单次生成的首token延迟、平均每token延迟和吞吐"""
+        end_time = time.perf_counter()
+        new_tokens = len(token_times)
+        ttft = token_times[0] - start_time if token_times else end_time - start_time
+        decode_time = token_times[-1] - token_times[0] if new_tokens > 1 else 0.0
+        self.last_generation_stats = {
+            "prompt_tokens": prompt_tokens,
+            "new_tokens": new_tokens,
+            "ttft": ttft,
+            "token_latency": decode_time / (new_tokens - 1) if new_tokens > 1 else 0.0,
+            "tokens_per_second": new_tokens / (end_time - start_time) if new_tokens else 0.0,
+            "total_time": end_time - start_time,
+        }
+        logger.debug(
+            "生成统计: 输入 %d tokens, 输出 %d tokens, 首token %.2f 秒, %.1f tokens/s",
+            prompt_tokens,
+            new_tokens,
+            ttft,
+            self.last_generation_stats["tokens_per_second"],
+        )
 
     def get_embedding(self, text):
         """获取文本的嵌入向量"""
-        # 增加请求计数器
-        self.request_counter += 1
-
-        # 先检查缓存
-        if text in self.embedding_cache:
-            return self.embedding_cache[text]
-
-        # 编码文本
-        inputs = self.embedding_tokenizer(
-            text, return_tensors="pt", padding=True, truncation=True, max_length=512
-        ).to(self.device)
-
-        # 获取嵌入向量
-        with torch.no_grad():
-            outputs = self.embedding_model(**inputs)
-            # 使用平均池化作为句子表示
-            embeddings = self._mean_pooling(outputs, inputs["attention_mask"])
-            # 规范化嵌入向量
-            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
-
-        # 转换为numpy数组
-        embedding = embeddings[0].cpu().numpy().tolist()
-
-        # 添加到缓存
-        self.embedding_cache[text] = embedding
-
-        # 控制缓存大小
-        if len(self.embedding_cache) > Config.EMBEDDING_CACHE_SIZE:
-            # 删除最早添加的缓存项
-            self.embedding_cache.pop(next(iter(self.embedding_cache)))
-
-        # 检查是否需要清理内存
-        self._check_and_clear_memory()
-
-        return embedding
+        return self.get_embeddings_batch([text])[0]
 
     def get_embeddings_batch(self, texts):
-        """批量获取嵌入向量"""
-        # 增加请求计数器
-        self.request_counter += 1
-
+        """批量获取嵌入向量，先查两级缓存，只对未命中的文本做前向计算"""
         if not texts:
             return []
 
-        # 先检查哪些文本已经缓存
-        result_embeddings = []
-        uncached_texts = []
-        uncached_indices = []
+        with tracer.span("embedding", texts=len(texts)) as span:
+            return self._get_embeddings_batch(texts, span)
 
-        for i, text in enumerate(texts):
-            if text in self.embedding_cache:
-                # 如果已缓存，直接使用
-                result_embeddings.append(self.embedding_cache[text])
-            else:
-                # 否则加入待处理列表
-                uncached_texts.append(text)
-                uncached_indices.append(i)
+    def _get_embeddings_batch(self, texts, span):
+        """get_embeddings_batch的实现，缓存命中数记录到span"""
+        final_embeddings = self.embedding_cache.get_many(texts)
+
+        # 未命中的文本去重后再计算
+        uncached_texts = list(
+            dict.fromkeys(text for text, emb in zip(texts, final_embeddings) if emb is None)
+        )
+        span.set(cache_hits=sum(emb is not None for emb in final_embeddings))
 
         # 如果所有文本都已缓存，直接返回
         if not uncached_texts:
-            return result_embeddings
+            return final_embeddings
 
         # 分批处理未缓存的文本
-        batch_embeddings = []
+        computed = {}
         for i in range(0, len(uncached_texts), Config.EMBEDDING_BATCH_SIZE):
             batch_texts = uncached_texts[i:i+Config.EMBEDDING_BATCH_SIZE]
 
@@ -136,64 +395,30 @@ class ModelInterface:
             ).to(self.device)
 
             # 获取嵌入向量
-            with torch.no_grad():
+            with self.device_lock, torch.no_grad():
                 outputs = self.embedding_model(**inputs)
                 # 使用平均池化
                 embeddings = self._mean_pooling(outputs, inputs["attention_mask"])
                 # 规范化
                 embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
 
-            # 将每个嵌入向量添加到结果列表
-            for j, emb in enumerate(embeddings):
-                embedding = emb.cpu().numpy().tolist()
-                batch_embeddings.append(embedding)
-
-                # 添加到缓存
-                self.embedding_cache[uncached_texts[i+j]] = embedding
-
-        # 控制缓存大小
-        while len(self.embedding_cache) > Config.EMBEDDING_CACHE_SIZE:
-            # 删除最早添加的缓存项
-            self.embedding_cache.pop(next(iter(self.embedding_cache)))
+            vectors = embeddings.float().cpu().numpy()
+            self.embedding_cache.put_many(batch_texts, vectors)
+            computed.update(zip(batch_texts, vectors))
 
-        # 将未缓存的嵌入向量按原始顺序插入结果列表
-        final_embeddings = [None] * len(texts)
-        for i, emb in enumerate(result_embeddings):
-            final_embeddings[i] = emb
-
-        for i, idx in enumerate(uncached_indices):
-            final_embeddings[idx] = batch_embeddings[i]
-
-        # 检查是否需要清理内存
-        self._check_and_clear_memory()
+        # 将新计算的嵌入向量按原始顺序填入结果列表
+        for i, text in enumerate(texts):
+            if final_embeddings[i] is None:
+                final_embeddings[i] = computed[text]
 
         return final_embeddings
 
-    def _check_and_clear_memory(self):
-        """检查是否达到清理内存的频率，并在需要时清理内存"""
-        if not Config.MEMORY_CLEAR_ENABLED:
-            return
-
-        if self.request_counter >= Config.MEMORY_CLEAR_FREQUENCY:
-            print("达到内存清理频率，开始清理内存...")
-
-            # 清理PyTorch缓存
-            if torch.cuda.is_available():
-                # 移动模型到CPU
-                self.model = self.model.cpu()
-                self.embedding_model = self.embedding_model.cpu()
-
-                # 清空CUDA缓存
-                torch.cuda.empty_cache()
-                time.sleep(3)
-                # 再次移回GPU
-                self.model = self.model.to(self.device)
-                self.embedding_model = self.embedding_model.to(self.device)
-                
-                print("MPS内存清理完成")
-
-            # 重置计数器
-            self.request_counter = 0
+    def close(self):
+        """停止资源调控线程，关闭嵌入向量磁盘缓存"""
+        if self.resource_governor is not None:
+            self.resource_governor.stop()
+        logger.info("嵌入缓存统计: %s", self.embedding_cache.stats())
+        self.embedding_cache.close()
 
     def get_embedding_dimension(self):
         """获取嵌入向量的维度"""
@@ -211,25 +436,12 @@ class ModelInterface:
         )
 
     @staticmethod
-    def extract_assistant_response(full_response):
-        """从完整回复中提取最后一个assistant的回复内容"""
-        # 查找最后一个assistant标记
-        assistant_marker = "assistant"
-        if assistant_marker in full_response:
-            # 提取最后一个assistant标记后的内容
-            parts = full_response.split(assistant_marker)
-            response = parts[-1].strip()
-            # 移除可能的前缀冒号和空格
-            if response.startswith(":"):
-                response = response[1:].strip()
-        else:
-            response = full_response
-            
-        # 去除可能的角色前缀
+    def strip_role_prefix(response):
+        """去除回复开头可能的角色前缀"""
         prefixes = ["助手:", "助手：", "AI:", "AI："]
         for prefix in prefixes:
             if response.startswith(prefix):
                 response = response[len(prefix):].strip()
                 break
 
-        return response 
\ No newline at end of file
+        return response
@@ -0,0 +1,103 @@
+"""前缀KV缓存模块，复用固定系统提示的past_key_values"""
+
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+
+
+class PrefixKVCache:
+    """系统提示前缀的KV缓存
+
+    对每个系统提示预先计算一次past_key_values，生成时以其副本继续，
+    只需对本轮的用户部分做prefill。键为 (模型名, 渲染后的前缀文本) 的哈希，
+    提示文本或模型变化时自然不会命中旧缓存。
+    """
+
+    def __init__(self, model_name, max_entries=8):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (prefix_ids, past_key_values)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def _render_prefix(self, tokenizer, system_message):
+        """渲染只包含系统消息的对话模板前缀"""
+        return tokenizer.apply_chat_template(
+            [system_message], tokenize=False, add_generation_prompt=False
+        )
+
+    def _key(self, prefix_text):
+        """计算缓存键"""
+        return hashlib.blake2b(
+            f"{self.model_name}\0{prefix_text}".encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+    def build(self, model, tokenizer, system_message):
+        """计算系统消息前缀的KV缓存，已存在时直接返回"""
+        prefix_text = self._render_prefix(tokenizer, system_message)
+        key = self._key(prefix_text)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+
+        prefix_ids = tokenizer(
+            prefix_text, return_tensors="pt", add_special_tokens=False
+        )["input_ids"].to(model.device)
+        with torch.no_grad():
+            outputs = model(prefix_ids, use_cache=True)
+        entry = (prefix_ids[0], outputs.past_key_values)
+
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def lookup(self, model, tokenizer, prompt, input_ids):
+        """为一次生成查找可复用的前缀缓存
+
+        Args:
+            prompt: 对话消息列表，首条为系统消息时才可复用
+            input_ids: 完整输入的token，形状为 (1, seq_len)
+
+        Returns:
+            past_key_values副本，前缀不匹配时返回None
+        """
+        if not prompt or prompt[0].get("role") != "system":
+            return None
+
+        prefix_ids, past_key_values = self.build(model, tokenizer, prompt[0])
+        prefix_length = len(prefix_ids)
+
+        # 对话模板在消息边界处可能合并token，前缀不一致时不复用
+        if input_ids.shape[-1] <= prefix_length or not torch.equal(
+            input_ids[0, :prefix_length], prefix_ids.to(input_ids.device)
+        ):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.saved_tokens += prefix_length
+        # generate会原地扩展缓存，每次生成使用独立副本
+        return copy.deepcopy(past_key_values)
+
+    def clear(self):
+        """清空缓存（模型迁移设备或内存紧张时调用）"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """返回命中统计"""
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "saved_tokens": self.saved_tokens,
+        }
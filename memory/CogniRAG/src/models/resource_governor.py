@@ -0,0 +1,172 @@
+"""资源调控模块，按实际内存占用逐级释放缓存"""
+
+import gc
+import threading
+import time
+from collections import deque
+import psutil
+import torch
+from config.logging_config import get_logger
+
+logger = get_logger("resource")
+
+
+class ResourceGovernor:
+    """内存资源调控器
+
+    后台线程定期读取进程RSS（有加速器时同时读取显存分配器统计），
+    超过高水位线时按代价从低到高依次执行释放动作，降到低水位线以下即停止。
+    水位线不是固定值，而是启动时测得的基线（模型加载和预热完成后的占用）加上余量，
+    这样常驻的模型权重本身不会触发释放。
+    释放全部缓存后仍高于低水位线时，剩余占用视为常驻内存并作为新的基线，
+    同时暂停释放，连续无效时暂停时间按倍数增长，避免反复清空缓存。
+    检查和释放都在后台线程完成，不会阻塞请求。
+    """
+
+    def __init__(self, high_headroom_mb, low_headroom_mb, device_high_headroom_mb=None,
+                 device_low_headroom_mb=None, check_interval=5.0, max_cooldown=3600.0):
+        self.high_headroom_mb = high_headroom_mb
+        self.low_headroom_mb = low_headroom_mb
+        self.device_high_headroom_mb = device_high_headroom_mb
+        self.device_low_headroom_mb = device_low_headroom_mb
+        self.check_interval = check_interval
+        self.max_cooldown = max_cooldown
+
+        self.process = psutil.Process()
+        self.actions = []  # (priority, name, func)，priority越小代价越低
+        self.interventions = deque(maxlen=100)
+        self.lock = threading.Lock()
+
+        self.stop_event = threading.Event()
+        self.thread = None
+        # 基线和水位线（MB），start时测量
+        self.baseline = None
+        self.high_watermark_mb = None
+        self.low_watermark_mb = None
+        self.device_high_watermark_mb = None
+        self.device_low_watermark_mb = None
+        # 连续无效的释放次数和暂停截止时间
+        self.failed_passes = 0
+        self.cooldown_until = 0.0
+
+    def register_action(self, name, func, priority):
+        """注册释放动作，priority越小越先执行"""
+        with self.lock:
+            self.actions.append((priority, name, func))
+            self.actions.sort(key=lambda action: action[0])
+
+    def set_baseline(self, usage=None):
+        """以当前（或给定的）内存占用为基线，重新计算水位线"""
+        usage = self.memory_usage() if usage is None else usage
+        self.baseline = usage
+        self.high_watermark_mb = usage["rss_mb"] + self.high_headroom_mb
+        self.low_watermark_mb = usage["rss_mb"] + self.low_headroom_mb
+        if "device_mb" in usage and self.device_high_headroom_mb is not None:
+            self.device_high_watermark_mb = usage["device_mb"] + self.device_high_headroom_mb
+            self.device_low_watermark_mb = usage["device_mb"] + self.device_low_headroom_mb
+
+    def start(self):
+        """测量基线并启动后台检查线程，应在模型加载和预热完成后调用"""
+        if self.baseline is None:
+            self.set_baseline()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="resource-governor", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """停止后台检查线程"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def memory_usage(self):
+        """读取当前内存占用（MB）：进程RSS，以及加速器上分配器保留的显存"""
+        usage = {"rss_mb": self.process.memory_info().rss / 1024 ** 2}
+        if torch.cuda.is_available():
+            usage["device_mb"] = torch.cuda.memory_reserved() / 1024 ** 2
+        elif hasattr(torch, "mps") and torch.backends.mps.is_available():
+            usage["device_mb"] = torch.mps.driver_allocated_memory() / 1024 ** 2
+        return usage
+
+    def _over(self, usage, rss_limit, device_limit):
+        """判断内存占用是否超过给定水位线"""
+        if usage["rss_mb"] > rss_limit:
+            return True
+        return device_limit is not None and usage.get("device_mb", 0.0) > device_limit
+
+    def check(self):
+        """检查一次内存占用，超过高水位线时执行释放动作"""
+        if time.time() < self.cooldown_until:
+            return
+        if self.baseline is None:
+            self.set_baseline()
+        usage = self.memory_usage()
+        if not self._over(usage, self.high_watermark_mb, self.device_high_watermark_mb):
+            return
+
+        with self.lock:
+            actions = list(self.actions)
+        for _, name, func in actions:
+            start_time = time.perf_counter()
+            func()
+            cost = time.perf_counter() - start_time
+            after = self.memory_usage()
+            self.interventions.append(
+                {"time": time.time(), "action": name, "cost": cost, "before": usage, "after": after}
+            )
+            logger.info(
+                "资源调控: %s，耗时 %.1f ms，RSS %.0f -> %.0f MB%s",
+                name,
+                cost * 1000,
+                usage["rss_mb"],
+                after["rss_mb"],
+                (
+                    f"，显存 {usage['device_mb']:.0f} -> {after['device_mb']:.0f} MB"
+                    if "device_mb" in usage
+                    else ""
+                ),
+            )
+            usage = after
+            if not self._over(usage, self.low_watermark_mb, self.device_low_watermark_mb):
+                self.failed_passes = 0
+                return
+
+        # 缓存已全部释放，剩余占用（如分配器未归还系统的内存）无法再降低
+        self.failed_passes += 1
+        cooldown = min(10 * self.check_interval * 2 ** (self.failed_passes - 1), self.max_cooldown)
+        self.cooldown_until = time.time() + cooldown
+        self.set_baseline(usage)
+        logger.warning(
+            "资源调控: 释放全部缓存后内存仍高于低水位线，以当前RSS %.0f MB为新基线，%.0f 秒内不再释放",
+            usage["rss_mb"],
+            cooldown,
+        )
+
+    def stats(self):
+        """返回当前内存占用、基线、水位线和最近的释放记录"""
+        return {
+            "usage": self.memory_usage(),
+            "baseline": self.baseline,
+            "high_watermark_mb": self.high_watermark_mb,
+            "low_watermark_mb": self.low_watermark_mb,
+            "failed_passes": self.failed_passes,
+            "interventions": list(self.interventions),
+        }
+
+    def _run(self):
+        """后台线程主循环"""
+        while not self.stop_event.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("资源检查失败: %s", e)
+
+    @staticmethod
+    def release_accelerator_cache():
+        """回收Python对象并释放加速器分配器中的空闲缓存"""
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        elif hasattr(torch, "mps") and torch.backends.mps.is_available():
+            torch.mps.empty_cache()
@@ -0,0 +1,311 @@
+"""请求调度模块，将多个调用方的生成和嵌入请求合并为批次执行"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from config.config import Config
+from models.streaming import TokenQueueStreamer, CancelCriteria
+from models.tracing import tracer
+
+
+class _Request:
+    """一次排队中的请求"""
+
+    __slots__ = ("payload", "key", "length", "future", "enqueued_at")
+
+    def __init__(self, payload, key=None, length=0):
+        self.payload = payload
+        self.key = key
+        self.length = length
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """微批处理器：在时间窗口内收集兼容的请求，凑成一批后交给run_batch执行
+
+    兼容条件为key相同且输入长度在length_ratio倍以内，结果通过Future返回给调用方。
+    """
+
+    _STOP = object()
+
+    def __init__(self, name, run_batch, max_batch_size, window_ms, length_ratio=None):
+        self.name = name
+        self.run_batch = run_batch  # 参数为payload列表，返回等长的结果列表
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.length_ratio = length_ratio
+
+        self.queue = queue.Queue()
+        self.pending = []  # 已取出但未能进入当前批次的请求
+
+        self.batches = 0
+        self.requests = 0
+        self.wait_time = 0.0
+
+        self.thread = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self.thread.start()
+
+    def submit(self, payload, key=None, length=0):
+        """提交请求，返回Future"""
+        request = _Request(payload, key, length)
+        self.queue.put(request)
+        return request.future
+
+    def close(self):
+        """处理完已提交的请求后停止"""
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+    def stats(self):
+        """返回队列深度和批次填充率"""
+        return {
+            "queue_depth": self.queue.qsize() + len(self.pending),
+            "batches": self.batches,
+            "requests": self.requests,
+            "avg_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "fill_ratio": self.requests / (self.batches * self.max_batch_size) if self.batches else 0.0,
+            "avg_wait_ms": self.wait_time / self.requests * 1000 if self.requests else 0.0,
+        }
+
+    def _compatible(self, first, other):
+        """判断两个请求能否放入同一批次"""
+        if first.key != other.key:
+            return False
+        if self.length_ratio is None:
+            return True
+        shorter, longer = sorted((max(first.length, 1), max(other.length, 1)))
+        return longer / shorter <= self.length_ratio
+
+    def _run(self):
+        """后台线程主循环"""
+        stopping = False
+        while True:
+            if not self.pending:
+                if stopping:
+                    return
+                request = self.queue.get()
+                if request is self._STOP:
+                    return
+                self.pending.append(request)
+
+            # 以最早的请求为基准，在时间窗口内收集兼容请求
+            first = self.pending[0]
+            deadline = first.enqueued_at + self.window
+            batch = [r for r in self.pending if self._compatible(first, r)][: self.max_batch_size]
+            while len(batch) < self.max_batch_size and not stopping:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is self._STOP:
+                    stopping = True
+                    break
+                self.pending.append(request)
+                if self._compatible(first, request):
+                    batch.append(request)
+
+            self.pending = [r for r in self.pending if r not in batch]
+            self._execute(batch)
+
+    def _execute(self, batch):
+        """执行一个批次并分发结果"""
+        now = time.perf_counter()
+        self.batches += 1
+        self.requests += len(batch)
+        self.wait_time += sum(now - r.enqueued_at for r in batch)
+
+        try:
+            results = self.run_batch([r.payload for r in batch])
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+
+
+class BatchScheduler:
+    """位于ModelInterface之前的调度层
+
+    对外提供与ModelInterface相同的generate_response/generate_response_stream/generate_responses/
+    get_embedding/get_embeddings_batch，多个会话并发调用时自动合并成批次；
+    流式请求与其他请求一起批量生成，每步的新token分发到各自的队列。
+    其余属性和方法直接转发给ModelInterface。
+    """
+
+    def __init__(self, model_interface):
+        self.model_interface = model_interface
+        self.generate_batcher = MicroBatcher(
+            "generate",
+            self._run_generate_batch,
+            max_batch_size=Config.BATCH_MAX_SIZE,
+            window_ms=Config.BATCH_WINDOW_MS,
+            length_ratio=Config.BATCH_LENGTH_RATIO,
+        )
+        self.embedding_batcher = MicroBatcher(
+            "embedding",
+            self._run_embedding_batch,
+            max_batch_size=Config.BATCH_MAX_SIZE,
+            window_ms=Config.BATCH_WINDOW_MS,
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.model_interface, name)
+
+    def _submit_generate(
+        self, prompt, input_ids, max_new_tokens, json_object, json_shape, streamer=None, length=None
+    ):
+        """提交生成请求，返回Future
+
+        JSON约束按序列生效，不影响能否同批；生成长度和采样参数相同的请求才能同批。
+        """
+        max_new_tokens = max_new_tokens or Config.MAX_NEW_TOKENS
+        return self.generate_batcher.submit(
+            (prompt, input_ids, max_new_tokens, json_object, json_shape, streamer),
+            key=(max_new_tokens, Config.TEMPERATURE, Config.TOP_P),
+            length=input_ids.shape[-1] if length is None else length,
+        )
+
+    def generate_response(self, prompt, max_new_tokens=None, json_object=False, json_shape=None):
+        """排队生成回复，阻塞直到所在批次完成"""
+        # 在调用方线程中完成编码，批处理线程只负责前向计算
+        input_ids = self.model_interface._encode_prompt(prompt)
+        future = self._submit_generate(prompt, input_ids, max_new_tokens, json_object, json_shape)
+        return future.result()
+
+    def generate_response_stream(
+        self, prompt, max_new_tokens=None, json_object=False, json_shape=None
+    ):
+        """排队流式生成，所在批次每步解码出的新token逐段返回
+
+        本序列结束即返回，不等待同批其他序列；调用方提前结束迭代时只中止本序列。
+        """
+        input_ids = self.model_interface._encode_prompt(prompt)
+        streamer = TokenQueueStreamer()
+        start_time = time.perf_counter()
+        self._submit_generate(prompt, input_ids, max_new_tokens, json_object, json_shape, streamer)
+
+        token_times = []
+        try:
+            yield from self.model_interface._decode_stream(streamer, token_times)
+        finally:
+            streamer.cancel()
+
+        self.model_interface._record_generation_stats(input_ids.shape[-1], start_time, token_times)
+        tracer.annotate(prompt_tokens=input_ids.shape[-1], new_tokens=len(token_times))
+
+    def generate_responses(self, prompts, max_new_tokens=None, json_object=False, json_shape=None):
+        """多个提示同时排队，返回各自的回复文本
+
+        同一次调用的提示按其中最长的输入长度排队，保证它们能进入同一批次，也能与其他会话的请求合并。
+        """
+        input_ids_list = [self.model_interface._encode_prompt(prompt) for prompt in prompts]
+        objects = json_object if isinstance(json_object, list) else [json_object] * len(prompts)
+        shapes = json_shape if isinstance(json_shape, list) else [json_shape] * len(prompts)
+        length = max(input_ids.shape[-1] for input_ids in input_ids_list)
+        futures = [
+            self._submit_generate(prompt, input_ids, max_new_tokens, obj, shape, length=length)
+            for prompt, input_ids, obj, shape in zip(prompts, input_ids_list, objects, shapes)
+        ]
+        return [future.result() for future in futures]
+
+    def get_embedding(self, text):
+        """排队获取单条嵌入向量"""
+        return self.get_embeddings_batch([text])[0]
+
+    def get_embeddings_batch(self, texts):
+        """排队批量获取嵌入向量"""
+        if not texts:
+            return []
+        return self.embedding_batcher.submit(list(texts)).result()
+
+    def _run_generate_batch(self, payloads):
+        """执行生成批次，流式请求的结果为None"""
+        streamers = [payload[5] for payload in payloads]
+        try:
+            if len(payloads) == 1:
+                return [self._run_single(*payloads[0])]
+            # 同一批次的生成长度相同，JSON约束按序列分别生效
+            responses = self.model_interface.generate_batch(
+                [payload[1] for payload in payloads],
+                max_new_tokens=payloads[0][2],
+                json_object=[payload[3] for payload in payloads],
+                json_shape=[payload[4] for payload in payloads],
+                streamers=streamers,
+            )
+        except Exception as e:
+            # 通知仍在等待token的流式调用方
+            for streamer in streamers:
+                if streamer is not None:
+                    streamer.fail(e)
+            raise
+        return [
+            None if streamer is not None else response
+            for streamer, response in zip(streamers, responses)
+        ]
+
+    def _run_single(self, prompt, input_ids, max_new_tokens, json_object, json_shape, streamer):
+        """批次中只有一个请求时走单条生成"""
+        # 单条生成可以复用系统提示的前缀KV缓存；填充批次各序列的前缀位置不同，无法使用前缀缓存
+        if streamer is None:
+            return self.model_interface.generate_response(
+                prompt,
+                max_new_tokens=max_new_tokens,
+                json_object=json_object,
+                json_shape=json_shape,
+            )
+        logits_processor, stopping_criteria = self.model_interface._json_controls(
+            input_ids.shape[-1], max_new_tokens, json_object, json_shape
+        )
+        stopping_criteria.append(CancelCriteria(streamer))
+        self.model_interface.generate_into(
+            streamer, prompt, input_ids, max_new_tokens, logits_processor, stopping_criteria
+        )
+        return None
+
+    def _run_embedding_batch(self, text_lists):
+        """合并多个请求的文本一次计算嵌入，再按请求拆分"""
+        flat_texts = [text for texts in text_lists for text in texts]
+        embeddings = self.model_interface.get_embeddings_batch(flat_texts)
+        results = []
+        offset = 0
+        for texts in text_lists:
+            results.append(embeddings[offset:offset + len(texts)])
+            offset += len(texts)
+        return results
+
+    def stats(self):
+        """返回各队列的调度统计"""
+        return {
+            "generate": self.generate_batcher.stats(),
+            "embedding": self.embedding_batcher.stats(),
+        }
+
+    def export_prometheus(self):
+        """导出各队列的队列深度、批次填充率和平均等待时间（Prometheus文本格式）"""
+        metrics = (
+            ("queue_depth", "排队中的请求数"),
+            ("fill_ratio", "批次平均填充率（平均批大小 / 最大批大小）"),
+            ("avg_batch_size", "平均批大小"),
+            ("avg_wait_ms", "请求在队列中的平均等待时间（毫秒）"),
+        )
+        stats = self.stats()
+        lines = []
+        for key, help_text in metrics:
+            lines.append(f"# HELP cognirag_scheduler_{key} {help_text}")
+            lines.append(f"# TYPE cognirag_scheduler_{key} gauge")
+            for name, queue_stats in stats.items():
+                value = float(queue_stats[key])
+                lines.append(f'cognirag_scheduler_{key}{{queue="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        """停止调度线程并关闭底层模型接口"""
+        self.generate_batcher.close()
+        self.embedding_batcher.close()
+        self.model_interface.close()
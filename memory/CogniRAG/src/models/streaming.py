@@ -0,0 +1,121 @@
+"""流式生成模块，提供逐token输出（含批量生成时按序列分发）、增量解码和生成中止"""
+
+import queue
+import torch
+from transformers import StoppingCriteria
+from transformers.generation.streamers import BaseStreamer
+
+
+class TokenQueueStreamer(BaseStreamer):
+    """接收generate产生的新token并放入队列，供流式生成器在另一线程读取"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.prompt_skipped = False
+        self.cancelled = False
+        self.error = None
+
+    def put(self, value):
+        """generate首次调用传入的是完整输入，跳过；之后每次传入新生成的token"""
+        if not self.prompt_skipped:
+            self.prompt_skipped = True
+            return
+        self.queue.put(value.view(-1).tolist())
+
+    def end(self):
+        """生成结束"""
+        self.queue.put(None)
+
+    def fail(self, error):
+        """生成出错，读取方读到结束标记后抛出该异常"""
+        self.error = error
+        self.end()
+
+    def cancel(self):
+        """请求中止生成，下一个解码步生效"""
+        self.cancelled = True
+
+
+class CancelCriteria(StoppingCriteria):
+    """流式生成被调用方放弃时中止generate"""
+
+    def __init__(self, streamer):
+        self.streamer = streamer
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],), self.streamer.cancelled, dtype=torch.bool, device=input_ids.device
+        )
+
+
+class BatchStreamer(BaseStreamer):
+    """批量生成时把每步各序列的新token分发给对应调用方的TokenQueueStreamer
+
+    序列生成结束符（或结束后generate补位的pad）即通知该调用方结束，不必等整个批次完成。
+    streamers中为None的序列不流式输出。
+    """
+
+    def __init__(self, streamers, stop_token_ids):
+        self.streamers = streamers
+        self.stop_token_ids = set(stop_token_ids)
+        self.prompt_skipped = False
+        self.finished = [streamer is None for streamer in streamers]
+
+    def put(self, value):
+        """首次传入的是完整输入，跳过；之后每次传入形状为(batch,)的新token"""
+        if not self.prompt_skipped:
+            self.prompt_skipped = True
+            return
+        for row, token_id in enumerate(value.view(-1).tolist()):
+            if self.finished[row]:
+                continue
+            self.streamers[row].queue.put([token_id])
+            if token_id in self.stop_token_ids:
+                self.finished[row] = True
+                self.streamers[row].end()
+
+    def end(self):
+        """批次结束，通知尚未结束的调用方"""
+        for row, streamer in enumerate(self.streamers):
+            if not self.finished[row]:
+                self.finished[row] = True
+                streamer.end()
+
+
+class BatchCancelCriteria(StoppingCriteria):
+    """批量生成中某个调用方放弃流式输出时，只中止对应的序列"""
+
+    def __init__(self, streamers):
+        self.streamers = streamers
+
+    def __call__(self, input_ids, scores, **kwargs):
+        cancelled = [streamer is not None and streamer.cancelled for streamer in self.streamers]
+        return torch.tensor(cancelled, dtype=torch.bool, device=input_ids.device)
+
+
+class IncrementalDecoder:
+    """增量解码：每次只解码最近一小段token，避免重复解码整个输出
+
+    维护prefix_offset/read_offset两个位置，只有新文本完整（末尾不是半个多字节字符）时才输出。
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, new_token_ids):
+        """追加新token，返回可以输出的新文本（可能为空字符串）"""
+        self.token_ids.extend(new_token_ids)
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset], skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:], skip_special_tokens=True
+        )
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
@@ -0,0 +1,234 @@
+"""追踪模块，记录处理流程各阶段的耗时，汇总为直方图并导出为JSON或Prometheus文本格式"""
+
+import time
+import threading
+from collections import deque
+from config.config import Config
+
+
+class Span:
+    """一个阶段的耗时记录，作为上下文管理器使用
+
+    属性中的数值（如token数）和布尔值（如缓存命中）会按阶段累加到计数器。
+    """
+
+    __slots__ = ("tracer", "name", "attrs", "start", "duration", "children")
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = 0.0
+        self.duration = 0.0
+        self.children = []
+
+    def set(self, **attrs):
+        """添加或更新属性"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer._pop(self)
+        return False
+
+    def to_dict(self):
+        """转换为可序列化的字典（含子阶段）"""
+        result = {"name": self.name, "duration": round(self.duration, 6)}
+        if self.attrs:
+            result["attrs"] = dict(self.attrs)
+        if self.children:
+            result["children"] = [child.to_dict() for child in self.children]
+        return result
+
+
+class _NullSpan:
+    """追踪关闭时使用的空操作span"""
+
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Histogram:
+    """单个阶段的耗时直方图和属性累计值"""
+
+    __slots__ = ("counts", "sum", "count", "attrs")
+
+    def __init__(self, bucket_count):
+        self.counts = [0] * (bucket_count + 1)  # 最后一个桶为+Inf
+        self.sum = 0.0
+        self.count = 0
+        self.attrs = {}
+
+
+class Tracer:
+    """阶段追踪器
+
+    每个线程维护自己的span栈，嵌套的span组成树；最外层名为"turn"的span结束时，
+    整棵树保存到最近轮次队列，用于查看单轮耗时分布。所有span的耗时按名称计入直方图。
+    TRACING_ENABLED为False时span()返回空操作对象，开销只有一次属性读取。
+    """
+
+    def __init__(self, buckets=None, recent_turns=None):
+        self.buckets = tuple(Config.TRACING_BUCKETS if buckets is None else buckets)
+        self.recent = deque(
+            maxlen=Config.TRACING_RECENT_TURNS if recent_turns is None else recent_turns
+        )
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def span(self, name, **attrs):
+        """创建一个阶段span，用法：with tracer.span("clue_extraction") as span: ..."""
+        if not Config.TRACING_ENABLED:
+            return _NULL_SPAN
+        return Span(self, name, attrs)
+
+    def annotate(self, **attrs):
+        """给当前线程最内层的span添加属性，供不知道所在阶段的底层调用记录token数等信息"""
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1].attrs.update(attrs)
+
+    def _push(self, span):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        if stack:
+            stack[-1].children.append(span)
+        stack.append(span)
+
+    def _pop(self, span):
+        stack = self.local.stack
+        # 正常情况下span按后进先出退出，这里容忍生成器等导致的乱序
+        if stack and stack[-1] is span:
+            stack.pop()
+        elif span in stack:
+            stack.remove(span)
+        self._record(span)
+        if not stack and span.name == "turn":
+            with self.lock:
+                self.recent.append(span)
+
+    def _record(self, span):
+        """把span计入直方图"""
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if span.duration <= bound:
+                index = i
+                break
+        with self.lock:
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = _Histogram(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.sum += span.duration
+            histogram.count += 1
+            for key, value in span.attrs.items():
+                if isinstance(value, (bool, int, float)):
+                    histogram.attrs[key] = histogram.attrs.get(key, 0) + value
+
+    def last_turn(self):
+        """返回最近一轮的追踪树（字典），没有时返回None"""
+        with self.lock:
+            return self.recent[-1].to_dict() if self.recent else None
+
+    def reset(self):
+        """清空已记录的数据"""
+        with self.lock:
+            self.histograms.clear()
+            self.recent.clear()
+
+    def _quantile(self, histogram, q):
+        """按桶线性插值估算分位数（与Prometheus的histogram_quantile一致）"""
+        if not histogram.count:
+            return 0.0
+        rank = q * histogram.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, histogram.counts):
+            if cumulative + count >= rank and count:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        # 落在+Inf桶中，返回最大的有限上界
+        return self.buckets[-1] if self.buckets else 0.0
+
+    def export_json(self):
+        """导出各阶段的直方图、分位数、属性累计值和最近轮次的追踪树"""
+        with self.lock:
+            stages = {}
+            for name, histogram in self.histograms.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+                stages[name] = {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                    "p50": self._quantile(histogram, 0.5),
+                    "p95": self._quantile(histogram, 0.95),
+                    "buckets": buckets,
+                    "attrs": dict(histogram.attrs),
+                }
+            recent = [span.to_dict() for span in self.recent]
+        return {"stages": stages, "recent_turns": recent}
+
+    def export_prometheus(self):
+        """导出为Prometheus文本格式"""
+        lines = [
+            "# HELP cognirag_stage_duration_seconds 处理流程各阶段耗时",
+            "# TYPE cognirag_stage_duration_seconds histogram",
+        ]
+        attr_lines = []
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(
+                        f'cognirag_stage_duration_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}'
+                    )
+                lines.append(f'cognirag_stage_duration_seconds_sum{{stage="{name}"}} {histogram.sum}')
+                lines.append(f'cognirag_stage_duration_seconds_count{{stage="{name}"}} {histogram.count}')
+                for key, value in sorted(histogram.attrs.items()):
+                    attr_lines.append(
+                        f'cognirag_stage_attribute_total{{stage="{name}",attribute="{key}"}} {float(value)}'
+                    )
+        if attr_lines:
+            lines.append("# HELP cognirag_stage_attribute_total 各阶段数值属性累计值（token数、缓存命中数等）")
+            lines.append("# TYPE cognirag_stage_attribute_total counter")
+            lines.extend(attr_lines)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def summarize(turn):
+        """把一轮的追踪树格式化为一行耗时摘要"""
+        parts = [
+            f"{child['name']} {child['duration']:.2f}s" for child in turn.get("children", [])
+        ]
+        return f"本轮耗时 {turn['duration']:.2f}s: " + ", ".join(parts)
+
+
+# 进程内共享的追踪器
+tracer = Tracer()
@@ -0,0 +1,274 @@
+"""HTTP服务模块，按会话路由对话请求，以SSE流式返回回答"""
+
+import json
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from app import ResponseProcessor
+from config.config import Config
+from config.logging_config import get_logger, setup_logging
+from models.tracing import tracer
+
+logger = get_logger("server")
+
+
+class ChatServer:
+    """对话HTTP服务
+
+    - POST /chat: 请求体 {"session_id": ..., "message": ..., "stream": true}，默认以SSE逐段返回回答
+    - GET /healthz: 存活检查，进程在运行即返回200
+    - GET /readyz: 就绪检查，模型加载完成且未在停止时返回200
+    - GET /metrics: 各阶段耗时直方图（Prometheus文本格式）
+    - GET /traces: 各阶段耗时统计和最近轮次的追踪树（JSON）
+
+    阻塞的模型调用在有界线程池中执行，事件循环只负责收发数据。已接受的请求数达到
+    线程数加排队上限时直接返回503；停止服务时先拒绝新请求，等进行中的请求完成后再释放资源。
+    """
+
+    def __init__(self, workers=None, max_queue=None, drain_timeout=None):
+        self.workers = Config.SERVER_WORKERS if workers is None else workers
+        self.max_queue = Config.SERVER_MAX_QUEUE if max_queue is None else max_queue
+        self.drain_timeout = Config.SERVER_DRAIN_TIMEOUT if drain_timeout is None else drain_timeout
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chat-worker")
+
+        self.processor = None
+        self.loading = None
+        self.ready = False
+        self.draining = False
+        # 以下状态只在事件循环线程中读写
+        self.in_flight = 0  # 已接受、尚未执行完的请求数（含排队中的请求）
+        self.idle = None  # 没有进行中的请求时置位，用于停止时等待
+
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def create_app(self):
+        """创建aiohttp应用"""
+        app = web.Application()
+        app.router.add_post("/chat", self.handle_chat)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/readyz", self.handle_ready)
+        app.router.add_get("/metrics", self.handle_metrics)
+        app.router.add_get("/traces", self.handle_traces)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app):
+        """在线程池中加载模型，加载期间存活检查可以响应，就绪检查返回503"""
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.loading = asyncio.get_running_loop().run_in_executor(self.executor, ResponseProcessor)
+        self.loading.add_done_callback(self._on_loaded)
+
+    def _on_loaded(self, future):
+        """模型加载完成"""
+        if future.cancelled() or future.exception() is not None:
+            logger.error("模型加载失败: %s", future.exception() if not future.cancelled() else "已取消")
+            return
+        self.processor = future.result()
+        self.ready = True
+        logger.info("模型加载完成，服务已就绪")
+
+    async def _on_shutdown(self, app):
+        """停止接受新请求，等待进行中的请求完成"""
+        self.draining = True
+        if self.in_flight:
+            logger.info("服务停止中，等待 %d 个进行中的请求完成", self.in_flight)
+            try:
+                await asyncio.wait_for(self.idle.wait(), timeout=self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("等待超时，仍有 %d 个请求未完成", self.in_flight)
+
+    async def _on_cleanup(self, app):
+        """等待后台写入完成后释放模型"""
+        if self.loading is not None:
+            # 模型仍在加载时等加载结束，再统一释放
+            await asyncio.gather(self.loading, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(None, self._close)
+
+    def _close(self):
+        """关闭线程池并释放模型"""
+        self.executor.shutdown(wait=True)
+        if self.processor is not None:
+            self.processor.close()
+
+    def _submit(self, func, *args):
+        """把阻塞调用交给线程池，执行完成后释放名额"""
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        """请求执行完成（在事件循环线程中回调）"""
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self.idle.set()
+
+    @staticmethod
+    def _unavailable(reason, retry_after=None):
+        headers = {"Retry-After": str(retry_after)} if retry_after is not None else None
+        return web.json_response({"error": reason}, status=503, headers=headers)
+
+    def stats(self):
+        """返回服务统计"""
+        stats = {
+            "ready": self.ready and not self.draining,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - self.workers),
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
+        if self.processor is not None:
+            stats["sessions"] = self.processor.session_manager.stats()
+            if Config.BATCH_SCHEDULER_ENABLED:
+                stats["scheduler"] = self.processor.model_interface.stats()
+        return stats
+
+    async def handle_health(self, request):
+        """存活检查"""
+        return web.json_response({"status": "ok"})
+
+    async def handle_ready(self, request):
+        """就绪检查"""
+        stats = self.stats()
+        return web.json_response(stats, status=200 if stats["ready"] else 503)
+
+    async def handle_metrics(self, request):
+        """Prometheus指标"""
+        text = tracer.export_prometheus()
+        if self.processor is not None and Config.BATCH_SCHEDULER_ENABLED:
+            text += self.processor.model_interface.export_prometheus()
+        return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+    async def handle_traces(self, request):
+        """JSON格式的阶段统计、最近轮次追踪和调度队列统计"""
+        data = tracer.export_json()
+        if self.processor is not None and Config.BATCH_SCHEDULER_ENABLED:
+            data["scheduler"] = self.processor.model_interface.stats()
+        return web.json_response(data)
+
+    async def handle_chat(self, request):
+        """对话接口"""
+        if self.draining:
+            return self._unavailable("服务正在停止")
+        if not self.ready:
+            return self._unavailable("模型尚未加载完成", retry_after=5)
+
+        try:
+            body = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.json_response({"error": "请求体必须是JSON"}, status=400)
+        if not isinstance(body, dict):
+            return web.json_response({"error": "请求体必须是JSON对象"}, status=400)
+        message = body.get("message")
+        if not isinstance(message, str) or not message.strip():
+            return web.json_response({"error": "message不能为空"}, status=400)
+        # 会话ID可以放在请求体或请求头中，都没有时使用默认会话
+        session_id = (
+            body.get("session_id") or request.headers.get("X-Session-Id") or Config.DEFAULT_USER_ID
+        )
+        if not isinstance(session_id, str):
+            return web.json_response({"error": "session_id必须是字符串"}, status=400)
+        # 只接受JSON布尔值，避免字符串"false"被当作真值而返回SSE
+        stream = body.get("stream", True)
+        if not isinstance(stream, bool):
+            return web.json_response({"error": "stream必须是布尔值"}, status=400)
+
+        # 准入控制：线程全忙且排队已满时拒绝，避免请求在队列中无限等待
+        if self.in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            return self._unavailable("请求过多，请稍后重试", retry_after=1)
+        self.in_flight += 1
+        self.idle.clear()
+        self.accepted += 1
+
+        if stream:
+            return await self._stream_chat(request, session_id, message)
+        return await self._complete_chat(session_id, message)
+
+    async def _complete_chat(self, session_id, message):
+        """非流式：等待完整回答后返回JSON"""
+        try:
+            response = await self._submit(self.processor.process_user_input, message, session_id)
+        except Exception as e:
+            self.failed += 1
+            logger.error("处理会话%s的请求失败: %s", session_id, e)
+            return web.json_response({"error": str(e)}, status=500)
+        return web.json_response({"session_id": session_id, "response": response})
+
+    async def _stream_chat(self, request, session_id, message):
+        """流式：在线程池中逐段生成，通过队列交给事件循环以SSE发送"""
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        state = {"cancelled": False}
+
+        def run_turn():
+            # 排队期间客户端已断开则不再处理
+            if state["cancelled"]:
+                return
+            try:
+                for chunk in self.processor.process_user_input_stream(message, user_id=session_id):
+                    loop.call_soon_threadsafe(events.put_nowait, ("delta", {"text": chunk}))
+                loop.call_soon_threadsafe(events.put_nowait, ("done", {"session_id": session_id}))
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, ("error", {"error": str(e)}))
+
+        self._submit(run_turn)
+
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+            }
+        )
+        try:
+            await response.prepare(request)
+            while True:
+                event, data = await events.get()
+                await response.write(
+                    f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+                )
+                if event == "error":
+                    self.failed += 1
+                    logger.error("处理会话%s的请求失败: %s", session_id, data["error"])
+                if event != "delta":
+                    break
+            await response.write_eof()
+        except ConnectionResetError:
+            # 已开始生成的回答继续完成并写入会话，保证对话历史完整
+            state["cancelled"] = True
+            logger.info("会话%s的客户端已断开", session_id)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+        return response
+
+
+def main():
+    """服务入口"""
+    parser = argparse.ArgumentParser(description="CogniRAG HTTP服务")
+    parser.add_argument("--host", type=str, default=Config.SERVER_HOST, help="监听地址")
+    parser.add_argument("--port", type=int, default=Config.SERVER_PORT, help="监听端口")
+    args = parser.parse_args()
+
+    setup_logging()
+    server = ChatServer()
+    # 收到SIGINT/SIGTERM后先执行on_shutdown等待进行中的请求
+    web.run_app(
+        server.create_app(),
+        host=args.host,
+        port=args.port,
+        shutdown_timeout=server.drain_timeout,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""用户画像分析：自由生成 vs JSON约束解码的生成token数、耗时和解析成功率对比"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config.config import Config
+from benchmark_fused_pipeline import load_test_cases
+
+
+def is_valid_profile(result):
+    """解析结果是否符合 {'基本信息': {}, '事件': {}} 形状"""
+    return (
+        isinstance(result, dict)
+        and isinstance(result.get("基本信息"), dict)
+        and isinstance(result.get("事件"), dict)
+    )
+
+
+def run_analyzer(processor, user_input, constrained):
+    """运行一次画像分析，返回(解析结果, 生成token数, 耗时)"""
+    Config.CONSTRAINED_DECODING_ENABLED = constrained
+    start = time.perf_counter()
+    result = processor.analyze_user_info(user_input)
+    elapsed = time.perf_counter() - start
+    return result, processor.model_interface.last_generation_stats.get("new_tokens", 0), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="画像分析约束解码对比")
+    parser.add_argument("--model", type=str, default=Config.MODEL_NAME, help="语言模型名称或路径")
+    parser.add_argument("--only", type=str, nargs="+", help="只运行指定名称的测试用例")
+    args = parser.parse_args()
+
+    # 数据写入临时目录，不影响正式的用户画像和记忆库
+    tmp_dir = tempfile.mkdtemp(prefix="benchmark_constrained_")
+    Config.MODEL_NAME = args.model
+    Config.MEMORY_DB_DIR = os.path.join(tmp_dir, "memory")
+    Config.USER_DATA_FILE = os.path.join(tmp_dir, "user_profile.json")
+    # 贪心解码，两种模式的差异只来自约束
+    Config.TEMPERATURE = None
+    Config.TOP_P = None
+
+    from app import ResponseProcessor
+
+    processor = ResponseProcessor()
+    processor.model_interface.model.generation_config.do_sample = False
+
+    test_cases = load_test_cases()
+    if args.only:
+        test_cases = [case for case in test_cases if case["name"] in args.only]
+    inputs = [step["input"] for case in test_cases for step in case["context_chain"]]
+
+    rows = []
+    for user_input in inputs:
+        free_result, free_tokens, free_time = run_analyzer(processor, user_input, False)
+        constrained_result, constrained_tokens, constrained_time = run_analyzer(
+            processor, user_input, True
+        )
+        rows.append(
+            {
+                "free_tokens": free_tokens,
+                "constrained_tokens": constrained_tokens,
+                "free_time": free_time,
+                "constrained_time": constrained_time,
+                "free_parsed": is_valid_profile(free_result),
+                "constrained_parsed": is_valid_profile(constrained_result),
+                "forced_tokens": processor.model_interface.last_generation_stats.get(
+                    "constrained", {}
+                ).get("forced_tokens", 0),
+            }
+        )
+
+    processor.close()
+
+    free_tokens = sum(row["free_tokens"] for row in rows)
+    constrained_tokens = sum(row["constrained_tokens"] for row in rows)
+    print(f"\n模型: {args.model}，贪心解码，共 {len(rows)} 条输入")
+    print(f"{'模式':<10} {'生成tokens':>10} {'平均tokens':>10} {'总耗时(s)':>10} {'解析成功率':>10}")
+    for name, prefix in (("自由生成", "free"), ("约束解码", "constrained")):
+        print(
+            f"{name:<10} {sum(r[f'{prefix}_tokens'] for r in rows):>10} "
+            f"{np.mean([r[f'{prefix}_tokens'] for r in rows]):>10.1f} "
+            f"{sum(r[f'{prefix}_time'] for r in rows):>10.2f} "
+            f"{np.mean([r[f'{prefix}_parsed'] for r in rows]):>10.0%}"
+        )
+    print(
+        f"节省tokens: {free_tokens - constrained_tokens} "
+        f"({1 - constrained_tokens / max(free_tokens, 1):.0%})，"
+        f"因长度上限强制补全的token: {sum(r['forced_tokens'] for r in rows)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
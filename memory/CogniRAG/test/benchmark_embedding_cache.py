@@ -0,0 +1,71 @@
+"""嵌入向量磁盘缓存的条目数上限和最近使用时间检查
+
+模拟一段访问：少量热点文本反复查询（只在内存层命中），大量冷门文本各查询一次并写入，
+使磁盘层多次超过上限触发清理；重启后统计热点文本在磁盘层的命中率。
+热点文本的最近使用时间随内存层命中写回，不应被当作最旧的条目删除。
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import numpy as np
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from models.embedding_cache import EmbeddingCache
+
+
+def simulate(db_path, max_entries, hot, cold, dimension, memory_size):
+    """热点文本每写入一批冷门文本就查询一次，返回缓存统计"""
+    rng = np.random.default_rng(0)
+    cache = EmbeddingCache(
+        "benchmark", db_path, memory_size=memory_size, disk_max_entries=max_entries
+    )
+    hot_texts = [f"热点{i}" for i in range(hot)]
+    cache.put_many(hot_texts, rng.standard_normal((hot, dimension)))
+
+    batch = max(1, memory_size // 4)
+    for start in range(0, cold, batch):
+        texts = [f"冷门{i}" for i in range(start, min(start + batch, cold))]
+        cache.get_many(hot_texts)
+        if any(vector is None for vector in cache.get_many(texts)):
+            cache.put_many(texts, rng.standard_normal((len(texts), dimension)))
+    stats = cache.stats()
+    cache.close()
+    return hot_texts, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="嵌入向量磁盘缓存清理检查")
+    parser.add_argument("--max-entries", type=int, default=2000, help="磁盘层条目数上限")
+    parser.add_argument("--hot", type=int, default=50, help="热点文本数量")
+    parser.add_argument("--cold", type=int, default=20000, help="冷门文本数量")
+    parser.add_argument("--dimension", type=int, default=512, help="向量维度")
+    parser.add_argument("--memory-size", type=int, default=256, help="内存层容量")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="benchmark_embedding_cache_"), "e.sqlite3")
+    hot_texts, stats = simulate(
+        db_path, args.max_entries, args.hot, args.cold, args.dimension, args.memory_size
+    )
+
+    # 重启后内存层为空，热点文本只能从磁盘层命中
+    cache = EmbeddingCache("benchmark", db_path, memory_size=args.memory_size)
+    survived = sum(vector is not None for vector in cache.get_many(hot_texts))
+    cache.close()
+
+    print(f"磁盘层上限 {args.max_entries} 条，写入 {args.hot + args.cold} 条")
+    print(
+        f"清理后磁盘层 {stats['disk_entries']} 条，{stats['disk_bytes'] / 1024 / 1024:.1f} MB；"
+        f"内存层命中率 {stats['memory_hits'] / max(stats['memory_hits'] + stats['misses'], 1):.0%}"
+    )
+    print(f"重启后热点文本保留 {survived}/{len(hot_texts)} 条")
+    if stats["disk_entries"] > args.max_entries or survived < len(hot_texts):
+        print("检查失败：磁盘层超过上限或热点文本被清理")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""画像分析 + 线索提取：两次生成 vs 合并为一次JSON生成的耗时和提取一致性对比"""
+
+import os
+import ast
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config.config import Config
+
+
+def load_test_cases():
+    """从evaluate_simple.py读取memory_test_cases（静态解析，不导入其依赖）"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "evaluate_simple.py")
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == "memory_test_cases"
+            for target in node.targets
+        ):
+            return ast.literal_eval(node.value)
+    raise ValueError("evaluate_simple.py中未找到memory_test_cases")
+
+
+def flatten_profile(profile):
+    """将画像增量展开为 "路径=值" 集合，用于计算一致性"""
+    items = set()
+
+    def walk(prefix, value):
+        if isinstance(value, dict):
+            for key, sub_value in value.items():
+                walk(f"{prefix}/{key}", sub_value)
+        elif isinstance(value, list):
+            for sub_value in value:
+                walk(prefix, sub_value)
+        else:
+            items.add(f"{prefix}={value}")
+
+    walk("", profile or {})
+    return items
+
+
+def jaccard(a, b):
+    """两个集合的Jaccard相似度，均为空时视为一致"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def run_separate(processor, user_input, user_data):
+    """两次生成：先分析画像，再基于更新后的画像提取线索"""
+    tokens = 0
+    new_user_info = processor.analyze_user_info(user_input)
+    tokens += processor.model_interface.last_generation_stats.get("new_tokens", 0)
+    if new_user_info:
+        user_data = processor.user_profile_manager.update_data(user_data, new_user_info)
+    clues = processor.extract_clues(user_input, user_data)
+    tokens += processor.model_interface.last_generation_stats.get("new_tokens", 0)
+    return new_user_info, clues, user_data, tokens
+
+
+def run_fused(processor, user_input, user_data):
+    """一次生成同时提取画像增量和线索"""
+    new_user_info, clues = processor.analyze_user_info_and_clues(user_input, user_data)
+    tokens = processor.model_interface.last_generation_stats.get("new_tokens", 0)
+    if new_user_info:
+        user_data = processor.user_profile_manager.update_data(user_data, new_user_info)
+    return new_user_info, clues, user_data, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="画像分析与线索提取合并模式对比")
+    parser.add_argument("--model", type=str, default=Config.MODEL_NAME, help="语言模型名称或路径")
+    parser.add_argument("--only", type=str, nargs="+", help="只运行指定名称的测试用例")
+    parser.add_argument("--sample", action="store_true", help="使用配置的采样参数（默认贪心解码以便复现）")
+    args = parser.parse_args()
+
+    # 数据写入临时目录，不影响正式的用户画像和记忆库
+    tmp_dir = tempfile.mkdtemp(prefix="benchmark_fused_")
+    Config.MODEL_NAME = args.model
+    Config.MEMORY_DB_DIR = os.path.join(tmp_dir, "memory")
+    Config.USER_DATA_FILE = os.path.join(tmp_dir, "user_profile.json")
+    if not args.sample:
+        Config.TEMPERATURE = None
+        Config.TOP_P = None
+
+    from app import ResponseProcessor
+
+    processor = ResponseProcessor()
+    if not args.sample:
+        processor.model_interface.model.generation_config.do_sample = False
+
+    test_cases = load_test_cases()
+    if args.only:
+        test_cases = [case for case in test_cases if case["name"] in args.only]
+
+    rows = []
+    for case in test_cases:
+        # 每个用例从空画像开始，两种模式各自累积画像
+        separate_data = {"基本信息": {}, "事件": []}
+        fused_data = {"基本信息": {}, "事件": []}
+        for step in case["context_chain"]:
+            user_input = step["input"]
+
+            start = time.perf_counter()
+            separate_info, separate_clues, separate_data, separate_tokens = run_separate(
+                processor, user_input, separate_data
+            )
+            separate_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            fused_info, fused_clues, fused_data, fused_tokens = run_fused(
+                processor, user_input, fused_data
+            )
+            fused_time = time.perf_counter() - start
+
+            clue_embeddings = processor.model_interface.get_embeddings_batch(
+                [separate_clues, fused_clues]
+            )
+            rows.append(
+                {
+                    "case": case["name"],
+                    "separate_time": separate_time,
+                    "fused_time": fused_time,
+                    "separate_tokens": separate_tokens,
+                    "fused_tokens": fused_tokens,
+                    "separate_parsed": separate_info is not None,
+                    "fused_parsed": fused_info is not None,
+                    "profile_agreement": jaccard(
+                        flatten_profile(separate_info), flatten_profile(fused_info)
+                    ),
+                    "clue_similarity": float(np.dot(clue_embeddings[0], clue_embeddings[1])),
+                }
+            )
+
+    processor.close()
+
+    print(f"\n模型: {args.model}，{'采样' if args.sample else '贪心'}解码")
+    print(
+        f"{'测试用例':<12} {'输入数':>6} {'两次生成(s)':>12} {'合并生成(s)':>12} {'加速比':>8} "
+        f"{'生成tokens':>14} {'解析成功':>12} {'画像一致':>8} {'线索相似':>8}"
+    )
+    for name in list(dict.fromkeys(row["case"] for row in rows)) + ["总计"]:
+        group = [row for row in rows if name in ("总计", row["case"])]
+        separate_time = sum(row["separate_time"] for row in group)
+        fused_time = sum(row["fused_time"] for row in group)
+        tokens = f"{sum(r['separate_tokens'] for r in group)}/{sum(r['fused_tokens'] for r in group)}"
+        parsed = (
+            f"{np.mean([r['separate_parsed'] for r in group]):.0%}/"
+            f"{np.mean([r['fused_parsed'] for r in group]):.0%}"
+        )
+        print(
+            f"{name:<12} {len(group):>6} {separate_time:>12.2f} {fused_time:>12.2f} "
+            f"{separate_time / fused_time:>7.2f}x {tokens:>14} {parsed:>12} "
+            f"{np.mean([r['profile_agreement'] for r in group]):>8.2f} "
+            f"{np.mean([r['clue_similarity'] for r in group]):>8.2f}"
+        )
+
+    result_file = os.path.join(tmp_dir, "results.json")
+    with open(result_file, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    print(f"逐条结果已保存到 {result_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""记忆检索方式对比：向量检索 / BM25关键词检索 / 两者RRF融合的召回率和耗时
+
+语料和标签取自evaluate_simple.py的测试链：带expected_response的陈述步骤作为记忆写入，
+带keywords的提问步骤作为查询，同一测试链中包含任一关键词的记忆为相关记忆。
+默认所有测试链的记忆写入同一个用户，其他测试链的记忆充当干扰项。
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config.config import Config
+from benchmark_fused_pipeline import load_test_cases
+
+
+def build_dataset(test_cases, shared):
+    """返回记忆列表 [(id, 文档, 用户ID)] 和查询列表 [(问题, 用户ID, 相关记忆ID集合)]"""
+    memories = []
+    queries = []
+    for case_index, case in enumerate(test_cases):
+        user_id = "benchmark" if shared else f"case{case_index}"
+        case_memories = []
+        for step_index, step in enumerate(case["context_chain"]):
+            if "expected_response" in step:
+                memory_id = f"case{case_index}-{step_index}"
+                document = json.dumps(
+                    {"用户": step["input"], "助手": step["expected_response"]}, ensure_ascii=False
+                )
+                case_memories.append((memory_id, step["input"]))
+                memories.append((memory_id, document, user_id))
+            elif step.get("keywords"):
+                relevant = {
+                    memory_id
+                    for memory_id, text in case_memories
+                    if any(keyword in text for keyword in step["keywords"])
+                }
+                if relevant:
+                    queries.append((step["input"], user_id, relevant))
+    return memories, queries
+
+
+def extract_clues(model_interface, question):
+    """用线索提取提示生成线索（画像为空），与正式流程的输入一致"""
+    prompt = [
+        {"role": "system", "content": Config.ROLE_PROMPT["CLUE_EXTRACTOR_SYSTEM"]},
+        {
+            "role": "user",
+            "content": Config.ROLE_PROMPT["CLUE_EXTRACTOR_USER"].format(
+                user_profile="{}", user_input=question
+            ),
+        },
+    ]
+    response = model_interface.generate_response(prompt)
+    clues = [line.strip() for line in response.split("\n") if line.strip()]
+    return clues[: Config.MAX_CLUES_TO_PROCESS] or [question]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量/关键词/混合记忆检索的召回率和耗时对比")
+    parser.add_argument("--model", type=str, default=Config.MODEL_NAME, help="语言模型名称或路径")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 3, 5], help="计算recall@k的k值")
+    parser.add_argument("--repeats", type=int, default=20, help="每条查询的计时重复次数")
+    parser.add_argument(
+        "--per-case", action="store_true", help="每条测试链的记忆写入单独的用户（默认共用一个用户）"
+    )
+    parser.add_argument(
+        "--extract-clues", action="store_true", help="先用语言模型提取线索再检索（默认直接用问题检索）"
+    )
+    args = parser.parse_args()
+
+    Config.MODEL_NAME = args.model
+    Config.EMBEDDING_CACHE_FILE = os.path.join(tempfile.mkdtemp(prefix="benchmark_hybrid_"), "e.sqlite3")
+    Config.RESOURCE_GOVERNOR_ENABLED = False
+
+    from models.model_interface import ModelInterface
+    from managers.memory import MemoryManager
+    from managers.flat_index import FlatMemoryIndex
+    from managers.keyword_index import KeywordIndex
+
+    model_interface = ModelInterface()
+    memories, queries = build_dataset(load_test_cases(), shared=not args.per_case)
+    scope = "每条测试链单独用户" if args.per_case else "共用一个用户"
+    print(f"记忆 {len(memories)} 条，查询 {len(queries)} 条，{scope}")
+
+    ids = [memory_id for memory_id, _, _ in memories]
+    documents = [document for _, document, _ in memories]
+    user_ids = [user_id for _, _, user_id in memories]
+    # 与add_memory一致，对序列化后的记忆文本计算嵌入向量
+    embeddings = model_interface.get_embeddings_batch(documents)
+    dimension = model_interface.get_embedding_dimension()
+    flat_index = FlatMemoryIndex(dimension)
+    flat_index.add(ids, embeddings, documents, user_ids)
+
+    keyword_index = KeywordIndex()  # 构造时加载分词词典，不计入构建耗时
+    start = time.perf_counter()
+    keyword_index.add(ids, documents, user_ids)
+    print(
+        f"关键词索引构建 {(time.perf_counter() - start) * 1000:.1f} ms，"
+        f"{len(keyword_index.postings)} 个词项"
+    )
+
+    # 每条查询的线索及其嵌入向量只计算一次，计时只包含检索和融合
+    query_clues = []
+    for question, _, _ in queries:
+        clues = extract_clues(model_interface, question) if args.extract_clues else [question]
+        query_clues.append(clues)
+    start = time.perf_counter()
+    clue_embeddings = [model_interface.get_embeddings_batch(clues) for clues in query_clues]
+    embed_ms = (time.perf_counter() - start) / len(queries) * 1000
+
+    def retrieve(mode, clues, embeddings_, user_id, top_k):
+        larger_top_k = min(top_k * 3, 20)
+        vector_rows = []
+        if mode != "keyword":
+            results = flat_index.query(embeddings_, larger_top_k, user_id=user_id)
+            vector_rows = list(zip(results["ids"], results["documents"], results["distances"]))
+        if mode == "vector":
+            return MemoryManager._merge_query_rows(vector_rows, top_k)
+        results = keyword_index.query(clues, top_k, user_id=user_id)
+        keyword_rows = list(zip(results["ids"], results["documents"], results["scores"]))
+        return MemoryManager._fuse_query_rows(vector_rows, keyword_rows, top_k)
+
+    print(f"\n线索嵌入平均耗时 {embed_ms:.2f} ms/查询（向量和混合检索需要，关键词检索不需要）")
+    header = " ".join(f"{f'recall@{k}':>10}" for k in args.top_k)
+    print(f"{'模式':<8} {header} {f'命中率@{max(args.top_k)}':>10} {'检索耗时(us)':>14}")
+    for mode in ("vector", "keyword", "hybrid"):
+        recalls = {k: [] for k in args.top_k}
+        hits = []
+        for (_, user_id, relevant), clues, embeddings_ in zip(queries, query_clues, clue_embeddings):
+            for k in args.top_k:
+                retrieved = {memory["id"] for memory in retrieve(mode, clues, embeddings_, user_id, k)}
+                recalls[k].append(len(retrieved & relevant) / len(relevant))
+                if k == max(args.top_k):
+                    hits.append(bool(retrieved & relevant))
+
+        top_k = Config.MEMORY_RETRIEVAL_TOP_K
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            for (_, user_id, _), clues, embeddings_ in zip(queries, query_clues, clue_embeddings):
+                retrieve(mode, clues, embeddings_, user_id, top_k)
+        retrieval_us = (time.perf_counter() - start) / (args.repeats * len(queries)) * 1e6
+
+        print(
+            f"{mode:<8} "
+            + " ".join(f"{np.mean(recalls[k]):>10.3f}" for k in args.top_k)
+            + f" {np.mean(hits):>10.3f} {retrieval_us:>14.1f}"
+        )
+
+    model_interface.close()
+
+
+if __name__ == "__main__":
+    main()
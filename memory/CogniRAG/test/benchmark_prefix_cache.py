@@ -0,0 +1,98 @@
+"""系统提示前缀KV缓存的prefill耗时对比（CPU，小型因果语言模型）"""
+
+import os
+import sys
+import copy
+import time
+import argparse
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config.config import Config
+from models.prefix_cache import PrefixKVCache
+
+
+# 每个角色的示例用户输入
+SAMPLE_USER_CONTENT = {
+    "USER_PROFILE_ANALYZER": Config.ROLE_PROMPT["USER_PROFILE_ANALYZER_USER"].format(
+        user_input="我叫张三，今年28岁，是一名数据科学家，在字节跳动工作"
+    ),
+    "CLUE_EXTRACTOR": Config.ROLE_PROMPT["CLUE_EXTRACTOR_USER"].format(
+        user_profile='{"基本信息": {"姓名": "张三", "年龄": "28"}, "事件": []}',
+        user_input="我的职业是什么？",
+    ),
+    "RESPONSE_GENERATOR": Config.ROLE_PROMPT["RESPONSE_GENERATOR_USER"].format(
+        context="用户: 我叫张三\n助手: 你好张三",
+        memories="用户: 我是一名数据科学家\n助手: 好的",
+        clues="用户职业",
+        user_input="我的职业是什么？",
+    ),
+}
+
+
+def time_prefill(func, repeats):
+    """多次运行prefill并返回平均耗时（毫秒）"""
+    func()  # 预热
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="前缀KV缓存prefill耗时对比")
+    parser.add_argument(
+        "--model", type=str, default="Qwen/Qwen2.5-0.5B-Instruct", help="小型因果语言模型名称或路径"
+    )
+    parser.add_argument("--repeats", type=int, default=10, help="每组重复次数")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(args.model, trust_remote_code=True).to("cpu")
+    model.eval()
+    prefix_cache = PrefixKVCache(args.model)
+
+    print(f"模型: {args.model}，设备: cpu")
+    print(f"{'角色':<22} {'前缀/总tokens':>14} {'完整prefill(ms)':>16} {'前缀缓存(ms)':>14} {'降低':>8}")
+    for role, user_content in SAMPLE_USER_CONTENT.items():
+        prompt = [
+            {"role": "system", "content": Config.ROLE_PROMPT[f"{role}_SYSTEM"]},
+            {"role": "user", "content": user_content},
+        ]
+        input_ids = tokenizer.apply_chat_template(
+            prompt, return_tensors="pt", add_generation_prompt=True, return_dict=False
+        )
+
+        past_key_values = prefix_cache.lookup(model, tokenizer, prompt, input_ids)
+        if past_key_values is None:
+            print(f"{role:<22} 对话模板在消息边界处合并了token，无法复用前缀")
+            continue
+        prefix_ids, cached = prefix_cache.build(model, tokenizer, prompt[0])
+        prefix_length = len(prefix_ids)
+
+        def full_prefill():
+            with torch.no_grad():
+                model(input_ids, use_cache=True)
+
+        def cached_prefill():
+            # 计入复制缓存的开销，与实际生成路径一致
+            with torch.no_grad():
+                model(
+                    input_ids[:, prefix_length:],
+                    past_key_values=copy.deepcopy(cached),
+                    use_cache=True,
+                )
+
+        full_ms = time_prefill(full_prefill, args.repeats)
+        cached_ms = time_prefill(cached_prefill, args.repeats)
+        print(
+            f"{role:<22} {f'{prefix_length}/{input_ids.shape[-1]}':>14} {full_ms:>16.1f} "
+            f"{cached_ms:>14.1f} {1 - cached_ms / full_ms:>7.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
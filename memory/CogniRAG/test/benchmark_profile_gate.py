@@ -0,0 +1,124 @@
+"""画像门控的精确率/召回率和判断耗时，标签取自evaluate_simple.py的测试链
+
+带expected_response的步骤是陈述新信息的输入（正例），带keywords的步骤是提问（负例）；
+另加几条含疑问词的个人陈述作为正例。
+耗时分别给出不含嵌入计算和包含嵌入计算（嵌入缓存未命中）两种，后者是流水线中门控的实际开销，
+门控算出的输入嵌入向量随后在记忆检索时复用。
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config.config import Config
+from benchmark_fused_pipeline import load_test_cases
+
+# 含疑问词的个人陈述（正例），疑问词不应让门控把它们当作提问跳过
+QUESTION_WORD_STATEMENTS = [
+    "我有几个孩子",
+    "我买了几本书",
+    "我明天要去几个地方开会",
+    "我知道怎么做蛋糕",
+    "我是谁",
+]
+
+
+def precision_recall(labels, decisions):
+    """计算精确率、召回率和准确率"""
+    tp = sum(1 for label, decision in zip(labels, decisions) if label and decision)
+    fp = sum(1 for label, decision in zip(labels, decisions) if not label and decision)
+    fn = sum(1 for label, decision in zip(labels, decisions) if label and not decision)
+    correct = sum(1 for label, decision in zip(labels, decisions) if label == decision)
+    return {
+        "precision": tp / (tp + fp) if tp + fp else 1.0,
+        "recall": tp / (tp + fn) if tp + fn else 1.0,
+        "accuracy": correct / len(labels),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="画像门控精确率/召回率评估")
+    parser.add_argument("--model", type=str, default=Config.MODEL_NAME, help="语言模型名称或路径")
+    parser.add_argument("--margin", type=float, default=Config.PROFILE_GATE_MARGIN, help="原型相似度差阈值")
+    args = parser.parse_args()
+
+    Config.MODEL_NAME = args.model
+    Config.EMBEDDING_CACHE_FILE = os.path.join(tempfile.mkdtemp(prefix="benchmark_gate_"), "e.sqlite3")
+    # 关闭磁盘缓存，计时前清空内存缓存，保证包含嵌入计算的耗时不被缓存命中掩盖
+    Config.EMBEDDING_CACHE_DISK_ENABLED = False
+
+    from models.model_interface import ModelInterface
+    from managers.profile_gate import ProfileFactGate
+
+    model_interface = ModelInterface()
+    gate = ProfileFactGate(model_interface, margin=args.margin)
+
+    steps = [step for case in load_test_cases() for step in case["context_chain"]]
+    inputs = [step["input"] for step in steps] + QUESTION_WORD_STATEMENTS
+    labels = [("expected_response" in step) for step in steps] + [True] * len(QUESTION_WORD_STATEMENTS)
+
+    # 预先计算输入向量，计时只包含门控判断本身
+    embeddings = model_interface.get_embeddings_batch(inputs)
+    gate.fact_score(embeddings[0])
+
+    results = {}
+
+    start = time.perf_counter()
+    results["规则 + 原型"] = [
+        gate.should_analyze(text, embedding) for text, embedding in zip(inputs, embeddings)
+    ]
+    combined_ms = (time.perf_counter() - start) / len(inputs) * 1000
+
+    start = time.perf_counter()
+    results["仅原型"] = [gate.fact_score(embedding) > args.margin for embedding in embeddings]
+    embedding_ms = (time.perf_counter() - start) / len(inputs) * 1000
+
+    rule_decisions = [ProfileFactGate.classify_by_rules(text) for text in inputs]
+    results["仅规则（无法判断时分析）"] = [decision is not False for decision in rule_decisions]
+
+    # 包含嵌入计算：规则无法判断的输入在门控中做一次嵌入前向计算
+    gate_times = []
+    embed_times = []
+    for text in inputs:
+        model_interface.embedding_cache.clear_memory()
+        start = time.perf_counter()
+        gate.should_analyze(text)
+        gate_times.append(time.perf_counter() - start)
+
+        model_interface.embedding_cache.clear_memory()
+        start = time.perf_counter()
+        model_interface.get_embedding(text)
+        embed_times.append(time.perf_counter() - start)
+    full_ms = sum(gate_times) / len(inputs) * 1000
+    embed_ms = sum(embed_times) / len(inputs) * 1000
+
+    model_interface.close()
+
+    print(f"\n共 {len(inputs)} 条输入，正例 {sum(labels)} 条，原型阈值 {args.margin}")
+    print(f"{'方法':<24} {'精确率':>8} {'召回率':>8} {'准确率':>8} {'跳过比例':>8}")
+    for name, decisions in results.items():
+        metrics = precision_recall(labels, decisions)
+        print(
+            f"{name:<24} {metrics['precision']:>8.2f} {metrics['recall']:>8.2f} "
+            f"{metrics['accuracy']:>8.2f} {1 - sum(decisions) / len(decisions):>8.0%}"
+        )
+    print(
+        f"规则可判断 {sum(d is not None for d in rule_decisions)}/{len(inputs)} 条；"
+        f"平均判断耗时（不含嵌入计算）：规则 + 原型 {combined_ms:.3f} ms，仅原型 {embedding_ms:.3f} ms"
+    )
+    print(
+        f"平均判断耗时（含嵌入计算）：规则 + 原型 {full_ms:.3f} ms，"
+        f"仅原型 {embedding_ms + embed_ms:.3f} ms；单条输入嵌入计算 {embed_ms:.3f} ms"
+    )
+    for text, label, decision in zip(inputs, labels, results["规则 + 原型"]):
+        if label != decision:
+            print(f"  误判: {'漏判' if label else '误报'} {text}")
+
+
+if __name__ == "__main__":
+    main()
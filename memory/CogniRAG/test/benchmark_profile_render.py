@@ -0,0 +1,118 @@
+"""用户画像写入提示的token数和耗时：完整JSON vs 按token预算渲染（100/500/2000轮后）"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import torch
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config.config import Config
+from benchmark_fused_pipeline import load_test_cases
+
+
+def build_profile(turns, statements, seed=0):
+    """模拟多轮对话后积累的画像：每轮一个事件，每10轮一个基本信息字段"""
+    rng = random.Random(seed)
+    profile = {"基本信息": {}, "事件": []}
+    for turn in range(turns):
+        profile["事件"].append(
+            {"时间": f"第{turn + 1}轮", "描述": rng.choice(statements), "地点": rng.choice(["公司", "家", "上海", "北京"])}
+        )
+        if turn % 10 == 0:
+            profile["基本信息"][f"属性{turn // 10}"] = rng.choice(statements)[:12]
+    return profile
+
+
+def clue_prompt(profile_text, user_input):
+    """与线索提取阶段相同的提示"""
+    return [
+        {"role": "system", "content": Config.ROLE_PROMPT["CLUE_EXTRACTOR_SYSTEM"]},
+        {
+            "role": "user",
+            "content": Config.ROLE_PROMPT["CLUE_EXTRACTOR_USER"].format(
+                user_profile=profile_text, user_input=user_input
+            ),
+        },
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用户画像渲染token数与耗时对比")
+    parser.add_argument("--model", type=str, default=Config.MODEL_NAME, help="语言模型名称或路径")
+    parser.add_argument("--turns", type=int, nargs="+", default=[100, 500, 2000], help="模拟对话轮数")
+    parser.add_argument("--budget", type=int, default=Config.PROFILE_TOKEN_BUDGET, help="画像token预算")
+    parser.add_argument("--prefill", action="store_true", help="同时测量提示的prefill耗时")
+    parser.add_argument("--max-prefill-tokens", type=int, default=8192, help="超过此长度的提示不做prefill")
+    args = parser.parse_args()
+
+    Config.MODEL_NAME = args.model
+    Config.EMBEDDING_CACHE_FILE = os.path.join(tempfile.mkdtemp(prefix="benchmark_render_"), "e.sqlite3")
+
+    from models.model_interface import ModelInterface
+    from managers.profile_renderer import ProfileRenderer
+
+    model_interface = ModelInterface()
+    tokenizer = model_interface.tokenizer
+
+    steps = [step for case in load_test_cases() for step in case["context_chain"]]
+    statements = [step["input"] for step in steps if "expected_response" in step]
+    questions = [step["input"] for step in steps if "keywords" in step]
+
+    def prompt_tokens(profile_text, user_input):
+        return model_interface._encode_prompt(clue_prompt(profile_text, user_input))
+
+    def prefill_ms(input_ids):
+        if not args.prefill or input_ids.shape[-1] > args.max_prefill_tokens:
+            return float("nan")
+        start = time.perf_counter()
+        with torch.no_grad():
+            model_interface.model(input_ids)
+        return (time.perf_counter() - start) * 1000
+
+    print(f"模型: {args.model}，画像预算 {args.budget} tokens，查询 {len(questions)} 条")
+    print(
+        f"{'轮数':>6} {'完整tokens':>10} {'渲染tokens':>10} {'首次渲染(ms)':>12} {'渲染(ms)':>9} "
+        f"{'完整prefill(ms)':>15} {'渲染prefill(ms)':>15}"
+    )
+    for turns in args.turns:
+        profile = build_profile(turns, statements)
+        renderer = ProfileRenderer(model_interface, token_budget=args.budget)
+
+        # 首次渲染需要为全部事件计算向量，之后每轮只处理新增事件
+        start = time.perf_counter()
+        renderer.render(profile, questions[0])
+        first_ms = (time.perf_counter() - start) * 1000
+
+        full_text = json.dumps(profile, ensure_ascii=False)
+        full_tokens, rendered_tokens, render_ms, full_prefill, rendered_prefill = [], [], [], [], []
+        for question in questions:
+            start = time.perf_counter()
+            rendered_text = renderer.render(profile, question)
+            render_ms.append((time.perf_counter() - start) * 1000)
+
+            full_ids = prompt_tokens(full_text, question)
+            rendered_ids = prompt_tokens(rendered_text, question)
+            full_tokens.append(full_ids.shape[-1])
+            rendered_tokens.append(rendered_ids.shape[-1])
+            full_prefill.append(prefill_ms(full_ids))
+            rendered_prefill.append(prefill_ms(rendered_ids))
+
+        def mean(values):
+            return sum(values) / len(values)
+
+        print(
+            f"{turns:>6} {mean(full_tokens):>10.0f} {mean(rendered_tokens):>10.0f} {first_ms:>12.1f} "
+            f"{mean(render_ms):>9.2f} {mean(full_prefill):>15.1f} {mean(rendered_prefill):>15.1f}"
+        )
+
+    model_interface.close()
+
+
+if __name__ == "__main__":
+    main()
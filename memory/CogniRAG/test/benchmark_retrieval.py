@@ -0,0 +1,133 @@
+"""多线索记忆检索性能对比：逐条线索查询 vs 单次多查询 + NumPy合并 vs 进程内扁平索引"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import chromadb
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config.config import Config
+from managers.memory import MemoryManager
+from managers.flat_index import FlatMemoryIndex
+
+
+def build_collection(num_memories, dimension, seed=0):
+    """构建包含随机记忆的内存ChromaDB集合"""
+    rng = np.random.default_rng(seed)
+    client = chromadb.EphemeralClient()
+    collection = client.create_collection(
+        name=f"benchmark_{int(time.time())}",
+        metadata={"hnsw:space": Config.COLLECTION_DISTANCE_TYPE},
+    )
+
+    embeddings = rng.standard_normal((num_memories, dimension)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    batch_size = 5000
+    for start in range(0, num_memories, batch_size):
+        end = min(start + batch_size, num_memories)
+        collection.add(
+            ids=[f"memory_{i}" for i in range(start, end)],
+            embeddings=embeddings[start:end].tolist(),
+            metadatas=[{"type": "memory"}] * (end - start),
+            documents=[
+                json.dumps({"用户": f"用户输入{i}", "助手": f"助手回复{i}"}, ensure_ascii=False)
+                for i in range(start, end)
+            ],
+        )
+    return collection, embeddings
+
+
+def make_clue_embeddings(memory_embeddings, num_clues, seed=1):
+    """以已有记忆为中心加噪声构造线索向量，保证部分结果能通过相似度阈值"""
+    rng = np.random.default_rng(seed)
+    centers = memory_embeddings[rng.choice(len(memory_embeddings), num_clues, replace=False)]
+    clues = centers + 0.03 * rng.standard_normal(centers.shape).astype(np.float32)
+    clues /= np.linalg.norm(clues, axis=1, keepdims=True)
+    return clues.tolist()
+
+
+def retrieve_per_clue(collection, clue_embeddings, top_k):
+    """旧实现：每条线索单独查询，逐条解析、过滤和去重"""
+    larger_top_k = min(top_k * 3, 20)
+    all_memories = {}
+    for clue_embedding in clue_embeddings:
+        results = collection.query(query_embeddings=[clue_embedding], n_results=larger_top_k)
+        for j in range(len(results["documents"][0])):
+            distance = results["distances"][0][j]
+            similarity = 1 - distance
+            if similarity < Config.SIMILARITY_THRESHOLD:
+                continue
+            memory_obj = json.loads(results["documents"][0][j])
+            memory_obj["distance"] = distance
+            memory_obj["similarity"] = similarity
+            memory_id = results["ids"][0][j]
+            if memory_id not in all_memories or all_memories[memory_id]["distance"] > distance:
+                all_memories[memory_id] = memory_obj
+    memories_list = sorted(all_memories.values(), key=lambda x: x["distance"])
+    return memories_list[:top_k]
+
+
+def retrieve_batched(collection, clue_embeddings, top_k):
+    """新实现：一次多查询，NumPy合并结果"""
+    larger_top_k = min(top_k * 3, 20)
+    results = collection.query(query_embeddings=clue_embeddings, n_results=larger_top_k)
+    rows = list(zip(results["ids"], results["documents"], results["distances"]))
+    return MemoryManager._merge_query_rows(rows, top_k)
+
+
+def retrieve_flat(flat_index, clue_embeddings, top_k):
+    """扁平索引实现：一次矩阵乘法，NumPy合并结果"""
+    larger_top_k = min(top_k * 3, 20)
+    results = flat_index.query(clue_embeddings, larger_top_k)
+    rows = list(zip(results["ids"], results["documents"], results["distances"]))
+    return MemoryManager._merge_query_rows(rows, top_k)
+
+
+def time_call(func, repeats):
+    """多次运行并返回平均耗时（毫秒）"""
+    func()  # 预热
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多线索记忆检索性能对比")
+    parser.add_argument("--memories", type=int, default=50000, help="集合中的记忆数量")
+    parser.add_argument("--dimension", type=int, default=512, help="嵌入向量维度")
+    parser.add_argument("--clues", type=int, nargs="+", default=[1, 3, 5, 10], help="线索数量")
+    parser.add_argument("--repeats", type=int, default=20, help="每组重复次数")
+    args = parser.parse_args()
+
+    top_k = Config.MEMORY_RETRIEVAL_TOP_K
+    print(f"构建 {args.memories} 条记忆的集合 (维度 {args.dimension})...")
+    collection, memory_embeddings = build_collection(args.memories, args.dimension)
+    flat_index = FlatMemoryIndex.from_collection(collection, args.dimension)
+
+    print(
+        f"{'线索数':>6} {'逐条查询(ms)':>14} {'合并查询(ms)':>14} {'扁平索引(ms)':>14} "
+        f"{'加速比':>8} {'结果一致':>8}"
+    )
+    for num_clues in args.clues:
+        clue_embeddings = make_clue_embeddings(memory_embeddings, num_clues)
+        old_ms = time_call(lambda: retrieve_per_clue(collection, clue_embeddings, top_k), args.repeats)
+        new_ms = time_call(lambda: retrieve_batched(collection, clue_embeddings, top_k), args.repeats)
+        flat_ms = time_call(lambda: retrieve_flat(flat_index, clue_embeddings, top_k), args.repeats)
+
+        old_docs = [m["用户"] for m in retrieve_per_clue(collection, clue_embeddings, top_k)]
+        new_docs = [m["用户"] for m in retrieve_batched(collection, clue_embeddings, top_k)]
+        print(
+            f"{num_clues:>6} {old_ms:>14.2f} {new_ms:>14.2f} {flat_ms:>14.2f} {old_ms / new_ms:>7.2f}x "
+            f"{str(old_docs == new_docs):>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,14 @@ def clear_memory_data():
     profile_file = os.path.join(profile_dir, "user_profile.json")
     if os.path.exists(profile_file):
         os.remove(profile_file)
+    # 画像追加日志
+    profile_log_file = os.path.join(profile_dir, "user_profile.log.jsonl")
+    if os.path.exists(profile_log_file):
+        os.remove(profile_log_file)
+    # 默认会话的对话历史
+    history_file = os.path.join(profile_dir, "user_profile.history.json")
+    if os.path.exists(history_file):
+        os.remove(history_file)
     # 确保目录存在
     os.makedirs(profile_dir, exist_ok=True)
     # 创建一个空的用户配置文件
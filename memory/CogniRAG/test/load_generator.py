@@ -0,0 +1,108 @@
+"""多用户负载生成：模拟大量用户交替对话，统计延迟、吞吐、会话换入换出和内存占用"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import numpy as np
+
+# 添加src目录到Python路径
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config.config import Config
+from benchmark_fused_pipeline import load_test_cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多用户交替对话负载生成")
+    parser.add_argument("--model", type=str, default=Config.MODEL_NAME, help="语言模型名称或路径")
+    parser.add_argument("--users", type=int, default=1000, help="模拟用户数")
+    parser.add_argument("--requests", type=int, default=500, help="总请求数")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发请求线程数")
+    parser.add_argument("--max-sessions", type=int, default=64, help="常驻内存的会话数上限")
+    parser.add_argument("--skew", type=float, default=1.1, help="用户活跃度的Zipf指数，0表示均匀分布")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    args = parser.parse_args()
+
+    # 数据写入临时目录，不影响正式的用户画像和记忆库
+    tmp_dir = tempfile.mkdtemp(prefix="load_generator_")
+    Config.MODEL_NAME = args.model
+    Config.MEMORY_DB_DIR = os.path.join(tmp_dir, "memory")
+    Config.USER_DATA_FILE = os.path.join(tmp_dir, "user", "user_profile.json")
+    Config.MAX_ACTIVE_SESSIONS = args.max_sessions
+    os.makedirs(os.path.dirname(Config.USER_DATA_FILE), exist_ok=True)
+
+    from app import ResponseProcessor
+
+    processor = ResponseProcessor()
+
+    # 每个用户按顺序复述一条测试链，多个用户的请求交替到达
+    chains = [[step["input"] for step in case["context_chain"]] for case in load_test_cases()]
+    rng = random.Random(args.seed)
+    weights = 1.0 / np.arange(1, args.users + 1) ** args.skew
+    users = rng.choices(range(args.users), weights=weights.tolist(), k=args.requests)
+    positions = {}
+    requests = []
+    for user in users:
+        chain = chains[user % len(chains)]
+        step = positions.get(user, 0)
+        positions[user] = step + 1
+        requests.append((f"user{user:05d}", chain[step % len(chain)]))
+
+    lock = threading.Lock()
+    latencies = []
+    failures = []
+
+    def worker():
+        while True:
+            with lock:
+                if not requests:
+                    return
+                user_id, user_input = requests.pop(0)
+            start = time.perf_counter()
+            try:
+                processor.process_user_input(user_input, user_id=user_id)
+            except Exception as e:
+                with lock:
+                    failures.append((user_id, str(e)))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    session_stats = processor.session_manager.stats()
+    processor.close()
+
+    latencies = np.asarray(latencies)
+    print(f"\n模型: {args.model}")
+    print(
+        f"用户 {args.users}（实际访问 {len(positions)}），请求 {args.requests}，"
+        f"并发 {args.concurrency}，会话上限 {args.max_sessions}"
+    )
+    print(f"完成 {len(latencies)} 条，失败 {len(failures)} 条，总耗时 {elapsed:.1f} 秒，"
+          f"吞吐 {len(latencies) / elapsed:.2f} 请求/秒")
+    if len(latencies):
+        print(
+            f"延迟 p50 {np.percentile(latencies, 50):.2f} 秒，p95 {np.percentile(latencies, 95):.2f} 秒，"
+            f"最大 {latencies.max():.2f} 秒"
+        )
+    print(f"会话统计: {session_stats}")
+    # Linux上ru_maxrss单位为KB
+    print(f"进程峰值内存: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    for user_id, error in failures[:5]:
+        print(f"失败: {user_id} {error}")
+
+
+if __name__ == "__main__":
+    main()